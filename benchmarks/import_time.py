@@ -0,0 +1,89 @@
+"""
+    fabcloudkit
+
+    Measures the cold import time of fabcloudkit: each run is a new interpreter that imports
+    the package, so nothing is cached in-process between runs. Reports the time of the import
+    itself (measured inside the interpreter) and of the whole process, minus an interpreter
+    that imports nothing. Also lists heavy modules that the import pulled in; tools, boto and
+    pkg_resources should only be imported when they're first used (see Tool.__modules__).
+
+    Run from the repository root, with the interpreter you deploy with:
+
+        python benchmarks/import_time.py [--runs 20] [--module fabcloudkit]
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import, print_function
+
+# standard
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+# modules that "import fabcloudkit" shouldn't need.
+HEAVY = ['boto', 'pkg_resources', 'fabcloudkit.tool.git', 'fabcloudkit.build_tools.python_build',
+         'fabcloudkit.activation_tools.nginx_gunicorn_activation']
+
+_CHILD = """
+import json, sys, time
+start = time.time()
+__import__(sys.argv[1])
+secs = time.time() - start
+print(json.dumps(dict(secs=secs, heavy=[m for m in json.loads(sys.argv[2]) if m in sys.modules])))
+"""
+
+
+def run_once(module):
+    # returns (import seconds, process seconds, heavy modules imported).
+    start = time.time()
+    cmd = [sys.executable] + ['-W' + w for w in sys.warnoptions] + ['-c', _CHILD, module, json.dumps(HEAVY)]
+    output = subprocess.check_output(cmd, cwd=_ROOT)
+    elapsed = time.time() - start
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    return result['secs'], elapsed, result['heavy']
+
+def baseline():
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', 'pass'])
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cold import time of fabcloudkit.')
+    parser.add_argument('--runs', type=int, default=20, help='number of interpreters to start (default: 20)')
+    parser.add_argument('--module', default='fabcloudkit', help='module to import (default: fabcloudkit)')
+    args = parser.parse_args()
+
+    run_once(args.module)  # warm the OS file cache and write bytecode; not counted.
+    imports, processes, base = [], [], []
+    heavy = set()
+    for _ in range(args.runs):
+        secs, elapsed, modules = run_once(args.module)
+        imports.append(secs)
+        processes.append(elapsed)
+        heavy.update(modules)
+        base.append(baseline())
+
+    print('{0}: {1} run(s), {2}'.format(args.module, args.runs, sys.version.split()[0]))
+    print('  {0:<24}{1:>10}{2:>10}{3:>10}'.format('', 'min', 'median', 'max'))
+    for label, values in [('import (s)', imports),
+                          ('process - baseline (s)', [p - _median(base) for p in processes])]:
+        print('  {0:<24}{1:>10.3f}{2:>10.3f}{3:>10.3f}'.format(label, min(values), _median(values), max(values)))
+    print('  heavy modules imported: {0}'.format(', '.join(sorted(heavy)) or 'none'))
+
+
+# -------------------- private implementation --------------------
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+if __name__ == '__main__':
+    main()
@@ -28,6 +28,5 @@ def load(self, path):
     with open(path, 'r') as f:
         self._set_dct(yaml.safe_load(f.read()))
 
-import fabcloudkit.activation_tools
-import fabcloudkit.build_tools
-import fabcloudkit.tool
+# note: tool modules (fabcloudkit.tool, fabcloudkit.build_tools, fabcloudkit.activation_tools)
+# aren't imported here; Tool.create() imports them on first use. see Tool.__modules__.
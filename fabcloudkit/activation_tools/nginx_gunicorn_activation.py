@@ -113,8 +113,7 @@ class NginxGUnicornActivationTool(Tool):
             failed_msg('Error stopping gunicorn server; ignoring.')
             pass
 
-        active.build = None
-        info.save()
+        info.set_active(name, build=None)
         succeed_msg('Finished deactivating instance in role: "{0}".'.format(env.role_name))
         return self
 
@@ -202,6 +201,4 @@ class _BuildInfoHelper(object):
             or self.active.build is None
 
     def update_active(self, build_name, port):
-        self.active.build = build_name
-        self.active.port = port
-        self.build_info.save()
+        self.build_info.set_active(self.active.name, build=build_name, port=port)
@@ -0,0 +1,321 @@
+"""
+    fabcloudkit
+
+    Functions for storing build artifacts (tarballs) outside of the builder instance, so that
+    instances can fetch a build without depending on (or having SSH access to) the builder.
+
+    A store holds, for each build name:
+
+    <file>:
+        The build tarball, named as it is in the builds root (e.g., "<build>.tar.gz").
+
+    <build>.json:
+        The build's metadata: the tarball "file" name, its "size" and "sha256" content hash,
+        plus whatever the build recorded (commits, interpreter, codec, etc.).
+
+    last_good:
+        The name of the most recently published build.
+
+    memo_<input-key>:
+        The name of a build made from the inputs with that key (see PythonBuildTool.build()).
+
+    The store is configured by the "artifact_store" section of the context file:
+
+        artifact_store:
+          type: s3                  # an S3, or S3-compatible, bucket.
+          bucket: my-builds
+          prefix: myproject         # optional; a key prefix.
+          host: s3.example.com      # optional; for S3-compatible stores.
+
+        artifact_store:
+          type: http                # a directory served by the "artifact_server" tool, which
+          url: http://10.0.0.5:8142 # accepts PUT and ranged GET requests.
+          token: !env FCK_ARTIFACT_TOKEN  # required for PUT; the same token the server was
+                                          # installed with.
+
+    Large files go directly between the instance and the store: uploads with curl, and
+    downloads with several concurrent ranged GETs. For S3, the URLs are pre-signed locally so
+    instances don't need AWS credentials.
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# standard
+import json
+import posixpath as path
+
+# pypi
+from fabric.operations import run
+
+# package
+from fabcloudkit import ctx
+from .internal import *
+from .remote_util import run_json
+from .util import put_string, tmp_file_name
+
+
+__all__ = ['ArtifactStore', 'HttpStore', 'S3Store']
+
+
+class ArtifactStore(object):
+    @classmethod
+    def create(cls, spec=None):
+        """Creates the store described by spec, or by the current context's "artifact_store" section.
+
+        :return: the ArtifactStore-derived object, or None if no store is configured.
+        """
+        if spec is None:
+            spec = ctx().get('artifact_store', None)
+        if not spec:
+            return None
+
+        kwargs = dict(spec)
+        store_type = kwargs.pop('type', 'http')
+        store_cls = _STORES.get(store_type, None)
+        if store_cls is None:
+            raise HaltError('Unknown artifact store type: "{0}"'.format(store_type))
+        return store_cls(**kwargs)
+
+    def put(self, build_name, file_path, meta=None, last_good=True):
+        """Publishes a build's tarball from the current instance.
+
+        :param build_name: the build name.
+        :param file_path: the path of the tarball on the current instance.
+        :param meta: optional; a dict of build metadata to store with it.
+        :param last_good: True to also make this the store's last good build.
+        :return: the stored metadata.
+        """
+        start_msg('----- Publishing build "{0}" to artifact store:'.format(build_name))
+        result = run('sha256sum {0} && stat -c %s {0}'.format(file_path), quiet=True)
+        if result.failed:
+            raise HaltError('Unable to read artifact: "{0}"'.format(file_path))
+        lines = result.splitlines()
+        digest, size = lines[0].split()[0], int(lines[-1])
+
+        file_name = path.basename(file_path)
+        result = self._upload(file_path, file_name)
+        if result.failed:
+            raise HaltError('Failed to upload artifact: "{0}"'.format(file_name))
+
+        meta = dict(meta or {}, file=file_name, size=size, sha256=digest)
+        self._write('{0}.json'.format(build_name), json.dumps(meta, sort_keys=True))
+        if last_good:
+            self.set_last_good(build_name)
+        succeed_msg('Published "{0}" ({1} bytes, sha256 {2}).'.format(file_name, size, digest))
+        return meta
+
+    def get(self, build_name, dest_dir, connections=4):
+        """Downloads a build's tarball to the current instance, and verifies its hash.
+
+        :param build_name: the build name.
+        :param dest_dir: the directory to download the tarball into.
+        :param connections: the number of concurrent ranged GET requests.
+        :return: the build's metadata (see put()).
+        """
+        meta = self.meta(build_name)
+        if meta is None:
+            raise HaltError('Build "{0}" is not in the artifact store.'.format(build_name))
+
+        start_msg('----- Downloading build "{0}" from artifact store:'.format(build_name))
+        dest = path.join(dest_dir, meta['file'])
+        args = "'{0}' {1} {2} {3}".format(self._url(meta['file'], 'GET'), dest, meta['size'], connections)
+        info = run_json(_DOWNLOAD_SCRIPT, args)
+        if info is None or info['sha256'] != meta['sha256']:
+            run('rm -f {0}'.format(dest))
+            raise HaltError('Download of "{0}" failed or is corrupt ({1}).'.format(
+                meta['file'], info['errors'] if info else 'no result'))
+
+        succeed_msg('Downloaded "{0}" in {1} part(s); sha256 verified.'.format(meta['file'], info['parts']))
+        return meta
+
+    def exists(self, build_name):
+        return self.meta(build_name) is not None
+
+    def list(self):
+        """Returns the names of the builds in the store."""
+        return sorted([name[:-len('.json')] for name in self._names() if name.endswith('.json')])
+
+    def last_good(self):
+        """Returns the name of the last published build, or None."""
+        data = self._read(_LAST_GOOD)
+        return data.strip() if data else None
+
+    def set_last_good(self, build_name):
+        """Makes a stored build the store's last good build (e.g., when it's reused)."""
+        self._write(_LAST_GOOD, build_name)
+        return self
+
+    def memo(self, input_key):
+        """Returns the name of a stored build made from the inputs with the given key, or None."""
+        data = self._read('memo_{0}'.format(input_key))
+        return data.strip() if data else None
+
+    def set_memo(self, input_key, build_name):
+        self._write('memo_{0}'.format(input_key), build_name)
+        return self
+
+    def meta(self, build_name):
+        """Returns a build's metadata, or None if the build isn't in the store."""
+        data = self._read('{0}.json'.format(build_name))
+        return json.loads(data) if data else None
+
+    # implemented by stores: read and write small objects, list object names, and return a URL
+    # that the current instance can use for an object.
+    def _read(self, name):
+        raise NotImplementedError()
+
+    def _write(self, name, data):
+        raise NotImplementedError()
+
+    def _names(self):
+        raise NotImplementedError()
+
+    def _url(self, name, method):
+        raise NotImplementedError()
+
+    def _upload(self, file_path, name):
+        # uploads a file from the current instance; returns the result of the command.
+        return run("curl -sSf -H 'Expect:' -T {0} '{1}'".format(file_path, self._url(name, 'PUT')))
+
+
+class HttpStore(ArtifactStore):
+    """A store served over HTTP by the "artifact_server" tool. Requests are made from the current
+    instance, so the store only has to be reachable from instances. Writes need the server's
+    token; without one, the store can only be read."""
+    def __init__(self, url, token=None):
+        self._base_url = url.rstrip('/')
+        self._token = token
+
+    def _read(self, name):
+        result = run("curl -sSf '{0}'".format(self._url(name, 'GET')), quiet=True)
+        return result if result.succeeded else None
+
+    def _write(self, name, data):
+        tmp = tmp_file_name()
+        put_string(data, tmp)
+        result = self._upload(tmp, name)
+        run('rm -f {0}'.format(tmp), quiet=True)
+        if result.failed:
+            raise HaltError('Failed to write "{0}" to artifact store.'.format(name))
+
+    def _upload(self, file_path, name):
+        if not self._token:
+            raise HaltError('The artifact store has no "token"; it can only be read.')
+
+        # the token goes in a curl config file, so it isn't on the command line or in the output.
+        config = tmp_file_name(ext='.curl')
+        put_string('header = "Authorization: Bearer {0}"\n'.format(self._token), config, mode=00600)
+        result = run("curl -sSf -K {0} -H 'Expect:' -T {1} '{2}'".format(config, file_path, self._url(name, 'PUT')))
+        run('rm -f {0}'.format(config), quiet=True)
+        return result
+
+    def _names(self):
+        result = run("curl -sSf '{0}/'".format(self._base_url), quiet=True)
+        if result.failed:
+            raise HaltError('Unable to list artifact store: "{0}"'.format(self._base_url))
+        return json.loads(result)
+
+    def _url(self, name, method):
+        return '{0}/{1}'.format(self._base_url, name)
+
+
+class S3Store(ArtifactStore):
+    """A store in an S3 (or S3-compatible) bucket. Metadata is read and written locally with boto;
+    instances transfer tarballs using pre-signed URLs."""
+    def __init__(self, bucket, prefix='', key=None, secret=None, host=None, port=None, is_secure=True,
+                 expires=3600):
+        self._bucket_name = bucket
+        self._prefix = prefix.strip('/')
+        self._key = key
+        self._secret = secret
+        self._host = host
+        self._port = port
+        self._is_secure = is_secure
+        self._expires = expires
+        self._conn = None
+
+    def _read(self, name):
+        key = self._bucket().get_key(self._key_name(name))
+        return key.get_contents_as_string() if key else None
+
+    def _write(self, name, data):
+        self._bucket().new_key(self._key_name(name)).set_contents_from_string(data)
+
+    def _names(self):
+        start = len(self._prefix) + 1 if self._prefix else 0
+        return [key.name[start:] for key in self._bucket().list(prefix=self._key_name(''))]
+
+    def _url(self, name, method):
+        self._bucket()
+        return self._conn.generate_url(self._expires, method, self._bucket_name, self._key_name(name))
+
+    def _key_name(self, name):
+        return '{0}/{1}'.format(self._prefix, name) if self._prefix else name
+
+    def _bucket(self):
+        if self._conn is None:
+            # boto is slow to import; defer it until needed.
+            from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+            kwargs = dict(is_secure=self._is_secure)
+            if self._host:
+                kwargs.update(host=self._host, calling_format=OrdinaryCallingFormat())
+            if self._port:
+                kwargs.update(port=self._port)
+            self._conn = S3Connection(self._key or ctx().aws_key, self._secret or ctx().aws_secret, **kwargs)
+        return self._conn.get_bucket(self._bucket_name, validate=False)
+
+
+# -------------------- private implementation --------------------
+
+_STORES = {
+    'http': HttpStore,
+    's3': S3Store
+}
+
+_LAST_GOOD = 'last_good'
+
+# arguments: URL, destination path, size, number of connections. downloads the file with
+# concurrent ranged GET requests (or one plain GET if the server ignores ranges), and prints
+# its sha256.
+_DOWNLOAD_SCRIPT = """
+import hashlib, json, shutil, sys, threading
+try:
+    from urllib2 import Request, urlopen
+except ImportError:
+    from urllib.request import Request, urlopen
+url, dest, size, n = sys.argv[1], sys.argv[2], int(sys.argv[3]), max(1, int(sys.argv[4]))
+errors = []
+def fetch(start, end):
+    try:
+        r = urlopen(Request(url, headers={'Range': 'bytes=%d-%d' % (start, end)}))
+        if r.getcode() != 206:
+            raise IOError('server ignored range request')
+        f = open(dest, 'r+b')
+        f.seek(start)
+        shutil.copyfileobj(r, f, 1 << 20)
+        f.close()
+    except Exception as e:
+        errors.append(str(e))
+f = open(dest, 'wb')
+f.truncate(size)
+f.close()
+chunk = max(1 << 20, -(-size // n))
+ranges = [(s, min(s + chunk, size) - 1) for s in range(0, size, chunk)]
+threads = [threading.Thread(target=fetch, args=r) for r in ranges]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+if errors:
+    f = open(dest, 'wb')
+    shutil.copyfileobj(urlopen(url), f, 1 << 20)
+    f.close()
+    ranges = [(0, size - 1)]
+h = hashlib.sha256()
+f = open(dest, 'rb')
+for block in iter(lambda: f.read(1 << 20), b''):
+    h.update(block)
+print(json.dumps(dict(sha256=h.hexdigest(), parts=len(ranges), errors=errors)))
+"""
@@ -7,46 +7,415 @@
 from __future__ import absolute_import
 
 # standard
+import hashlib
+import copy
 import json
+import pipes
 import posixpath as path
-from StringIO import StringIO
+import re
+import time
+from contextlib import contextmanager
 
 # pypi
-from fabric.context_managers import cd, prefix
-from fabric.operations import get, run
+from fabric.context_managers import cd, prefix, settings
+from fabric.operations import run
 
 # package
 from fabcloudkit import ctx
-from fabcloudkit.tool import GitTool
+from fabcloudkit.tool.git import GitTool
 from fabcloudkit.tool.virtualenv import VirtualEnvTool
+from .host_vars import get_value, set_value
 from .internal import *
+from .remote_util import host_facts, run_json
 from .util import *
 
 
 __all__ = ['increment_name']
 
 
-def build_repo(build_env_dir, repo):
-    full_repo_dir = ctx().repo_path(repo.dir)
-    dist_dir = path.join(full_repo_dir, 'dist')
+def build_repo(build_env_dir, repo, reinstall=False, wheelhouse=None):
+    build_repos(build_env_dir, [repo], reinstall, wheelhouse)
+
+
+def build_repos(build_env_dir, repo_list, reinstall=False, wheelhouse=None, timer=None):
+    """Creates a source distribution for each repo, and installs them all into the build virtualenv.
+
+    The "setup.py sdist" commands run concurrently, and the distributions are installed with a
+    single "pip install", so packages from different repos are resolved together. If the combined
+    install fails, each repo is installed on its own to identify the one(s) that failed.
+
+    With a BuildTimer, the "sdist" and "pip_install" phases are timed.
+    """
+    if not repo_list:
+        return
+
+    names = [repo.dir for repo in repo_list]
+    dist_dirs = [path.join(ctx().repo_path(repo.dir), 'dist') for repo in repo_list]
+
+    # with the build virtualenv activated.
+    with prefix(VirtualEnvTool.activate_prefix(build_env_dir)):
+        start_msg('Running "python setup.py sdist" for repo(s): {0}'.format(', '.join(names)))
+
+        # first create a source distribution using setup.py in each repo, all at once.
+        with _timed(timer, 'sdist'):
+            results = run_json(_SDIST_SCRIPT, ' '.join([ctx().repo_path(name) for name in names]))
+        if results is None:
+            raise HaltError('"python setup.py sdist" failed in repo(s): {0}'.format(', '.join(names)))
+        failed = [name for name in names if results[ctx().repo_path(name)]['code']]
+        for name in failed:
+            failed_msg('"python setup.py sdist" failed in repo "{0}":\n{1}'.format(
+                name, results[ctx().repo_path(name)]['output']))
+        if failed:
+            raise HaltError('"python setup.py sdist" failed in repo(s): {0}'.format(', '.join(failed)))
+
+        # a cloned virtualenv (see VirtualEnvTool.clone) already has the previous versions; remove
+        # them rather than letting pip overwrite files that are shared with the previous build.
+        packages = [repo.package_name for repo in repo_list]
+        if reinstall:
+            run('pip uninstall --yes --quiet {0}'.format(' '.join(packages)))
+
+        # now use pip to install. pip does a "flat" (not versioned) install, no eggs, and consistent
+        # package directory names. with a wheelhouse, dependencies are installed from pre-built wheels
+        # and pypi is only used to fill in missing wheels; otherwise pip gets them from pypi.
+        start_msg('Running "pip install" for package(s): {0}'.format(', '.join(packages)))
+        with _timed(timer, 'pip_install'):
+            installed = _pip_install(packages, dist_dirs, wheelhouse)
+        if not installed:
+            failed = [repo.dir for repo, dist_dir in zip(repo_list, dist_dirs)
+                      if not _pip_install([repo.package_name], [dist_dir], wheelhouse)]
+            for name in failed:
+                failed_msg('"pip install" failed in repo: "{0}"'.format(name))
+            raise HaltError('"pip install" failed in repo(s): {0}'.format(', '.join(failed or names)))
+        succeed_msg('Build successful.')
+
 
-    # with the build virtualenv activated, and within the repo directory.
-    with prefix(VirtualEnvTool.activate_prefix(build_env_dir)), cd(full_repo_dir):
-        start_msg('Running "python setup.py install" for repo "{0}"'.format(repo.dir))
+def resolve_requirements(repo_list, interpreter=None):
+    """Determines the third-party install requirements of a set of repos.
+
+    Requirements come from each repo's setup.py ("install_requires") and requirements.txt;
+    the repos' own packages are excluded.
+
+    :return: a dict containing "requirements" (a sorted list of requirement specifiers) and
+             "python" (the interpreter version), or None if they can't be determined.
+    """
+    args = ' '.join([','.join([repo.package_name for repo in repo_list])] +
+                    [ctx().repo_path(repo.dir) for repo in repo_list])
+    info = run_json(_REQUIREMENTS_SCRIPT, args, python=interpreter or 'python')
+    if info is None:
+        failed_msg('Unable to determine install requirements.')
+    return info
+
+
+def timing_report(count=10, threshold=25.0, min_secs=1.0):
+    """Reports the phase timings (see BuildTimer) of the last good builds on the current host.
+
+    Prints the wall-clock seconds of each phase for each build, oldest first. A phase of the
+    latest build is flagged as a regression when it took more than "threshold" percent longer
+    than the median of the earlier builds (and at least "min_secs" longer, to ignore noise).
+
+    :param count: the number of builds to report.
+    :param threshold: the regression threshold, in percent.
+    :param min_secs: the minimum increase, in seconds, that counts as a regression.
+    :return: a dict mapping each regressed phase to a dict containing "latest" and "median".
+    """
+    info = BuildInfo().load()
+    names = sorted([name for name, meta in info.builds.iteritems() if meta.get('timing', None)],
+                   key=info.build_number)[-count:]
+    if not names:
+        message('No timed builds.')
+        return {}
+
+    timings = [info.build(name)['timing'] for name in names]
+    phases = [phase for phase in BuildTimer.PHASES if any([phase in t for t in timings])]
+    phases.extend(sorted(set([phase for t in timings for phase in t]) - set(phases)))
+
+    start_msg('----- Build phase timings (wall-clock seconds; latest build last):')
+    message('{0:<12} {1}'.format('build', ' '.join(['{0:>8}'.format(info.build_number(n)) for n in names])))
+    scratch = [(info.build(name).get('scratch', None) or {}).get('mode', 'disk') for name in names]
+    message('{0:<12} {1}'.format('built on', ' '.join(['{0:>8}'.format(mode) for mode in scratch])))
+    regressions = {}
+    for phase in phases:
+        walls = [t[phase]['wall'] if phase in t else None for t in timings]
+        row = '{0:<12} {1}'.format(phase, ' '.join(['{0:>8}'.format('-' if w is None else '{0:.1f}'.format(w))
+                                                    for w in walls]))
+        earlier = sorted([w for w in walls[:-1] if w is not None])
+        latest = walls[-1]
+        if earlier and latest is not None:
+            median = earlier[len(earlier) // 2]
+            if latest > median * (1 + threshold / 100.0) and latest - median >= min_secs:
+                regressions[phase] = dict(latest=latest, median=median)
+                yellow_msg('{0}   <-- regressed (median {1:.1f}s)'.format(row, median))
+                continue
+        message(row)
+
+    if regressions:
+        failed_msg('Regressed phase(s): {0}'.format(', '.join(sorted(regressions))))
+    else:
+        succeed_msg('No phase regressed by more than {0}%.'.format(threshold))
+    return regressions
+
+
+class BuildTimer(object):
+    """Times the phases of a build.
+
+    Each phase records its wall-clock time, and the CPU time used on the current host while it
+    ran ("cpu"; from /proc/stat, summed over all CPUs, so it includes anything else running on
+    the host). Reading /proc/stat takes a round trip, so a phase that starts right after
+    another ends reuses that reading.
+    """
+    # the phases of PythonBuildTool.build(), in order; used to order reports.
+    PHASES = ['prepare', 'virtualenv', 'requirements', 'sdist', 'pip_install', 'precompile', 'import_profile',
+              'unittest', 'tarball', 'persist', 'publish', 'post_build', 'total']
+
+    def __init__(self):
+        self.phases = {}
+        self._last = None
+        self._begin = None
+
+    def begin(self):
+        """Starts timing the whole build; see finish()."""
+        self._begin = self._last = self._reading(fresh=True)
+        return self
 
-        # first create a source distribution using setup.py in this repo.
-        result = run('python setup.py sdist --formats=gztar')
+    def finish(self):
+        """Records the time since begin() as the "total" phase."""
+        end = self._reading(fresh=True)
+        cpu = round(end[1] - self._begin[1], 2) if self._begin[1] is not None and end[1] is not None else None
+        self.phases['total'] = dict(wall=round(end[0] - self._begin[0], 2), cpu=cpu)
+        return self.phases
+
+    @contextmanager
+    def phase(self, name):
+        start = self._reading()
+        yield
+        self._last = end = self._reading(fresh=True)
+        cpu = round(end[1] - start[1], 2) if start[1] is not None and end[1] is not None else None
+        self.phases[name] = dict(wall=round(end[0] - start[0], 2), cpu=cpu)
+        message('Phase "{0}": {1:.1f}s wall, {2} CPU.'.format(
+            name, end[0] - start[0], '{0:.1f}s'.format(cpu) if cpu is not None else 'unknown'))
+
+    def _reading(self, fresh=False):
+        # returns (local time, host CPU seconds).
+        if not fresh and self._last and time.time() - self._last[0] < _TIMER_REUSE_SECS:
+            return self._last
+        result = run('head -1 /proc/stat && getconf CLK_TCK', quiet=True)
+        now = time.time()
         if result.failed:
-            raise HaltError('"python setup.py sdist" failed in repo: "{0}"'.format(repo.dir))
+            return now, None
+        lines = result.splitlines()
+        # cpu user nice system idle iowait irq softirq steal ...; idle and iowait aren't busy.
+        ticks = [int(n) for n in lines[0].split()[1:]]
+        return now, float(sum(ticks) - sum(ticks[3:5])) / int(lines[-1])
+
+
+class Wheelhouse(object):
+    """A directory of wheels built for a context's third-party dependencies.
+
+    Each dependency is built into a wheel once; installs then use "pip install --no-index" with
+    the wheelhouse as the only source, so they need neither the network nor a compiler. When an
+    install fails because a wheel is missing, the missing wheels are built concurrently (see
+    build(); sources are downloaded from pypi) and the install is retried.
+
+    The wheelhouse lives in <deploy_root>/<context-name>/<wheelhouse_dir>. It can be packed into
+    a tarball and copied to other instances (see copy_from()), so they can install offline.
+    """
+    def __init__(self, dir=None):
+        self._dir = dir if dir else ctx().wheelhouse_root()
 
-        # now use pip to install. couple of things to note:
-        # a) pip does a "flat" (not versioned) install, no eggs, and consistent package directory names.
-        # b) we're still allowing pip to grab packages from pypi; this should be fixed in a later version
-        #    where packages can (optionally) be picked up only from a local directory.
-        result = run('pip install --quiet --find-links=file://{dist_dir} {repo.package_name}'.format(**locals()))
+    @property
+    def dir(self):
+        return self._dir
+
+    def tarball_path(self):
+        return '{0}.tar.gz'.format(self._dir)
+
+    def install(self, requirements, find_links=None, exclude=None):
+        """Installs requirements into the active virtualenv from the wheelhouse.
+
+        :param requirements: list of requirement specifiers (e.g., "Flask>=0.9").
+        :param find_links: optional; other local directories with distributions (e.g., a repo's "dist").
+        :param exclude: optional; names of packages not to keep in the wheelhouse (e.g., the project's own).
+        :return: a dict mapping the name of each wheel that had to be built to its build time (seconds);
+                 empty if all requirements were already in the wheelhouse.
+        """
+        if not requirements:
+            return {}
+
+        run('mkdir -p {0}'.format(self._dir))
+        reqs = ' '.join(["'{0}'".format(r) for r in requirements])
+        links = ' '.join(['--find-links=file://{0}'.format(d) for d in [self._dir] + (find_links or [])])
+
+        result = run('pip install --quiet --no-index {links} {reqs}'.format(**locals()), quiet=True)
+        if result.succeeded:
+            succeed_msg('Installed from wheelhouse: {0}'.format(reqs))
+            return {}
+
+        # fill in the missing wheels, then install everything in one pass.
+        yellow_msg('Wheelhouse is missing wheels; building them.')
+        times = self.build(requirements, find_links)
+        for name in (exclude or []):
+            # wheel file names use underscores in place of dashes.
+            run('rm -f {0}'.format(path.join(self._dir, '{0}-*.whl'.format(name.replace('-', '_')))))
+
+        result = run('pip install --quiet --no-index {links} {reqs}'.format(**locals()))
         if result.failed:
-            raise HaltError('"pip install" failed in repo: "{0}"'.format(repo.dir))
-        succeed_msg('Build successful.')
+            raise HaltError('"pip install" from wheelhouse failed for: {0}'.format(reqs))
+        succeed_msg('Built wheels and installed from wheelhouse: {0}'.format(reqs))
+        return times
+
+    def build(self, requirements, find_links=None, processes=None):
+        """Builds wheels for requirements, and all of their dependencies, that aren't in the wheelhouse.
+
+        Requirements are resolved a level at a time: the wheels for one level are built concurrently
+        (one "pip wheel --no-deps" per package), and the dependencies listed in their metadata make
+        up the next level. The active virtualenv's python and pip are used.
+
+        :param requirements: list of requirement specifiers.
+        :param find_links: optional; other local directories with distributions.
+        :param processes: optional; the number of concurrent builds. default: the host's CPU count.
+        :return: a dict mapping the name of each wheel built to its build time (seconds).
+        """
+        if processes is None:
+            processes = host_facts()['cpu_count']
+        result = run('pip install --quiet wheel')
+        if result.failed:
+            raise HaltError('Unable to install "wheel" package.')
+
+        args = ' '.join(["'{0}'".format(a) for a in
+                         [self._dir, processes, ','.join(find_links or [])] + list(requirements)])
+        info = run_json(_WHEEL_SCRIPT, args)
+        if info is None:
+            raise HaltError('Failed to build wheels for: {0}'.format(', '.join(requirements)))
+
+        times = info['built']
+        message('Resolved {0} requirement(s); {1} wheel(s) built with {2} process(es):'.format(
+            len(info['requirements']), len(times), processes))
+        for name in sorted(times, key=times.get, reverse=True):
+            msg = '  {0:>7.1f}s  {1}'.format(times[name], name)
+            if times[name] >= _SLOW_WHEEL_SECS:
+                yellow_msg(msg)
+            else:
+                message(msg)
+        if info['failed']:
+            for name, output in sorted(info['failed'].iteritems()):
+                failed_msg('Failed to build wheel "{0}":\n{1}'.format(name, output))
+            raise HaltError('Failed to build wheel(s): {0}'.format(', '.join(sorted(info['failed']))))
+        return times
+
+    def pack(self):
+        """Creates a tarball of the wheelhouse, for copying to other instances.
+
+        :return: the tarball path.
+        """
+        tarball = self.tarball_path()
+        with cd(path.dirname(self._dir)):
+            result = run('mkdir -p {0} && tar --create --gzip --file={1} {2}'.format(
+                self._dir, tarball, path.basename(self._dir)))
+        if result.failed:
+            raise HaltError('Failed to create wheelhouse tarball: "{0}"'.format(tarball))
+        succeed_msg('Created wheelhouse tarball: "{0}"'.format(tarball))
+        return tarball
+
+    def copy_from(self, role_name):
+        """Copies the wheelhouse from an instance in the specified role, merging it into this one.
+
+        :param role_name: the role of the instance to copy the wheelhouse from.
+        :return: self
+        """
+        message('Copying wheelhouse from instance in role: "{0}"'.format(role_name))
+        inst, role = ctx().get_host_in_role(role_name)
+        with settings(host_string=inst.public_dns_name, user=role.user):
+            tarball = Wheelhouse(self._dir).pack()
+
+        run('mkdir -p {0}'.format(self._dir))
+        copy_file_from(role.user, inst.private_dns_name, tarball, tarball)
+        with cd(path.dirname(self._dir)):
+            run('tar --extract --gzip --keep-old-files --file={0} 2>/dev/null; rm -f {0}'.format(tarball))
+        count = run('ls {0} | grep -c "\\.whl$"'.format(self._dir), quiet=True)
+        succeed_msg('Wheelhouse now contains {0} wheel(s).'.format(count))
+        return self
+
+
+class DependencyCache(object):
+    """Caches virtualenvs ("layers") that contain only a build's third-party dependencies.
+
+    A layer is keyed by a hash of the install requirements of the repos being built (from
+    setup.py and requirements.txt) and the interpreter version. A build whose requirements
+    match an existing layer starts from a clone of it (see VirtualEnvTool.clone), so pip only
+    has to install the project packages themselves.
+
+    Layers live in the "_layers" directory under the builds root. Least-recently used layers
+    are deleted when the layers' total size is more than max_size_mb.
+    """
+    LAYERS_DIR = '_layers'
+
+    def __init__(self, max_size_mb=2048, wheelhouse=None):
+        self._max_size_mb = max_size_mb
+        self._wheelhouse = wheelhouse
+
+    def layers_root(self):
+        return ctx().build_path(self.LAYERS_DIR)
+
+    def layer_path(self, key):
+        return path.join(self.layers_root(), key)
+
+    def key(self, repo_list, interpreter=None):
+        """Computes the layer key for a set of repos.
+
+        :return: a tuple of (key, requirements list), or (None, None) if it can't be computed.
+        """
+        info = resolve_requirements(repo_list, interpreter)
+        if info is None:
+            return None, None
+
+        requirements = info['requirements']
+        key = hashlib.sha1(json.dumps([info['python'], requirements])).hexdigest()[:16]
+        return key, requirements
+
+    def checkout(self, build_env_dir, repo_list, interpreter=None):
+        """Creates the build's virtualenv from the matching layer, creating the layer on a miss.
+
+        :return: a dict describing the layer used ("key", "hit"), or None if no layer was used.
+        """
+        start_msg('----- Checking dependency cache:')
+        key, requirements = self.key(repo_list, interpreter)
+        if key is None:
+            return None
+
+        layer_dir = self.layer_path(key)
+        hit = run('test -f {0}'.format(path.join(layer_dir, _COMPLETE_FILE)), quiet=True).succeeded
+        if hit:
+            succeed_msg('Dependency cache hit: "{0}"'.format(key))
+        else:
+            yellow_msg('Dependency cache miss: "{0}"; creating layer.'.format(key))
+            self._create(layer_dir, requirements, interpreter)
+
+        run('touch {0}'.format(path.join(layer_dir, _LAST_USED_FILE)))
+        VirtualEnvTool().clone(layer_dir, build_env_dir)
+        self.evict(key)
+        return dict(key=key, hit=hit)
+
+    def evict(self, keep_key=None):
+        """Deletes least-recently used layers until their total size is within the limit."""
+        result = run_json(_EVICT_SCRIPT, '{0} {1} {2}'.format(
+            self.layers_root(), self._max_size_mb, keep_key or '-'))
+        if result and result['evicted']:
+            message('Evicted dependency layers: {0}'.format(', '.join(result['evicted'])))
+        return self
+
+    def _create(self, layer_dir, requirements, interpreter):
+        run('rm -rf {0}'.format(layer_dir))
+        VirtualEnvTool().ensure(layer_dir, interpreter, force_create=True)
+        if requirements and self._wheelhouse:
+            with prefix(VirtualEnvTool.activate_prefix(layer_dir)):
+                self._wheelhouse.install(requirements)
+        elif requirements:
+            with prefix(VirtualEnvTool.activate_prefix(layer_dir)):
+                reqs = ' '.join(["'{0}'".format(r) for r in requirements])
+                result = run('pip install --quiet {reqs}'.format(**locals()))
+                if result.failed:
+                    raise HaltError('Failed to install dependencies into layer: "{0}"'.format(layer_dir))
+        run('touch {0}'.format(path.join(layer_dir, _COMPLETE_FILE)))
 
 
 class _Active(object):
@@ -58,24 +427,24 @@ class _Active(object):
     def build(self):
         return self._dct.get('build', None)
 
-    @build.setter
-    def build(self, value):
-        self._dct['build'] = value
-
     @property
     def port(self):
         return self._dct.get('port', 0)
 
-    @port.setter
-    def port(self, value):
-        self._dct['port'] = value
-
     def __init__(self, key, dct):
         self._key = key
         self._dct = dct
 
 
 class BuildInfo(object):
+    """The build information file on the current host (see _default() for its contents).
+
+    Changes are made with transactions (see transact()): each runs on the host in one command,
+    under an exclusive flock, and replaces the file atomically (write to a temporary file, then
+    rename), so concurrent builds and activations on the host don't lose each other's updates.
+    Every change increments the file's version number; load() keeps the last document it read
+    for each host, and only fetches it again when the version has changed.
+    """
     BUILD_INFO_FILE = 'build_info.txt'
 
     @classmethod
@@ -87,26 +456,36 @@ class BuildInfo(object):
         return BuildInfo(context_name).load().last
 
     @classmethod
-    def set_last_good(cls, build_name):
-        BuildInfo().load().update(build_name)
+    def set_last_good(cls, build_name, **meta):
+        BuildInfo().update(build_name, **meta)
 
     @classmethod
     def next(cls, ref_repo_name):
         commit = GitTool().head_commit(ref_repo_name)
-        return BuildInfo().load().next_name(commit)
+        return BuildInfo().next_name(commit)
 
     @property
     def last(self):
         return self._dct['last']
 
-    @last.setter
-    def last(self, build_name):
-        self._dct['last'] = build_name
+    @property
+    def memo(self):
+        # maps build input keys to build names; files written by earlier versions don't have this.
+        return self._dct.setdefault('memo', {})
 
     @property
     def number(self):
         return self._dct['number']
 
+    @property
+    def version(self):
+        return self._dct.get('version', 0)
+
+    @property
+    def builds(self):
+        # files written by earlier versions don't have this.
+        return self._dct.setdefault('builds', {})
+
     def __init__(self, context_name=None):
         self._context_name = ctx().name if not context_name else context_name
         self._dct = None
@@ -115,52 +494,340 @@ class BuildInfo(object):
         return 'context-name: "{0}"; {1}'.format(self._context_name, self._dct.__repr__())
 
     def active(self, key):
-        return _Active(key, self._dct['active'].setdefault(key, {}))
+        return _Active(key, self._dct['active'].get(key, {}))
+
+    def active_builds(self):
+        """Returns the names of the builds that are active (for any key)."""
+        return [dct['build'] for dct in self._dct['active'].itervalues() if dct.get('build', None)]
+
+    def build(self, build_name):
+        """Returns the recorded information for a build (see update()), or None."""
+        return self.builds.get(build_name, None) if build_name else None
 
     def load(self):
-        if not self._info_exists():
-            self._dct = self._default()
-        else:
-            stream = StringIO()
-            result = get(self._file_path(), stream)
-            if result.failed:
-                raise HaltError('Unable to retrieve build info file: {0}'.format(self._file_path()))
-            self._dct = json.loads(stream.getvalue())
+        """Reads the file, unless this host's cached copy is still current."""
+        cached = get_value(self._cache_key())
+        self._dct = self._run(_INFO_READ_SCRIPT, [self._file_path(), cached['version'] if cached else -1,
+                                                  self._default()])
+        if self._dct.get('unchanged', False):
+            self._dct = copy.deepcopy(cached)
         return self
 
-    def save(self):
-        # print it purdy to make things easier on someone looking at the file contents.
-        put_string(
-            json.dumps(self._dct, sort_keys=True, indent=4, separators=(',', ': ')),
-            self._file_path(), use_sudo=True)
+    def transact(self, ops):
+        """Atomically applies a list of changes to the file on the current host.
+
+        :param ops: list of [op, keys, value] lists. keys is the path of the value to change,
+                    e.g. ['active', 'web', 'port'], and op is one of:
+                    "set": sets the value (an empty path replaces the whole document).
+                    "merge": updates the dict at the path with the given dict.
+                    "incr": adds the given number to the value.
+                    "delete": removes the value, if present (the given value is ignored).
+        :return: self, holding the new contents of the file.
+        """
+        self._dct = self._run(_INFO_TRANSACT_SCRIPT, [self._file_path(), ops, self._default()], use_sudo=True)
         return self
 
-    def next_name(self, commit):
-        n = self.number + 1
-        name = self._build_name(n, commit)
-        self._dct['number'] = n
-        self.save()
-        return name
-
-    def update(self, build_name):
-        self.last = build_name
-        self.save()
-        return self
+    def save(self):
+        # replaces the whole document; prefer transact(), which can't overwrite concurrent changes.
+        return self.transact([['set', [], self._dct]])
 
-    def _info_exists(self):
-        result = run('test -f {0}'.format(self._file_path()), quiet=True)
-        return result.succeeded
+    def next_name(self, commit):
+        self.transact([['incr', ['number'], 1]])
+        return self._build_name(self.number, commit)
+
+    def update(self, build_name, **meta):
+        ops = [['set', ['last'], build_name], ['merge', ['builds', build_name], meta]]
+        if meta.get('input_key', None):
+            ops.append(['set', ['memo', meta['input_key']], build_name])
+        return self.transact(ops)
+
+    def set_active(self, key, **values):
+        """Updates the active build information (e.g., "build" and "port") for a key."""
+        return self.transact([['merge', ['active', key], values]])
+
+    def _run(self, script, args, use_sudo=False):
+        dct = run_json(script, ' '.join([pipes.quote(json.dumps(arg)) for arg in args]), use_sudo=use_sudo)
+        if dct is None:
+            raise HaltError('Unable to access build info file: {0}'.format(self._file_path()))
+        if not dct.get('unchanged', False):
+            set_value(self._cache_key(), copy.deepcopy(dct))
+        return dct
+
+    def _cache_key(self):
+        return 'build_info:' + self._file_path()
 
     def _file_path(self):
         return ctx().repo_path(self.BUILD_INFO_FILE)
 
     def _default(self):
+        # version: incremented by every change to the file.
         # number: the mostly recently used build number (build may have failed).
         # last: name of the last known good build.
         # active: a dict mapping kys to dicts, the target dict contains:
         #         build: name of a build used for the key
         #         port: name of the port used for the key
-        return dict(number=0, last=None, active={})
+        # builds: a dict mapping good build names to information about the build, e.g.:
+        #         commits: a dict mapping repo name to the commit ID that was built
+        #         interpreter: the python interpreter used for the build's virtualenv
+        #         input_key: hash of the build's inputs (see PythonBuildTool.build(memoize=True))
+        #         timing: a dict mapping build phases to their times (see BuildTimer)
+        # memo: a dict mapping build input keys to the names of good builds with those inputs.
+        return dict(version=0, number=0, last=None, active={}, builds={}, memo={})
+
+    def build_number(self, build_name):
+        """Returns the number of a build, from its name (see _build_name()); 0 if it has none."""
+        match = re.match(r'^{0}_(\d+)_'.format(re.escape(self._context_name)), build_name or '')
+        return int(match.group(1)) if match else 0
 
     def _build_name(self, number, commit):
         return '{self._context_name}_{number:0>5}_{commit}'.format(**locals())
+
+
+# -------------------- private implementation --------------------
+
+# a phase that starts within this many seconds of the previous one ending reuses its reading.
+_TIMER_REUSE_SECS = 1.0
+
+@contextmanager
+def _no_phase():
+    yield
+
+def _timed(timer, name):
+    return timer.phase(name) if timer else _no_phase()
+
+def _pip_install(packages, dist_dirs, wheelhouse):
+    # installs packages from local distribution directories; returns True if successful.
+    if wheelhouse:
+        try:
+            wheelhouse.install(packages, find_links=dist_dirs, exclude=packages)
+            return True
+        except HaltError:
+            return False
+
+    links = ' '.join(['--find-links=file://{0}'.format(d) for d in dist_dirs])
+    return run('pip install --quiet {0} {1}'.format(links, ' '.join(packages))).succeeded
+
+_COMPLETE_FILE = '.fck_complete'
+_SLOW_WHEEL_SECS = 30
+_LAST_USED_FILE = '.fck_last_used'
+
+# arguments: comma-separated project package names (excluded), then repo directories.
+# prints the combined install requirements of the repos, and the interpreter version.
+_REQUIREMENTS_SCRIPT = """
+import json, os, re, shutil, subprocess, sys, tempfile
+excluded = set(n.lower() for n in sys.argv[1].split(','))
+reqs = set()
+for repo_dir in sys.argv[2:]:
+    tmp = tempfile.mkdtemp()
+    try:
+        subprocess.check_call([sys.executable, 'setup.py', '-q', 'egg_info', '--egg-base', tmp],
+                              cwd=repo_dir, stdout=open(os.devnull, 'w'))
+        for name in os.listdir(tmp):
+            requires = os.path.join(tmp, name, 'requires.txt')
+            if os.path.exists(requires):
+                for line in open(requires):
+                    line = line.strip()
+                    if line.startswith('['):
+                        break
+                    if line:
+                        reqs.add(line)
+    finally:
+        shutil.rmtree(tmp)
+    requirements = os.path.join(repo_dir, 'requirements.txt')
+    if os.path.exists(requirements):
+        for line in open(requirements):
+            line = line.split('#')[0].strip()
+            if line and not line.startswith('-'):
+                reqs.add(line)
+name = lambda r: re.split(r'[<>=!~;\[ ]', r, 1)[0].lower().replace('_', '-')
+excluded = set(n.replace('_', '-') for n in excluded)
+print(json.dumps(dict(
+    requirements=sorted(r for r in reqs if name(r) not in excluded),
+    python='%d.%d.%d' % sys.version_info[:3])))
+"""
+
+# arguments: repo directories. runs "setup.py sdist" in all of them concurrently, and prints
+# each one's exit code and (the end of) its output.
+_SDIST_SCRIPT = """
+import json, subprocess, sys, tempfile
+procs = []
+for repo_dir in sys.argv[1:]:
+    out = tempfile.TemporaryFile()
+    procs.append((repo_dir, out, subprocess.Popen([sys.executable, 'setup.py', 'sdist', '--formats=gztar'],
+                                                  cwd=repo_dir, stdout=out, stderr=subprocess.STDOUT)))
+results = {}
+for repo_dir, out, p in procs:
+    code = p.wait()
+    out.seek(0)
+    results[repo_dir] = dict(code=code, output=out.read()[-2000:].decode('utf-8', 'replace'))
+print(json.dumps(results))
+"""
+
+# arguments: layers root, maximum size (MB), key of a layer to keep.
+# deletes least-recently used layers until the total size is within the maximum.
+_EVICT_SCRIPT = """
+import json, os, shutil, sys
+root, max_bytes, keep = sys.argv[1], int(sys.argv[2]) * 1024 * 1024, sys.argv[3]
+def size(top):
+    seen, total = set(), 0
+    for dir, dirs, files in os.walk(top):
+        for f in files:
+            st = os.lstat(os.path.join(dir, f))
+            if st.st_ino not in seen:
+                seen.add(st.st_ino)
+                total += st.st_blocks * 512
+    return total
+def last_used(layer):
+    try:
+        return os.path.getmtime(os.path.join(root, layer, '.fck_last_used'))
+    except OSError:
+        return 0
+layers = sorted(os.listdir(root) if os.path.isdir(root) else [], key=last_used)
+sizes = dict((layer, size(os.path.join(root, layer))) for layer in layers)
+total, evicted = sum(sizes.values()), []
+for layer in layers:
+    if total <= max_bytes:
+        break
+    if layer != keep:
+        shutil.rmtree(os.path.join(root, layer), ignore_errors=True)
+        total -= sizes[layer]
+        evicted.append(layer)
+print(json.dumps(dict(evicted=evicted, total=total)))
+"""
+
+# arguments: wheelhouse directory, number of processes, comma-separated extra find-links
+# directories, then requirements. builds missing wheels level by level, concurrently within a
+# level, and prints the resolved requirement names and the build time of each wheel built.
+_WHEEL_SCRIPT = """
+import json, os, re, subprocess, sys, time, zipfile
+from multiprocessing import Pool
+wheel_dir, processes, links, reqs = sys.argv[1], int(sys.argv[2]), sys.argv[3], sys.argv[4:]
+links = [wheel_dir] + [l for l in links.split(',') if l]
+try:
+    from pip._vendor.packaging.markers import Marker
+    from pip._vendor.packaging.requirements import Requirement
+    from pip._vendor.packaging.version import parse as parse_version
+except ImportError:
+    Marker = Requirement = None
+def norm(n):
+    return re.sub(r'[-_.]+', '-', n).lower()
+def name(r):
+    return norm(re.split(r'[<>=!~;\[ (]', r.strip(), 1)[0])
+def key(r):
+    # a requirement's name and version specifier; the same project may be required differently.
+    return (name(r), str(Requirement(r).specifier) if Requirement else r.strip())
+def wheels():
+    # maps each project name to its wheels in the wheelhouse, newest last.
+    have = {}
+    for f in sorted(os.listdir(wheel_dir), key=lambda f: os.path.getmtime(os.path.join(wheel_dir, f))):
+        if f.endswith('.whl'):
+            have.setdefault(norm(f.split('-')[0]), []).append(f)
+    return have
+def match(r, have):
+    # returns the highest-versioned wheel that satisfies the requirement, or None. without
+    # "packaging", versions can't be checked, so the requirement is always given to pip (which
+    # reuses a wheel that satisfies it).
+    if Requirement is None:
+        return None
+    spec = Requirement(r).specifier
+    ok = [f for f in have.get(name(r), []) if spec.contains(f.split('-')[1], prereleases=True)]
+    return max(ok, key=lambda f: parse_version(f.split('-')[1])) if ok else None
+def requires(whl):
+    zf = zipfile.ZipFile(os.path.join(wheel_dir, whl))
+    meta = [n for n in zf.namelist() if n.endswith('.dist-info/METADATA')]
+    deps = []
+    for line in (zf.read(meta[0]).decode('utf-8').splitlines() if meta else []):
+        if not line.strip():
+            break
+        if line.startswith('Requires-Dist:'):
+            dep, _, marker = line.split(':', 1)[1].partition(';')
+            if marker.strip() and (Marker is None or not Marker(marker).evaluate(dict(extra=''))):
+                continue
+            deps.append(dep.strip().replace('(', '').replace(')', ''))
+    return deps
+def build(req):
+    start = time.time()
+    cmd = [sys.executable, '-m', 'pip', 'wheel', '--quiet', '--no-deps', '--wheel-dir', wheel_dir]
+    for l in links:
+        cmd += ['--find-links', l]
+    p = subprocess.Popen(cmd + [req], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = p.communicate()[0]
+    return req, p.returncode, time.time() - start, out[-2000:].decode('utf-8', 'replace')
+pool = Pool(max(1, processes))
+seen, built, failed, level = set(), {}, {}, reqs
+while level:
+    todo = []
+    for r in level:
+        if key(r) not in seen:
+            seen.add(key(r))
+            todo.append(r)
+    have = wheels()
+    for req, code, secs, out in pool.map(build, [r for r in todo if not match(r, have)]):
+        built[name(req)] = round(secs, 1)
+        if code:
+            failed[name(req)] = out
+    have = wheels()
+    level = []
+    for r in todo:
+        whl = match(r, have) or (None if Requirement else (have.get(name(r)) or [None])[-1])
+        if whl:
+            level.extend(requires(whl))
+pool.close()
+print(json.dumps(dict(requirements=sorted(set([n for n, spec in seen])), built=built, failed=failed)))
+"""
+
+# arguments: file path, cached version, default document. prints the build info document, or
+# only {"unchanged": true} if its version matches. reads need no lock: writers replace the file
+# with a rename, so a reader sees either the old or the new file.
+_INFO_READ_SCRIPT = """
+import json, sys
+file_name, version, doc = [json.loads(arg) for arg in sys.argv[1:4]]
+try:
+    doc = json.load(open(file_name))
+except IOError:
+    pass
+print(json.dumps(dict(unchanged=True) if doc.get('version', 0) == version else doc))
+"""
+
+# arguments: file path, operations (see BuildInfo.transact()), default document. applies the
+# operations under an exclusive lock, writes the result atomically, and prints it.
+_INFO_TRANSACT_SCRIPT = """
+import errno, fcntl, json, os, sys, tempfile
+file_name, ops, doc = [json.loads(arg) for arg in sys.argv[1:4]]
+lock = open(file_name + '.lock', 'a')
+fcntl.flock(lock, fcntl.LOCK_EX)
+try:
+    doc = json.load(open(file_name))
+except IOError as e:
+    if e.errno != errno.ENOENT:
+        raise
+version = doc.get('version', 0)
+for op, keys, value in ops:
+    if not keys:
+        doc = value
+        continue
+    parent = doc
+    for key in keys[:-1]:
+        parent = parent.setdefault(key, {})
+    key = keys[-1]
+    if op == 'set':
+        parent[key] = value
+    elif op == 'merge':
+        parent.setdefault(key, {}).update(value)
+    elif op == 'incr':
+        parent[key] = parent.get(key, 0) + value
+    elif op == 'delete':
+        parent.pop(key, None)
+    else:
+        raise ValueError('unknown operation: %s' % op)
+doc['version'] = version + 1
+fd, tmp = tempfile.mkstemp(dir=os.path.dirname(file_name), prefix='.build_info')
+f = os.fdopen(fd, 'w')
+json.dump(doc, f, sort_keys=True, indent=4, separators=(',', ': '))
+f.flush()
+os.fsync(f.fileno())
+f.close()
+os.chmod(tmp, 0o644)
+os.rename(tmp, file_name)
+print(json.dumps(doc))
+"""
@@ -6,22 +6,37 @@
 """
 from __future__ import absolute_import
 
+# standard
+import hashlib
+import json
+import pipes
+import posixpath as path
+import re
+from contextlib import contextmanager
+
 # pypi
-from fabric.context_managers import cd, prefix, settings
+from fabric.context_managers import cd, prefix, settings, shell_env
 from fabric.operations import run, sudo
 from fabric.state import env
 
 # package
 from fabcloudkit import ctx
-from ..build import build_repo, BuildInfo
+from ..artifact_store import ArtifactStore
+from ..build import build_repos, resolve_requirements, timing_report, BuildInfo, BuildTimer, DependencyCache, Wheelhouse
 from ..internal import *
-from ..toolbase import Tool
+from ..remote_util import host_facts, run_json
+from ..retention import collect_builds
+from ..toolbase import Tool, SimpleTool
+from ..tool.ccache import CcacheTool
+from ..tool.git import GitTool
 from ..tool.virtualenv import VirtualEnvTool
-from ..util import copy_file_from
+from ..util import copy_file_from, ssh_options, tmp_file_name
 
 
 class PythonBuildTool(Tool):
-    def build(self, repos, reference_repo=None, post_build=None, interpreter=None, tarball=False, unittest=None):
+    def build(self, repos, reference_repo=None, post_build=None, interpreter=None, tarball=False, unittest=None,
+              incremental=False, dependency_cache=None, wheelhouse=False, compiler_cache=None, memoize=False,
+              retain=None, precompile=False, profile_imports=None, scratch=False):
         """Performs a 'python' build.
 
         Performs a python build by running setup.py in each identified repo. If desired, repos can
@@ -48,87 +63,559 @@ class PythonBuildTool(Tool):
 
         :param tarball:
             True to create a tarball of the build; this is required if any other
-            instance will use "copy_from".
+            instance will use "copy_from". if the context has an "artifact_store",
+            the tarball is published to it (see fabcloudkit.artifact_store). may also be a dict with "codec", one of
+            "zstd" (multi-threaded), "pigz" (multi-threaded gzip), "gzip" (the default)
+            or "none" (no compression; for fast networks), and "level", the compression
+            level. the codec is recorded with the build, so "copy_from" can extract it.
 
         :param unittest:
-            TBD
+            True (or a dict of options) to run the repos' tests in the build's virtualenv after
+            it's built, several test files at a time; the build fails (and isn't recorded as the
+            last good build) if any test file fails. options may include "dirs" (test directories
+            in each repo; default "tests"), "pattern" (default "test*.py"), "runner" ("pytest",
+            "nose" or "unittest"), "processes" (per host; default: CPU count), "shard_role" and
+            "shards" (to also run shards of the tests on other instances in a role, balanced by
+            the durations recorded for the last good build), and "ignore_fail". see
+            fabcloudkit.testing.
+
+        :param incremental:
+            True to start from a clone of the last good build's virtualenv (if it still exists
+            and used the same interpreter), and reinstall only the repos whose head commit
+            differs from the commit recorded for that build.
+
+        :param dependency_cache:
+            True (or a dict of options) to start from a cached virtualenv that already contains
+            the repos' third-party dependencies (see DependencyCache). options may include
+            "max_size_mb", the disk space allowed for cached dependency layers (default: 2048).
+            not used if an incremental build was possible.
+
+        :param wheelhouse:
+            True to install third-party dependencies from the context's wheelhouse (see Wheelhouse),
+            building wheels only for dependencies that aren't already there. the repos' full set of
+            requirements is resolved first; missing wheels are built concurrently (one process per
+            CPU), and everything is installed in one pass before the repos themselves.
+
+        :param compiler_cache:
+            True (or a dict of options) to compile C extensions through ccache, with one compile
+            job per CPU (see CcacheTool). options may include "dir", "max_size" and "jobs". the
+            cache hit rate is reported and recorded with the build.
+
+        :param memoize:
+            True to reuse an earlier build with the same inputs instead of building: the head
+            commit of each repo, the interpreter, the third-party requirements, and the options
+            that affect the result (repos, post_build, tarball, unittest, precompile). the earlier build is
+            found by its input key in the build info file or, failing that, in the artifact
+            store, and becomes the last good build again (in the store, too). default: False.
+
+        :param retain:
+            optional; the number of good builds to keep on the instance. when given, older builds
+            (other than active ones), their tarballs and conf files are removed after the build
+            (see fabcloudkit.retention).
+
+        :param precompile:
+            True (or a dict with "processes") to compile every python file in the virtualenv to
+            bytecode, in parallel and with the virtualenv's interpreter, so that the first start
+            of each worker doesn't have to. the counts are recorded with the build.
+
+        :param profile_imports:
+            a "module:variable" to import under an import-time profiler after the build; True
+            to use the gunicorn "app_module" from this role's "activate" section. the total
+            import time and the slowest imports are reported and recorded with the build. may
+            also be a dict with "app_module" and "top" (the number of imports to keep).
+
+        :param scratch:
+            True (or a dict of options) to build in RAM (tmpfs), or on a faster local disk, instead
+            of on the builds volume. the scratch space is mounted at the build's final path, so
+            the paths in the virtualenv stay valid, and TMPDIR points into it (for sdist and pip
+            temporary files); the finished virtualenv is copied to the builds volume at the end
+            ("persist" phase). options may include "dir" (e.g., an instance-store mount, instead
+            of tmpfs) and, for tmpfs, "size_mb" or "fraction" (of host memory; default 0.5). not
+            used with "incremental" or "dependency_cache", whose clones are hard links.
+
+        Each phase of the build (prepare, virtualenv, requirements, sdist, pip_install, precompile,
+        import_profile, unittest, tarball, persist, publish, post_build) is timed, and the timings are
+        recorded with the build (see BuildTimer and timing_report()).
 
         :return:
             the new build name
         """
         start_msg('Executing build for instance in role "{0}":'.format(env.role_name))
-
-        # increment the build name and create a new virtualenv for the build.
-        build_name = self._increment_name(reference_repo)
-        build_env_dir = ctx().build_path(build_name)
-        VirtualEnvTool().ensure(build_env_dir, interpreter)
-
-        # run "setup.py install" in each repo.
-        for repo_name in ([repos] if isinstance(repos, basestring) else repos):
-            build_repo(build_env_dir, ctx().get_repo(repo_name))
-
-        # run tests.
-        self._unittest(unittest, build_name)
-
-        # save the last known good build-name.
-        BuildInfo.set_last_good(build_name)
-        if tarball:
-            self._tarball(build_name)
-
-        # execute any post-build commands.
+        timer = BuildTimer().begin()
+
+        with timer.phase('prepare'):
+            # get the commit being built in each repo, and reuse an earlier build of the same inputs.
+            repo_list = [ctx().get_repo(name) for name in ([repos] if isinstance(repos, basestring) else repos)]
+            commits = GitTool().head_commits([repo.dir for repo in repo_list])
+            plan = dict(repos=repos, post_build=post_build, tarball=tarball, unittest=unittest, precompile=precompile)
+            input_key = self._input_key(repo_list, commits, interpreter, plan) if memoize else None
+            memo_name = self._reuse(input_key, tarball) if input_key else None
+            if memo_name:
+                succeed_msg('Reused build "{0}" for role "{1}".'.format(memo_name, env.role_name))
+                env.role.set_env(build_result=memo_name)
+                return self
+
+            # increment the build name.
+            build_name = self._increment_name(reference_repo)
+            build_env_dir = ctx().build_path(build_name)
+            tested_repos = list(repo_list)
+
+        # run the build on scratch space, if requested; it's copied to the builds volume at the end.
+        scratch_options = scratch if not (incremental or dependency_cache) else None
+        if scratch and not scratch_options:
+            yellow_msg('Virtualenv clones are hard-linked on the builds volume; not using scratch space.')
+        with self._scratch(build_env_dir, scratch_options, timer) as scratch_info:
+            # compile C extensions through the compiler cache, if enabled.
+            ccache = CcacheTool() if compiler_cache else None
+            ccache_options = compiler_cache if isinstance(compiler_cache, dict) else {}
+            compile_env = ccache.prepare(**ccache_options) if ccache else {}
+
+            with shell_env(**compile_env):
+                # create the build's virtualenv: a clone of the last good build, a clone of a cached
+                # dependency layer, or new.
+                with timer.phase('virtualenv'):
+                    wheels = Wheelhouse() if wheelhouse else None
+                    base_commits = self._clone_last_good(build_env_dir, interpreter) if incremental else None
+                    layer = None
+                    if base_commits is None and dependency_cache:
+                        cache_options = dependency_cache if isinstance(dependency_cache, dict) else {}
+                        cache = DependencyCache(wheelhouse=wheels, **cache_options)
+                        layer = cache.checkout(build_env_dir, repo_list, interpreter)
+                    if base_commits is None and layer is None:
+                        VirtualEnvTool().ensure(build_env_dir, interpreter)
+                    elif base_commits is not None:
+                        repo_list = [repo for repo in repo_list
+                                     if base_commits.get(repo.dir, None) != commits[repo.dir]]
+                        message('Repos changed since last good build: {0}'.format([repo.dir for repo in repo_list]))
+
+                # install third-party dependencies from the wheelhouse, all at once.
+                wheel_times = {}
+                if wheels:
+                    with timer.phase('requirements'):
+                        wheel_times = self._install_requirements(build_env_dir, repo_list, interpreter, wheels)
+
+                # build and install the repos.
+                build_repos(build_env_dir, repo_list, reinstall=base_commits is not None, wheelhouse=wheels,
+                            timer=timer)
+
+            # compile the virtualenv to bytecode, and profile the app's imports.
+            bytecode = import_profile = None
+            if precompile:
+                options = precompile if isinstance(precompile, dict) else {}
+                with timer.phase('precompile'):
+                    bytecode = self._precompile(build_env_dir, **options)
+            if profile_imports:
+                options = profile_imports if isinstance(profile_imports, dict) else {}
+                app_module = options.get('app_module', None) if options else profile_imports
+                with timer.phase('import_profile'):
+                    import_profile = self._profile_imports(build_env_dir, app_module, options.get('top', 20))
+
+            cache_stats = ccache.stats(ccache_options.get('dir', None)) if ccache else None
+
+            # run tests; a failure ends the build here.
+            test_results = None
+            if unittest:
+                with timer.phase('unittest'):
+                    test_results = self._unittest(unittest, build_name, tested_repos)
+
+            # create the tarball, then save the last known good build-name, along with what was built.
+            artifact = None
+            if tarball:
+                options = tarball if isinstance(tarball, dict) else {}
+                with timer.phase('tarball'):
+                    artifact = self._tarball(build_name, **options)
+
+        meta = dict(commits=commits, interpreter=interpreter, dependency_layer=layer, input_key=input_key,
+                    wheel_build_times=wheel_times, compiler_cache=cache_stats, artifact=artifact,
+                    unittest=test_results, bytecode=bytecode, import_profile=import_profile, scratch=scratch_info)
+
+        # publish the tarball, if the context has an artifact store.
+        store = ArtifactStore.create() if artifact else None
+        if store:
+            with timer.phase('publish'):
+                stored = store.put(build_name, ctx().build_path(artifact['file']), meta=meta)
+                artifact.update(sha256=stored['sha256'], size=stored['size'])
+                if input_key:
+                    store.set_memo(input_key, build_name)
+        BuildInfo.set_last_good(build_name, timing=timer.phases, **meta)
+
+        # execute any post-build commands, then record the complete timings.
         if post_build:
-            self._execute_post_build(post_build, build_name)
+            with timer.phase('post_build'):
+                self._execute_post_build(post_build, build_name)
+        BuildInfo.set_last_good(build_name, timing=timer.finish())
+        self._retain(retain)
 
         # make the build_name available to the caller; it'll be set as an instance-tag.
         succeed_msg('Build completed successfully for role "{0}".'.format(env.role_name))
         env.role.set_env(build_result=build_name)
         return self
 
-    def copy_from(self, role_name, post_build=None, delete_tar=True):
+    def copy_from(self, role_name, post_build=None, delete_tar=True, stream=False, archive=False, delta=False,
+                  use_store=True, connections=4, retain=None):
         """Copies an existing build from an instance in the specified role.
 
         Instead of building itself, a build is copied from another instance to the current
-        instance.
+        instance. if the context has an "artifact_store", and neither "stream" nor "delta" is
+        used, the store's last good build is downloaded from the store instead; the instance
+        in the role isn't contacted at all.
 
         :param role_name: the role of the instance to copy the build tarball from.
         :param post_build: list of post-build commands to execute.
         :param delete_tar: True to delete the tarball, False otherwise.
+        :param stream: True (or a dict with "codec" and "level"; see build()) to stream the build
+                       directory from the source instance straight into "tar -x", rather than
+                       copying its tarball. the source doesn't need a tarball, and the stream's
+                       checksum is verified on both ends before the build is used.
+        :param archive: when streaming, True to also keep a tarball of the stream on this instance.
+        :param delta: True to transfer only the differences from a build that's already on this
+                      instance (the active build, or else the last good build), with rsync. the
+                      new build directory starts as hard links to the unchanged files of that
+                      build. falls back to a full copy (streamed, if "stream" is set) when there's
+                      no such build.
+        :param use_store: False to copy from the instance even if the context has an artifact store.
+        :param connections: the number of concurrent ranged downloads from the artifact store.
+        :param retain: optional; the number of good builds to keep on this instance (see build()).
         :return: the name of the copied build.
         """
+        store = ArtifactStore.create() if use_store and not (stream or delta) else None
+        if store:
+            build_name = self._copy_from_store(store, post_build, delete_tar, connections)
+            self._retain(retain)
+            return build_name
+
         # get the last known good build from the source machine.
         # note: we could alternatively get this from an instance tag.
         message('Copying build from instance in role: "{0}"'.format(role_name))
         inst, role = ctx().get_host_in_role(role_name)
         with settings(host_string=inst.public_dns_name, user=role.user):
             message('Getting last good build-name from: "{0}"'.format(role_name))
-            src_build_name = BuildInfo().get_last_good()
+            info = BuildInfo().load()
+            src_build_name = info.last
+            src_meta = info.build(src_build_name) or {}
+
+        transfer = self._delta_from(inst, role, src_build_name) if delta else None
+        if transfer:
+            src_meta = dict(src_meta, transfer=transfer)
+        elif stream:
+            options = stream if isinstance(stream, dict) else {}
+            transfer = self._stream_from(inst, role, src_build_name, archive=archive, **options)
+            src_meta = dict(src_meta, transfer=transfer)
+        else:
+            self._copy_tarball_from(inst, role, src_build_name, src_meta, delete_tar)
+
+        # update the build information.
+        BuildInfo().set_last_good(src_build_name, **src_meta)
+
+        # execute any post-build commands.
+        if post_build:
+            self._execute_post_build(post_build, src_build_name)
+        self._retain(retain)
+
+        succeed_msg('Successfully copied build: "{0}"'.format(src_build_name))
+        return src_build_name
+
+    def _copy_tarball_from(self, inst, role, build_name, meta, delete_tar):
+        # builds from earlier versions don't record their artifact; they're always gzip tarballs.
+        artifact = meta.get('artifact', None) or dict(file=self._tarball_name(build_name), codec='gzip')
+        codec = _codec(artifact['codec'])
+        if codec['tool']:
+            SimpleTool.create(codec['tool']).verify()
 
         # copy it from the source machine. note that all machines must have been provisioned
         # properly to allow the current machine access to the source machine.
-        tarball = self._tarball_name(src_build_name)
+        tarball = artifact['file']
         path = ctx().build_path(tarball)
         copy_file_from(role.user, inst.private_dns_name, path, path)
+        return self._extract(tarball, codec, delete_tar)
+
+    def _copy_from_store(self, store, post_build, delete_tar, connections, build_name=None):
+        build_name = build_name or store.last_good()
+        if not build_name:
+            raise HaltError('The artifact store has no last good build.')
+
+        message('Copying build "{0}" from artifact store.'.format(build_name))
+        meta = store.get(build_name, ctx().builds_root(), connections=connections)
+        artifact = meta.get('artifact', None) or dict(file=meta['file'], codec='gzip')
+        codec = _codec(artifact['codec'])
+        if codec['tool']:
+            SimpleTool.create(codec['tool']).verify()
+        self._extract(meta['file'], codec, delete_tar)
 
+        # update the build information.
+        transfer = dict(mode='store', sha256=meta['sha256'])
+        meta = dict([(k, v) for k, v in meta.iteritems() if k not in ('file', 'size', 'sha256')], transfer=transfer)
+        BuildInfo().set_last_good(build_name, **meta)
+
+        # execute any post-build commands.
+        if post_build:
+            self._execute_post_build(post_build, build_name)
+
+        succeed_msg('Successfully copied build: "{0}"'.format(build_name))
+        return build_name
+
+    def _extract(self, tarball, codec, delete_tar):
         with cd(ctx().builds_root()):
             # untar it.
-            command = 'tar -x --file={tarball}'.format(**locals())
+            command = 'set -o pipefail; {0} {1} | tar -x'.format(codec['decompress'], tarball)
             result = run(command)
             if result.failed:
-                raise HaltError('Failed to untar: "{0}"'.format(path))
+                raise HaltError('Failed to untar: "{0}"'.format(ctx().build_path(tarball)))
 
             # delete the tar.
             if delete_tar:
                 run('rm {tarball}'.format(**locals()))
+        return self
 
-        # update the build information.
-        BuildInfo().set_last_good(src_build_name)
+    def _delta_from(self, inst, role, build_name):
+        # copies the build with rsync, using a build already on this instance as the basis: files
+        # with the same content (by checksum) are hard-linked from the basis, and changed files are
+        # sent as differences against the basis file. the copy is made in a temporary directory and
+        # renamed into place when complete; a build that's already here is never replaced or removed.
+        # returns the transfer description that's recorded with the build, or None if there's no basis.
+        dest = ctx().build_path(build_name)
+        if run('test -e {0}'.format(dest), quiet=True).succeeded:
+            message('Build "{0}" is already on this instance; not copying it.'.format(build_name))
+            return dict(mode='existing')
+
+        info = BuildInfo().load()
+        basis = None
+        for name in info.active_builds() + [info.last]:
+            if name and name != build_name and run('test -d {0}'.format(ctx().build_path(name)), quiet=True).succeeded:
+                basis = name
+                break
+        if basis is None:
+            message('No previous build on this instance; doing a full copy.')
+            return None
 
-        # execute any post-build commands.
-        if post_build:
-            self._execute_post_build(post_build, src_build_name)
+        with settings(host_string=inst.public_dns_name, user=role.user):
+            SimpleTool.create('rsync').verify()
+        SimpleTool.create('rsync').verify()
+
+        start_msg('----- Copying build "{0}" as a delta from "{1}":'.format(build_name, basis))
+        tmp = run('mktemp -d {0}/.fck_delta_XXXXXXXX'.format(ctx().builds_root()), quiet=True)
+        if tmp.failed:
+            raise HaltError('Unable to create a temporary directory in "{0}".'.format(ctx().builds_root()))
+        tmp = tmp.strip()
+
+        src = '{0}@{1}:{2}/'.format(role.user, inst.private_dns_name, ctx().build_path(build_name))
+        dst = '{0}/'.format(path.join(tmp, build_name))
+        command = ('rsync --archive --delete --checksum --stats --link-dest={0} -e "ssh {1}" {2} {3}'
+                   .format(ctx().build_path(basis), ssh_options(), src, dst))
+        result = run(command)
+        if result.failed:
+            run('rm -rf {0}'.format(tmp), quiet=True)
+            raise HaltError('rsync of build "{0}" failed.'.format(build_name))
+
+        # "mv -T" fails, rather than moving into it, if the build appeared meanwhile.
+        moved = run('mv -T {0} {1}'.format(path.join(tmp, build_name), dest), quiet=True)
+        run('rm -rf {0}'.format(tmp), quiet=True)
+        if moved.failed:
+            yellow_msg('Build "{0}" appeared during the copy; kept that copy.'.format(build_name))
+            return dict(mode='existing')
+
+        stats = _parse_rsync_stats(result)
+        stats.update(mode='delta', basis=basis)
+        succeed_msg('Copied build "{0}": {1} of {2} bytes transferred ({3}%).'.format(
+            build_name, stats['transferred'], stats['total'], stats['ratio']))
+        return stats
+
+    def _stream_from(self, inst, role, build_name, codec='gzip', level=None, archive=False, rate_limit=None,
+                     dest_root=None):
+        # streams the build directory: tar and compress on the source, over ssh, then decompress
+        # and untar here. both ends hash the compressed stream as it passes (see _HASH_PIPE_SCRIPT).
+        # the build is extracted into a temporary directory in dest_root (default: the builds root),
+        # and moved into place only when the digests match; a build that's already there is never
+        # replaced or removed. rate_limit caps the stream at that many bytes per second, with "pv"
+        # on the source. returns the transfer description that's recorded with the build.
+        spec = _codec(codec, level)
+        dest_root = dest_root or ctx().builds_root()
+        dest = path.join(dest_root, build_name)
+        if run('test -e {0}'.format(dest), quiet=True).succeeded:
+            message('Build "{0}" is already in "{1}"; not streaming it.'.format(build_name, dest_root))
+            return dict(mode='existing')
+
+        throttle = '| pv -q -L {0} '.format(int(rate_limit)) if rate_limit else ''
+        with settings(host_string=inst.public_dns_name, user=role.user):
+            if spec['tool']:
+                SimpleTool.create(spec['tool']).verify()
+            if throttle:
+                SimpleTool.create('pv').verify()
+        if spec['tool']:
+            SimpleTool.create(spec['tool']).verify()
+
+        start_msg('----- Streaming build "{0}" from "{1}" ({2}):'.format(build_name, inst.private_dns_name, codec))
+        tmp = run('mkdir -p {0} && mktemp -d {0}/.fck_stream_XXXXXXXX'.format(dest_root), quiet=True)
+        if tmp.failed:
+            raise HaltError('Unable to create a temporary directory in "{0}".'.format(dest_root))
+        tmp = tmp.strip()
+
+        src_sum, dst_sum = tmp_file_name(ext='.sha256'), tmp_file_name(ext='.sha256')
+        send = ('cd {0} && set -o pipefail && tar --create --format=ustar --owner=0 --group=0 {1} | {2} {3}| {4}'
+                .format(ctx().builds_root(), build_name, spec['compress'], throttle, _hash_pipe()))
+        keep = '| tee {0} '.format(path.join(dest_root, self._tarball_name(build_name, codec))) if archive else ''
+        command = ("set -o pipefail; ssh {opts} {user}@{host} {send} 2>{src_sum} | {hash_pipe} "
+                   "{keep}| {decompress} | tar -x -C {tmp}").format(
+            opts=ssh_options(), user=role.user, host=inst.private_dns_name, send=pipes.quote(send),
+            hash_pipe=_hash_pipe(dst_sum), decompress=spec['decompress'], **locals())
+        result = run(command)
+
+        # the source's digest is the last line of its stderr.
+        src_digest = run('tail -n 1 {0}'.format(src_sum), quiet=True).strip()
+        dst_digest = run('cat {0}'.format(dst_sum), quiet=True).strip()
+        run('rm -f {0} {1}'.format(src_sum, dst_sum), quiet=True)
+        if result.failed or not dst_digest or src_digest != dst_digest:
+            run('rm -rf {0}'.format(tmp), quiet=True)
+            raise HaltError('Streaming build "{0}" failed; checksums: sent "{1}", received "{2}".'
+                            .format(build_name, src_digest, dst_digest))
+
+        # "mv -T" fails, rather than moving into it, if the build appeared meanwhile.
+        result = run('mv -T {0} {1}'.format(path.join(tmp, build_name), dest), quiet=True)
+        run('rm -rf {0}'.format(tmp), quiet=True)
+        if result.failed:
+            yellow_msg('Build "{0}" appeared in "{1}" during the transfer; kept that copy.'.format(
+                build_name, dest_root))
+            return dict(mode='existing')
 
-        succeed_msg('Successfully copied build: "{0}"'.format(src_build_name))
-        return src_build_name
+        succeed_msg('Streamed build "{0}"; sha256 verified: {1}'.format(build_name, dst_digest))
+        return dict(mode='stream', codec=codec, sha256=dst_digest)
+
+    def compare_codecs(self, build_name=None, codecs=None, bandwidth_mbps=1000):
+        """Compares tarball codecs by packing and unpacking a build with each one.
+
+        Reports, for each codec, the pack time, tarball size, the transfer time estimated
+        from the network bandwidth, the unpack time, and the total. Codecs whose program
+        isn't installed are skipped.
+
+        :param build_name: optional; the build to pack. default: the last good build.
+        :param codecs: optional; a list of codec names, or a dict mapping codec names to levels.
+                       default: all codecs, at their default levels.
+        :param bandwidth_mbps: optional; the network bandwidth, in megabits per second.
+        :return: a dict mapping each codec to its results.
+        """
+        build_name = build_name or BuildInfo.get_last_good()
+        if not build_name:
+            raise HaltError('There is no build to compare codecs with.')
+        if not isinstance(codecs, dict):
+            codecs = dict([(name, None) for name in (codecs or sorted(_CODECS))])
+        specs = dict([(name, _codec(name, level)) for name, level in codecs.iteritems()])
+
+        start_msg('----- Comparing tarball codecs for build "{0}":'.format(build_name))
+        results = run_json(_COMPARE_SCRIPT, "{0} {1} '{2}'".format(
+            ctx().builds_root(), build_name, json.dumps(specs)))
+        if results is None:
+            raise HaltError('Failed to compare codecs.')
+
+        bytes_per_sec = bandwidth_mbps * 1000 * 1000 / 8.0
+        for name, r in results.iteritems():
+            if 'size' in r:
+                r['transfer'] = round(r['size'] / bytes_per_sec, 2)
+                r['total'] = round(r['pack'] + r['transfer'] + r['unpack'], 2)
+
+        message('{0:<6} {1:>8} {2:>10} {3:>9} {4:>8} {5:>8}'.format(
+            'codec', 'pack(s)', 'size(MB)', 'xfer(s)', 'unpack(s)', 'total(s)'))
+        for name in sorted(results, key=lambda n: results[n].get('total', float('inf'))):
+            r = results[name]
+            if 'error' in r:
+                yellow_msg('{0:<6} {1}'.format(name, r['error']))
+            else:
+                message('{0:<6} {1:>8.2f} {2:>10.1f} {3:>9.2f} {4:>8.2f} {5:>8.2f}'.format(
+                    name, r['pack'], r['size'] / 1048576.0, r['transfer'], r['unpack'], r['total']))
+        return results
+
+    def timing_report(self, builds=10, threshold=25.0, **kwargs):
+        """Reports the phase timings of the last good builds on this instance, and flags phases
+        of the latest build that took more than "threshold" percent longer than usual.
+
+        :param builds: the number of builds to report.
+        :param threshold: the regression threshold, in percent.
+        :return: a dict mapping each regressed phase to its latest and median times.
+        """
+        return timing_report(count=builds, threshold=threshold, **kwargs)
+
+    def copy_wheelhouse_from(self, role_name):
+        """Copies the wheelhouse from an instance in the specified role.
+
+        Wheels already in this instance's wheelhouse are kept. Use this to seed a new builder,
+        or any instance that should be able to install the context's dependencies offline.
+
+        :param role_name: the role of the instance to copy the wheelhouse from.
+        :return: self
+        """
+        Wheelhouse().copy_from(role_name)
+        return self
+
+    def _install_requirements(self, build_env_dir, repo_list, interpreter, wheels):
+        # returns the build time of each wheel that had to be built.
+        info = resolve_requirements(repo_list, interpreter)
+        if info is None:
+            # build_repos() will still install them, with the repos.
+            return {}
+        with prefix(VirtualEnvTool.activate_prefix(build_env_dir)):
+            return wheels.install(info['requirements'])
+
+    def _input_key(self, repo_list, commits, interpreter, plan):
+        # returns a hash of everything that determines the build's result, or None.
+        info = resolve_requirements(repo_list, interpreter)
+        if info is None:
+            message('Unable to determine build inputs; not reusing builds.')
+            return None
+
+        inputs = dict(commits=commits, interpreter=interpreter, python=info['python'],
+                      requirements=info['requirements'], plan=plan)
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+    def _reuse(self, input_key, tarball):
+        # returns the name of an earlier build with the same inputs, made available on this
+        # instance (from the artifact store, if necessary), with its tarball if the plan makes
+        # one; or None. the reused build becomes the last good build here and in the store.
+        info = BuildInfo().load()
+        store = ArtifactStore.create()
+        name = info.memo.get(input_key, None)
+        if name and self._has_build(name, info.build(name) or {}, tarball):
+            message('Build inputs unchanged since build "{0}".'.format(name))
+            BuildInfo.set_last_good(name)
+            if store:
+                store.set_last_good(name)
+            return name
+
+        name = store.memo(input_key) if store else None
+        if name and store.exists(name):
+            message('Build inputs match build "{0}" in the artifact store.'.format(name))
+            self._copy_from_store(store, None, not tarball, 4, build_name=name)
+            store.set_last_good(name)
+            return name
+
+        message('No earlier build with the same inputs ("{0}").'.format(input_key))
+        return None
+
+    def _has_build(self, build_name, meta, tarball):
+        # True if the build's virtualenv (and, when wanted, its tarball) is on this instance.
+        files = [path.join(ctx().build_path(build_name), 'bin/activate')]
+        if tarball:
+            artifact = meta.get('artifact', None) or dict(file=self._tarball_name(build_name))
+            files.append(ctx().build_path(artifact['file']))
+        return run(' && '.join(['test -f {0}'.format(f) for f in files]), quiet=True).succeeded
+
+    def _clone_last_good(self, build_env_dir, interpreter):
+        # clones the last good build's virtualenv to build_env_dir, and returns the commits that
+        # were built into it. returns None if there's no usable last good build.
+        info = BuildInfo().load()
+        last = info.build(info.last)
+        if not last or 'commits' not in last:
+            message('No information for last good build; doing a full build.')
+            return None
+        if last.get('interpreter', None) != interpreter:
+            message('Interpreter changed since last good build; doing a full build.')
+            return None
+
+        last_env_dir = ctx().build_path(info.last)
+        if run('test -f {0}'.format(path.join(last_env_dir, 'bin/activate')), quiet=True).failed:
+            message('Last good build "{0}" no longer exists; doing a full build.'.format(info.last))
+            return None
+
+        VirtualEnvTool().clone(last_env_dir, build_env_dir)
+        return last['commits']
 
     def _execute_post_build(self, cmd_lst, build_name):
         message('Running post-build commands:')
@@ -141,6 +628,12 @@ class PythonBuildTool(Tool):
         message('Completed post-build commands.')
         return self
 
+    def _retain(self, keep):
+        # removes old builds from this instance, keeping the given number of good builds.
+        if keep:
+            collect_builds(keep=keep)
+        return self
+
     def _increment_name(self, ref_repo_name):
         # some projects have more than one repo. in this case one is designated as the "reference".
         # the reference repo gives it's most recent commit ID that's used in the new build name.
@@ -154,27 +647,298 @@ class PythonBuildTool(Tool):
         succeed_msg('Created new build name: "{0}"'.format(name))
         return name
 
-    def _tarball(self, build_name):
-        tarball = self._tarball_name(build_name)
+    def _tarball(self, build_name, codec='gzip', level=None):
+        # returns the artifact description that's recorded with the build.
+        spec = _codec(codec, level)
+        if spec['tool']:
+            SimpleTool.create(spec['tool']).verify()
+        tarball = self._tarball_name(build_name, codec)
         dir_to_tar = ctx().build_path(build_name)
 
         with cd(ctx().builds_root()):
-            options = '--create --gzip --format=ustar --owner=0 --group=0'
-            command = 'tar {options} --file={tarball} {build_name}'.format(**locals())
+            options = '--create --format=ustar --owner=0 --group=0'
+            compress = spec['compress']
+            command = 'set -o pipefail; tar {options} {build_name} | {compress} > {tarball}'.format(**locals())
             result = run(command)
 
         if result.failed:
             raise HaltError('Failed to create tarball for: "{0}"'.format(dir_to_tar))
         succeed_msg('Created build tarball: "{0}"'.format(tarball))
-        return self
-
-    def _tarball_name(self, build_name):
-        return '{build_name}.tar.gz'.format(**locals())
-
-    def _unittest(self, plan, build_name):
-        failed_msg('The action "unittest" is not implemented (yet).')
-        return self
+        return dict(file=tarball, codec=codec, level=spec['level'])
+
+    def _tarball_name(self, build_name, codec='gzip'):
+        return '{0}{1}'.format(build_name, _codec(codec)['ext'])
+
+    @contextmanager
+    def _scratch(self, build_env_dir, options, timer):
+        # mounts scratch space (a directory on tmpfs, or in options["dir"]) at the build directory,
+        # and copies the build to the builds volume on success. yields the scratch description
+        # recorded with the build, or None if not used.
+        if not options:
+            yield None
+            return
+
+        options = options if isinstance(options, dict) else {}
+        build_name = path.basename(build_env_dir)
+        if options.get('dir', None):
+            info = dict(mode='dir', dir=options['dir'])
+            scratch_root = path.join(options['dir'], 'fck_scratch_{0}'.format(build_name))
+            mount = ''
+        else:
+            size_mb = options.get('size_mb', None) or \
+                int(host_facts()['mem_total'] * options.get('fraction', 0.5) / (1024 * 1024))
+            if size_mb < _MIN_SCRATCH_MB:
+                yellow_msg('Not enough memory for scratch space ({0} MB); building on disk.'.format(size_mb))
+                yield None
+                return
+            info = dict(mode='tmpfs', size_mb=size_mb)
+            scratch_root = '/mnt/fck_scratch_{0}'.format(build_name)
+            mount = 'mount -t tmpfs -o size={0}m,mode=0755 fck_scratch {1} && '.format(size_mb, scratch_root)
+
+        start_msg('----- Mounting scratch space ({0}) at "{1}":'.format(info['mode'], build_env_dir))
+        result = sudo('mkdir -p {root} {build_env_dir} && {mount}mkdir -p {root}/build {root}/tmp && '
+                      'chown -R {user} {root} && mount --bind {root}/build {build_env_dir}'.format(
+                          root=scratch_root, user=env.user, **locals()))
+        if result.failed:
+            sudo('umount {0}; rm -rf {0}'.format(scratch_root), quiet=True)
+            raise HaltError('Unable to mount scratch space at "{0}".'.format(build_env_dir))
+
+        unmount = 'umount {0}; rm -rf {0}'.format(scratch_root) if mount else 'rm -rf {0}'.format(scratch_root)
+        persisted = False
+        try:
+            with shell_env(TMPDIR=path.join(scratch_root, 'tmp')):
+                yield info
+
+            # copy the build to the builds volume, and put it in place of the mount.
+            with timer.phase('persist'):
+                persist = build_env_dir + '.persist'
+                result = sudo('rm -rf {persist} && cp -a {build_env_dir} {persist} && umount {build_env_dir} && '
+                              'rmdir {build_env_dir} && mv {persist} {build_env_dir}'.format(**locals()))
+                if result.failed:
+                    raise HaltError('Unable to copy build from scratch space: "{0}"'.format(build_env_dir))
+            persisted = True
+        finally:
+            # the scratch space is released however the build ends; on failure, so is the mount.
+            sudo(unmount if persisted else 'umount {0}; rmdir {0}; {1}'.format(build_env_dir, unmount), quiet=True)
+        succeed_msg('Copied build from scratch space to "{0}".'.format(build_env_dir))
+
+    def _precompile(self, build_env_dir, processes=None):
+        # compiles the virtualenv's python files with its own interpreter; returns the counts.
+        start_msg('----- Compiling virtualenv to bytecode:')
+        with prefix(VirtualEnvTool.activate_prefix(build_env_dir)):
+            result = run_json(_PRECOMPILE_SCRIPT, str(processes or 0))
+        if result is None:
+            raise HaltError('Failed to compile virtualenv: "{0}"'.format(build_env_dir))
+
+        # files that don't compile (e.g., python 3-only modules in a python 2 package) are
+        # never imported by this interpreter; count them, but don't fail.
+        succeed_msg('Compiled {compiled} of {files} file(s) in {secs:.1f}s ({skipped} up to date, '
+                    '{errors} not compilable).'.format(**result))
+        return result
+
+    def _profile_imports(self, build_env_dir, app_module, top=20):
+        # imports the app the way gunicorn does, timing each newly imported module.
+        app_module = app_module if isinstance(app_module, basestring) else self._configured_app_module()
+        if not app_module:
+            yellow_msg('No app_module to profile; skipping import profile.')
+            return None
+
+        start_msg('----- Profiling imports of "{0}":'.format(app_module))
+        with cd(ctx().builds_root()), prefix(VirtualEnvTool.activate_prefix(build_env_dir)):
+            result = run_json(_IMPORT_PROFILE_SCRIPT, '{0} {1}'.format(app_module.split(':')[0], top))
+        if result is None:
+            raise HaltError('Failed to import "{0}" in the build.'.format(app_module))
+
+        message('{0:<48} {1:>9} {2:>9}'.format('module', 'self(ms)', 'cum(ms)'))
+        for name, own, cumulative in result['slowest']:
+            message('{0:<48} {1:>9.1f} {2:>9.1f}'.format(name, own * 1000, cumulative * 1000))
+        succeed_msg('Imported "{0}" in {1:.2f}s ({2} modules).'.format(app_module, result['total'], result['modules']))
+        return result
+
+    def _configured_app_module(self):
+        # the gunicorn "app_module" from this role's "activate" section, if any.
+        for tool_def in env.role.get('activate', None) or []:
+            for options in tool_def.values():
+                gunicorn = options.get('gunicorn', None) if isinstance(options, dict) else None
+                if gunicorn and gunicorn.get('app_module', None):
+                    return gunicorn['app_module']
+        return None
+
+    def _unittest(self, options, build_name, repo_list):
+        # imported on first use; it imports this module.
+        from ..testing import run_tests
+
+        return run_tests(build_name, repo_list, options)
 
 
 # register.
 Tool.__tools__['python_build'] = PythonBuildTool
+
+
+# private.
+# tarball codecs: file extension, default level, compress/decompress commands (filters), and the
+# tool that provides them. zstd and pigz use all CPUs.
+# scratch space smaller than this isn't worth using.
+_MIN_SCRATCH_MB = 512
+
+_CODECS = {
+    'zstd': dict(ext='.tar.zst', level=3, compress='zstd -q -T0 -{level}', decompress='zstd -q -d -c', tool='zstd'),
+    'pigz': dict(ext='.tar.gz', level=6, compress='pigz -{level}', decompress='pigz -d -c', tool='pigz'),
+    'gzip': dict(ext='.tar.gz', level=6, compress='gzip -{level}', decompress='gzip -d -c', tool=None),
+    'none': dict(ext='.tar', level=None, compress='cat', decompress='cat', tool=None)
+}
+
+def _parse_rsync_stats(text):
+    # rsync 3.1+ formats numbers with thousands separators.
+    def number(label):
+        match = re.search(r'^{0}: ([\d,]+)'.format(label), text, re.M)
+        return int(match.group(1).replace(',', '')) if match else 0
+    total = number('Total file size')
+    transferred = number('Total bytes sent') + number('Total bytes received')
+    ratio = round(100.0 * transferred / total, 2) if total else 0.0
+    return dict(total=total, transferred=transferred, ratio=ratio, files=number('Number of regular files transferred'))
+
+def _hash_pipe(out=''):
+    # the hash filter as a "python -c" command, so no script file is shared between transfers.
+    return 'python -c {0} {1}'.format(pipes.quote(_HASH_PIPE_SCRIPT), out).strip()
+
+def _codec(name, level=None):
+    spec = _CODECS.get(name, None)
+    if spec is None:
+        raise HaltError('Unknown tarball codec: "{0}"; use one of: {1}'.format(name, ', '.join(sorted(_CODECS))))
+    spec = dict(spec, level=level if level is not None else spec['level'])
+    spec['compress'] = spec['compress'].format(**spec)
+    return spec
+
+# a filter that copies stdin to stdout, and writes the sha256 digest of the data to the file named
+# by its argument (or to stderr) at the end. run with _hash_pipe().
+_HASH_PIPE_SCRIPT = """
+import hashlib, sys
+h = hashlib.sha256()
+src, dst = getattr(sys.stdin, 'buffer', sys.stdin), getattr(sys.stdout, 'buffer', sys.stdout)
+for block in iter(lambda: src.read(1 << 20), b''):
+    h.update(block)
+    dst.write(block)
+dst.flush()
+out = open(sys.argv[1], 'w') if len(sys.argv) > 1 else sys.stderr
+out.write(h.hexdigest() + '\\n')
+out.close()
+""".lstrip()
+
+# arguments: builds root, build name, JSON dict of codec specs (see _codec()). packs and unpacks
+# the build with each codec, and prints the times and tarball sizes.
+_COMPARE_SCRIPT = """
+import json, os, shutil, subprocess, sys, tempfile, time
+root, name, codecs = sys.argv[1], sys.argv[2], json.loads(sys.argv[3])
+def installed(exe):
+    return any(os.access(os.path.join(d, exe), os.X_OK) for d in os.environ['PATH'].split(os.pathsep))
+def timed(cmd, cwd):
+    start = time.time()
+    code = subprocess.call('set -o pipefail; ' + cmd, shell=True, cwd=cwd, executable='/bin/bash')
+    return code, round(time.time() - start, 2)
+tmp = tempfile.mkdtemp(dir=root)
+results = {}
+try:
+    for codec, spec in sorted(codecs.items()):
+        if not installed(spec['compress'].split()[0]):
+            results[codec] = dict(error='"%s" is not installed' % spec['compress'].split()[0])
+            continue
+        tarball, out = os.path.join(tmp, name + spec['ext']), os.path.join(tmp, 'out')
+        os.mkdir(out)
+        code, pack = timed('tar --create --format=ustar %s | %s > %s' % (name, spec['compress'], tarball), root)
+        if not code:
+            code, unpack = timed('%s %s | tar -x' % (spec['decompress'], tarball), out)
+        if code:
+            results[codec] = dict(error='failed with exit code %d' % code)
+        else:
+            results[codec] = dict(pack=pack, unpack=unpack, size=os.path.getsize(tarball))
+        shutil.rmtree(out)
+        if os.path.exists(tarball):
+            os.remove(tarball)
+finally:
+    shutil.rmtree(tmp)
+print(json.dumps(results))
+"""
+
+# argument: the number of processes (0 for one per CPU). compiles the python files under the
+# running interpreter's prefix (the virtualenv) that don't have an up-to-date bytecode file.
+_PRECOMPILE_SCRIPT = """
+import json, multiprocessing, os, py_compile, sys, time
+def cache_file(f):
+    try:
+        from importlib.util import cache_from_source
+        return cache_from_source(f)
+    except ImportError:
+        return f + ('o' if sys.flags.optimize else 'c')
+def compile_file(f):
+    try:
+        py_compile.compile(f, doraise=True)
+        return True
+    except Exception:
+        return False
+start = time.time()
+files, seen = [], set()
+for top in ('lib', 'lib64'):
+    top = os.path.realpath(os.path.join(sys.prefix, top))
+    if top in seen or not os.path.isdir(top):
+        continue
+    seen.add(top)
+    for dir_path, dirs, names in os.walk(top):
+        files.extend([os.path.join(dir_path, n) for n in names if n.endswith('.py')])
+stale = []
+for f in files:
+    c = cache_file(f)
+    if not (os.path.exists(c) and os.path.getmtime(c) >= os.path.getmtime(f)):
+        stale.append(f)
+pool = multiprocessing.Pool(int(sys.argv[1]) or None)
+results = pool.map(compile_file, stale, chunksize=64)
+pool.close()
+print(json.dumps(dict(files=len(files), compiled=results.count(True), errors=results.count(False),
+                      skipped=len(files) - len(stale), secs=round(time.time() - start, 2))))
+"""
+
+# arguments: module name, number of imports to report. imports the module, timing each import
+# of a module that wasn't already imported; "self" time excludes the imports it made. prints
+# the total time, the number of modules imported, and the slowest [name, self, cumulative].
+_IMPORT_PROFILE_SCRIPT = """
+import json, sys, time
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+real_import, stack, times = builtins.__import__, [], {}
+def full_name(name, args, kwargs):
+    # resolves relative imports against the importing module's package.
+    g = args[0] if args else kwargs.get('globals', None)
+    level = args[3] if len(args) > 3 else kwargs.get('level', 0)
+    if level > 0 and g and g.get('__package__', None):
+        base = g['__package__'].rsplit('.', level - 1)[0]
+        return base + '.' + name if name else base
+    return name
+def timed_import(name, *args, **kwargs):
+    key = full_name(name, args, kwargs)
+    new = key not in sys.modules
+    stack.append(0.0)
+    start = time.time()
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        children = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        if new and key not in times:
+            times[key] = (elapsed - children, elapsed)
+sys.path.insert(0, '')
+before = len(sys.modules)
+builtins.__import__ = timed_import
+start = time.time()
+try:
+    __import__(sys.argv[1])
+finally:
+    builtins.__import__ = real_import
+total = time.time() - start
+slowest = sorted(times.items(), key=lambda item: -item[1][0])[:int(sys.argv[2])]
+print(json.dumps(dict(total=round(total, 3), modules=len(sys.modules) - before,
+                      slowest=[[name, round(own, 4), round(cum, 4)] for name, (own, cum) in slowest])))
+"""
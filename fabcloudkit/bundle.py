@@ -0,0 +1,215 @@
+"""
+    fabcloudkit
+
+    A configuration bundle is the resolved and validated configuration for a run: the
+    fabcloudkit configuration (including tool definitions) and, optionally, a context file
+    along with all of its role files. Compiling a bundle parses and checks these files once;
+    the result is cached on disk and reused until one of the source files changes.
+
+    ~/.fabcloudkit/bundles/<hash>.bundle:
+        The cached, compiled bundle. The location can be changed with the environment variable
+        FABCLOUDKIT_CACHE_DIR. A cached bundle is used if the size and modification time of
+        each source file are unchanged or, failing that, if the file's content hash is unchanged.
+
+    Values tagged "!env" are kept in the cached bundle as references and are resolved from the
+    environment each time the bundle is loaded, so environment values (e.g., AWS secrets) are
+    never written to disk.
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# standard
+import cPickle as pickle
+import hashlib
+import os
+import re
+
+# pypi
+import yaml
+
+# package
+from .dotdict import dotdict
+from .internal import message
+from .yaml_util import BundleLoader, resolve_env
+
+
+__all__ = ['Bundle']
+
+
+class Bundle(object):
+    # bump this when the compiled format changes; older cached bundles are then ignored.
+    VERSION = 1
+
+    @classmethod
+    def load(cls, context_path=None, config_path=None):
+        """Returns the bundle for a context file and configuration file, compiling it if necessary.
+
+        :param context_path: path to the context file; None for a configuration-only bundle.
+        :param config_path: path to the fabcloudkit configuration file; None for the default.
+        :return: the Bundle.
+        """
+        if config_path is None:
+            # the package isn't zip-safe, so the default file is always next to this module.
+            config_path = os.path.join(os.path.dirname(__file__), 'fabcloudkit.yaml')
+        config_path = os.path.abspath(config_path)
+        if context_path:
+            context_path = os.path.abspath(context_path)
+
+        cache_path = _cache_path(context_path, config_path)
+        compiled = _read_cache(cache_path)
+        if compiled is None:
+            compiled = _compile(context_path, config_path)
+            _write_cache(cache_path, compiled)
+        return Bundle(compiled)
+
+    def __init__(self, compiled):
+        self.config_path = compiled['config_path']
+        self.context_path = compiled['context_path']
+        self.config = _wrap(resolve_env(compiled['config']))
+        self.context = _wrap(resolve_env(compiled['context'])) if compiled['context'] is not None else None
+        self.roles = [_wrap(resolve_env(role)) for role in compiled['roles']]
+
+
+# -------------------- private implementation --------------------
+
+_NAME_REGEX = re.compile('^[0-9a-zA-Z_-]+$')
+
+def _cache_dir():
+    default = os.path.join(os.path.expanduser('~'), '.fabcloudkit', 'bundles')
+    return os.environ.get('FABCLOUDKIT_CACHE_DIR', default)
+
+def _cache_path(context_path, config_path):
+    key = hashlib.sha1('{0}\n{1}'.format(context_path, config_path)).hexdigest()
+    return os.path.join(_cache_dir(), '{0}.bundle'.format(key))
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path, 'rb') as f:
+            compiled = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+    if compiled.get('version', None) != Bundle.VERSION:
+        return None
+    for source in compiled['sources']:
+        if not _is_current(source):
+            return None
+    return compiled
+
+def _write_cache(cache_path, compiled):
+    # write to a temporary file and rename, so a concurrent reader never sees a partial file.
+    try:
+        dir = os.path.dirname(cache_path)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        tmp_path = '{0}.{1}.tmp'.format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(compiled, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        # the cache is an optimization; failing to write it isn't an error.
+        pass
+
+def _source(path, data):
+    st = os.stat(path)
+    return dict(path=path, size=st.st_size, mtime=st.st_mtime, sha1=hashlib.sha1(data).hexdigest())
+
+def _is_current(source):
+    try:
+        st = os.stat(source['path'])
+    except OSError:
+        return False
+    if st.st_size == source['size'] and st.st_mtime == source['mtime']:
+        return True
+
+    # the file was touched; it's still current if the content didn't change.
+    with open(source['path'], 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest() == source['sha1']
+
+def _parse(path, sources):
+    with open(path, 'rb') as f:
+        data = f.read()
+    sources.append(_source(path, data))
+    return yaml.load(data, Loader=BundleLoader) or {}
+
+def _compile(context_path, config_path):
+    sources = []
+    config = _parse(config_path, sources)
+    if not config.get('tools', None):
+        raise RuntimeError('No "tools" section in configuration: "{0}"'.format(config_path))
+
+    context, roles = None, []
+    if context_path:
+        context = _parse(context_path, sources)
+        dir = os.path.dirname(context_path)
+        for file_name in context.get('roles', []):
+            roles.append(_parse(os.path.join(dir, file_name), sources))
+        _resolve_repos(context)
+        _validate(context_path, context, roles, config)
+
+    return dict(version=Bundle.VERSION, sources=sources,
+                config_path=config_path, context_path=context_path,
+                config=config, context=context, roles=roles)
+
+def _resolve_repos(context):
+    # fill in the defaults that Context.get_repo() would otherwise compute on every access.
+    for name, repo in (context.get('repos', None) or {}).iteritems():
+        if not repo.get('url', None):
+            raise RuntimeError('Repo "{0}" has no "url".'.format(name))
+        if not repo.get('dir', None):
+            repo['dir'] = repo['url'].rsplit('/', 1)[1].rsplit('.')[0]
+        if not repo.get('package_name', None):
+            repo['package_name'] = repo['dir']
+
+def _validate(context_path, context, roles, config):
+    # unknown tools and roles are only reported (once, when the bundle is compiled); they may
+    # be provided some other way, and would otherwise fail when used, as before.
+    from .toolbase import Tool
+
+    name = context.get('name', None)
+    if not name or not _NAME_REGEX.match(str(name)):
+        raise RuntimeError('Context "{0}" needs a "name" (letters, numbers, underscore, dash).'
+                           .format(context_path))
+
+    role_names = set()
+    for role in roles:
+        role_name = role.get('name', None)
+        if not role_name:
+            raise RuntimeError('A role in context "{0}" has no "name".'.format(name))
+        if role_name in role_names:
+            raise RuntimeError('Role "{0}" is defined more than once.'.format(role_name))
+        role_names.add(role_name)
+
+    for role in roles:
+        allowed = (role.get('allow_access', None) or {}).get('roles', [])
+        for allowed_name in ([allowed] if isinstance(allowed, basestring) else allowed):
+            if allowed_name not in role_names:
+                message('Warning: role "{0}" allows access to unknown role "{1}".'.format(role['name'], allowed_name))
+
+        for section in ('provision', 'build', 'activate'):
+            for tool_name, spec in _tool_defs(role.get(section, None)):
+                names = [tool_name]
+                if tool_name == 'tools':
+                    # the "tools" tool takes a list of (usually simple) tool names.
+                    names = spec.get('options', []) if isinstance(spec, dict) else (spec or [])
+                for n in names:
+                    if not (n in config['tools'] or Tool.exists(n)):
+                        message('Warning: role "{0}" uses unknown tool "{1}" in "{2}".'
+                                .format(role['name'], n, section))
+
+def _tool_defs(spec):
+    # a spec is a list of single-entry dicts: {tool-name: tool-definition}.
+    if not isinstance(spec, list):
+        return
+    for tool_def in spec:
+        if isinstance(tool_def, dict) and len(tool_def) == 1:
+            yield tool_def.keys()[0], tool_def.values()[0]
+
+def _wrap(dct):
+    # wrap nested dicts up front, rather than on each access (see dotdict._fixup()).
+    wrapped = dict()
+    for k,v in dct.iteritems():
+        wrapped[k] = dotdict(_wrap(v)) if isinstance(v, dict) else v
+    return wrapped
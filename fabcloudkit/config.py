@@ -15,6 +15,10 @@ repos_dir:
     Name of the directory under <deploy_root> that contains cloned repositories.
     Default: "repos"
 
+wheelhouse_dir:
+    Name of the directory under <deploy_root> that contains built wheels for a build's dependencies.
+    Default: "wheelhouse"
+
 supervisord_include_conf:
     Specifies the root directory for site-specific conf files. These files contain only a [program]
     definition for a site, and are usually named in a build-specific way.
@@ -25,6 +29,60 @@ nginx_include_conf:
     single "server" definition.
     Default: "/etc/nginx/conf.d"
 
+package_cache_dir:
+    Specifies the directory on a package-cache host that holds cached OS packages.
+    Default: "/var/cache/fabcloudkit/packages"
+
+package_cache_port:
+    Specifies the port on which a package-cache host serves cached OS packages.
+    Default: 8141
+
+package_cache_script:
+    Specifies the location of the package cache program on a package-cache host.
+    Default: "/usr/local/lib/fabcloudkit/package_cache.py"
+
+package_cache_mirrors:
+    Specifies the upstream mirrors (host name patterns, e.g., "*.archive.ubuntu.com") that a
+    package-cache host fetches from; requests for other hosts are refused.
+    Default: the Amazon Linux and Ubuntu mirrors.
+
+artifact_server_dir:
+    Specifies the directory on an artifact-server host that holds stored builds.
+    Default: "/var/lib/fabcloudkit/artifacts"
+
+artifact_server_port:
+    Specifies the port on which an artifact-server host serves stored builds.
+    Default: 8142
+
+artifact_server_script:
+    Specifies the location of the artifact server program on an artifact-server host.
+    Default: "/usr/local/lib/fabcloudkit/artifact_server.py"
+
+ccache_dir:
+    Specifies the directory on build hosts that holds the compiler cache.
+    Default: "/var/cache/fabcloudkit/ccache"
+
+ccache_max_size:
+    Specifies the maximum size of the compiler cache (e.g., "500M", "2G").
+    Default: "2G"
+
+pypi_cache_dir:
+    Specifies the directory on a pypi-cache host that holds cached python packages.
+    Default: "/var/cache/fabcloudkit/pypi"
+
+pypi_cache_port:
+    Specifies the port on which a pypi-cache host serves its package index.
+    Default: 8143
+
+pypi_cache_script:
+    Specifies the location of the pypi cache program on a pypi-cache host.
+    Default: "/usr/local/lib/fabcloudkit/pypi_cache.py"
+
+pypi_cache_upstream:
+    Specifies the package index that the pypi cache fills misses from; empty to serve only
+    cached packages.
+    Default: "https://pypi.python.org/simple/"
+
 tools:
     Contains tool definitions.
 
@@ -35,10 +93,6 @@ from __future__ import absolute_import
 
 # standard
 import os
-from pkg_resources import resource_filename
-
-# pypi
-import yaml
 
 # package
 from .dotdict import dotdict
@@ -47,6 +101,7 @@ from .dotdict import dotdict
 class Config(dotdict):
     _inst = None
     _loaded = False
+    _path = None
 
     @classmethod
     def inst(cls):
@@ -68,13 +123,22 @@ class Config(dotdict):
         super(Config,self).__init__()
         self._inst = self
 
+    @property
+    def path(self):
+        # path of the loaded configuration file, or None if not loaded.
+        return self._path
+
     def load_file(self, path=None):
         if not self._loaded:
-            if path is None:
-                path = resource_filename(__name__, 'fabcloudkit.yaml')
-            with open(path, 'r') as f:
-                self._set_dct(yaml.safe_load(f.read()))
-        self._loaded = True
+            # parsed and cached via a configuration bundle; path=None loads the default file.
+            from .bundle import Bundle
+            self.load_bundle(Bundle.load(config_path=path))
+
+    def load_bundle(self, bundle):
+        # note: attribute assignment would set a configuration value; these are real attributes.
+        self._set_dct(bundle.config)
+        self._real_prop('_path', bundle.config_path)
+        self._real_prop('_loaded', True)
 
     def machine_key_file(self):
         return '~/.ssh/{0}'.format(self.fck_machine_key)
@@ -7,16 +7,14 @@
 from __future__ import absolute_import
 
 # standard
-import os
 import posixpath
 
 # pypi
-import boto.ec2
 from fabric.api import env
-import yaml
 
 # package
 from fabcloudkit import cfg
+from .bundle import Bundle
 from .dotdict import dotdict
 from .role import Role
 
@@ -42,6 +40,8 @@ class Context(dotdict):
         self._instances[inst.public_dns_name] = inst
 
     def aws_sync(self):
+        # boto is slow to import; defer it until needed.
+        import boto.ec2
         conn = boto.ec2.EC2Connection(Context.current().aws_key, Context.current().aws_secret)
         result = conn.get_all_instances()
 
@@ -77,6 +77,9 @@ class Context(dotdict):
     def repo_path(self, file_or_dir_name):
         return posixpath.join(self.repos_root(), file_or_dir_name)
 
+    def wheelhouse_root(self):
+        return posixpath.join(cfg().deploy_root, self.name, cfg().wheelhouse_dir)
+
     def get_key(self, name):
         key = self.get('keys', {}).get(name, None)
         if not key:
@@ -87,15 +90,19 @@ class Context(dotdict):
         return [self.get_key(name) for name in self.get('keys', {}).keys()]
 
     def load(self, file_path):
-        with open(file_path, 'r') as f:
-            # note: calling safe_load() disables the "!env" extension tag.
-            self._set_dct(yaml.load(f))
+        # the context, its roles and the configuration are parsed, validated and cached
+        # together as a bundle. if no configuration was loaded yet, use the bundle's.
+        bundle = Bundle.load(file_path, cfg().path)
+        if cfg().path is None:
+            cfg().load_bundle(bundle)
+        self._set_dct(bundle.context)
 
         # load roles.
-        dir = os.path.dirname(file_path)
         del self._roles[:]
-        for file_name in self.get('roles', []):
-            self._roles.append(Role(os.path.join(dir, file_name)))
+        for dct in bundle.roles:
+            role = Role()
+            role._set_dct(dct)
+            self._roles.append(role)
 
     def get_role(self, name):
         for role in self._roles:
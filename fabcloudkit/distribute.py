@@ -0,0 +1,133 @@
+"""
+    fabcloudkit
+
+    Functions for distributing a build to all instances in a role. Rather than every instance
+    copying the build from the same source (whose network and disk then limit the whole copy),
+    instances that already have the build pass it on to others, in rounds:
+
+        round 1: source -> A, B                           (fanout=2)
+        round 2: source -> C, D; A -> E, F; B -> G, H
+        ...
+
+    The number of instances with the build multiplies by (fanout + 1) each round, so N
+    instances need about log(N) / log(fanout + 1) rounds. Each copy is streamed (see
+    PythonBuildTool.copy_from()), and its checksum verified, before the receiving instance
+    serves the build to others.
+
+    Instances that already have the build (it's in their build info: a good build, the last
+    build, or an active one) are skipped; they neither receive it again nor have it replaced.
+
+    plan_rounds() only computes the schedule; it doesn't touch any hosts, so schedules can be
+    checked locally with any host names (see tests/test_distribute.py).
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# pypi
+from fabric.context_managers import settings
+from fabric.state import env
+
+# package
+from fabcloudkit import ctx
+from .build import BuildInfo
+from .build_tools.python_build import PythonBuildTool
+from .internal import *
+from .util import run_parallel
+
+
+__all__ = ['distribute_build', 'plan_rounds']
+
+
+def plan_rounds(sources, targets, fanout=2):
+    """Plans the rounds for copying a build from the sources to the targets.
+
+    :param sources: list of hosts that have the build.
+    :param targets: list of hosts that need the build.
+    :param fanout: the number of targets each host with the build copies to per round.
+    :return: a list of rounds; each round is a list of (source, target) tuples.
+    """
+    if fanout < 1:
+        raise ValueError('fanout must be at least 1.')
+    if targets and not sources:
+        raise ValueError('There are no sources for the build.')
+
+    holders, pending, rounds = list(sources), list(targets), []
+    while pending:
+        pairs = []
+        for source in holders:
+            for _ in xrange(fanout):
+                if not pending:
+                    break
+                pairs.append((source, pending.pop(0)))
+        holders.extend([target for source, target in pairs])
+        rounds.append(pairs)
+    return rounds
+
+def distribute_build(source_role_name, role_name, fanout=2, rate_limit_mb=None, codec='gzip', level=None,
+                     pool_size=None):
+    """Copies the last good build of an instance in the source role to every instance in a role.
+
+    :param source_role_name: the role of the instance with the build.
+    :param role_name: the role whose instances receive the build.
+    :param fanout: the number of instances each instance with the build copies to per round.
+    :param rate_limit_mb: optional; the maximum upload rate of each source instance, in MB/s. a
+                          source's concurrent copies share it.
+    :param codec: the compression codec for the transfer.
+    :param level: optional; the compression level.
+    :param pool_size: optional; the maximum number of concurrent copies.
+    :return: a tuple of (the build name, the list of instances that received it).
+    """
+    source, source_role = ctx().get_host_in_role(source_role_name)
+    insts, role = ctx().all_hosts_in_role(role_name)
+    with settings(host_string=source.public_dns_name, user=source_role.user):
+        info = BuildInfo().load()
+        build_name = info.last
+        meta = info.build(build_name) or {}
+    if not build_name:
+        raise HaltError('No last good build on instance in role "{0}".'.format(source_role_name))
+
+    # hosts are identified by host string; keep track of the instance and role for each.
+    hosts = dict([(_host_string(inst, role), (inst, role)) for inst in insts])
+    hosts[_host_string(source, source_role)] = (source, source_role)
+
+    # skip the instances that already have the build (including the source, if it's in the role).
+    targets = [_host_string(inst, role) for inst in insts]
+    have = run_parallel(_has_build, targets, build_name, pool_size=pool_size)
+    targets = [host for host in targets if not have[host]]
+    if len(targets) < len(insts):
+        message('{0} instance(s) already have build "{1}".'.format(len(insts) - len(targets), build_name))
+
+    rounds = plan_rounds([_host_string(source, source_role)], targets, fanout)
+    rate_limit = rate_limit_mb * 1024 * 1024 / fanout if rate_limit_mb else None
+
+    start_msg('----- Distributing build "{0}" to {1} instance(s) in {2} round(s):'.format(
+        build_name, len(targets), len(rounds)))
+    for n, pairs in enumerate(rounds):
+        message('Round {0}: {1}'.format(n + 1, ', '.join(['{0} -> {1}'.format(s, t) for s, t in pairs])))
+        assignments = dict([(target, hosts[source]) for source, target in pairs])
+        run_parallel(_receive, assignments.keys(), assignments, build_name, meta, codec, level, rate_limit,
+                     pool_size=pool_size)
+
+    succeed_msg('Distributed build "{0}" to role "{1}".'.format(build_name, role_name))
+    return build_name, [hosts[host][0] for host in targets]
+
+
+# -------------------- private implementation --------------------
+
+def _host_string(inst, role):
+    return '{0}@{1}'.format(role.user, inst.public_dns_name)
+
+def _has_build(build_name):
+    # runs on each instance in the role: True if its build info already lists the build.
+    info = BuildInfo().load()
+    return build_name in info.builds or build_name == info.last or build_name in info.active_builds()
+
+def _receive(assignments, build_name, meta, codec, level, rate_limit):
+    # runs on a receiving host: stream the build from the assigned source, then record it.
+    source, source_role = assignments[env.host_string]
+    transfer = PythonBuildTool()._stream_from(source, source_role, build_name, codec=codec, level=level,
+                                              rate_limit=rate_limit)
+    BuildInfo().set_last_good(build_name, **dict(meta, transfer=transfer))
+    return transfer.get('sha256', None)
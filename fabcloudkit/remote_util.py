@@ -1,9 +1,14 @@
 from __future__ import absolute_import
 
+# standard
+import json
+
 # pypi
 from fabric.context_managers import prefix
+from fabric.operations import run, sudo
 
 # package
+from .host_vars import get_value, set_value
 from .tool.virtualenv import VirtualEnvTool
 from .util import *
 
@@ -51,6 +56,56 @@ EOF
     white_msg('Found CPU count={0}'.format(count), bold=True)
     return count
 
+def host_facts():
+    """
+    Returns facts about the remote host. The facts are retrieved with a single command, and
+    cached for the host.
+
+    :return: a dict containing "cpu_count", "mem_total" (bytes), and "file_max" (the current
+             system-wide limit on open files).
+    """
+    _FACTS_CMD = """
+cat <<-EOF | python -
+import json, multiprocessing as mp
+mem = [l.split() for l in open('/proc/meminfo') if l.startswith('MemTotal:')][0]
+print(json.dumps(dict(
+    cpu_count=mp.cpu_count(),
+    mem_total=int(mem[1]) * 1024,
+    file_max=int(open('/proc/sys/fs/file-max').read()))))
+EOF
+""".lstrip()
+
+    facts = get_value('host_facts')
+    if facts is None:
+        result = run(_FACTS_CMD, quiet=True)
+        if result.failed:
+            raise HaltError('Failed to retrieve host facts.')
+        facts = json.loads(result)
+        set_value('host_facts', facts)
+        white_msg('Found host facts: CPU count={cpu_count}, memory={mem_total}'.format(**facts), bold=True)
+    return facts
+
+def run_json(script, args='', python='python', use_sudo=False):
+    """
+    Runs a python script on the remote host and returns its result. The script must print its
+    result as a JSON document on the last line of its output.
+
+    :param script: the python source code.
+    :param args: optional; command-line arguments for the script (already shell-quoted).
+    :param python: optional; the python interpreter to run the script with.
+    :param use_sudo: optional; True to run the script with sudo.
+    :return: the decoded JSON result, or None if the script failed.
+    """
+    # the quoted heredoc delimiter keeps the shell from expanding anything in the script.
+    cmd = "cat <<'EOF' | " + python + ' - ' + args + '\n' + script.strip() + '\nEOF\n'
+    result = (sudo if use_sudo else run)(cmd, quiet=True)
+    if result.failed:
+        failed_msg('Remote script failed: {0}'.format(result))
+        return None
+
+    lines = result.strip().splitlines()
+    return json.loads(lines[-1]) if lines else None
+
 def site_packages_dir(virtualenv_dir):
     _DIR_CMD = """
 cat <<-EOF | python -
@@ -0,0 +1,152 @@
+"""
+    fabcloudkit
+
+    Functions for removing old builds. Each build leaves a complete virtualenv (and maybe a
+    tarball) under <builds_root>, and nothing else deletes them. Collecting garbage on a host
+    keeps:
+
+        - the last N good builds (recorded in the build info file; see BuildInfo),
+        - the last good build, and every build that is active for any key, and
+        - any build numbered after the newest good build, since it may still be in progress.
+
+    and removes everything else belonging to the context: build directories, tarballs whose
+    build is gone (or was never good), and supervisor and Nginx conf files named for removed
+    builds. Other entries under <builds_root> (e.g., the dependency layers in "_layers") are
+    left alone.
+
+    All of the work on a host is done by one remote command, and collect_role() runs it on
+    every instance in a role concurrently.
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# standard
+import json
+
+# package
+from fabcloudkit import cfg, ctx
+from .build import BuildInfo
+from .internal import *
+from .remote_util import run_json
+from .util import run_parallel
+
+
+__all__ = ['collect_builds', 'collect_role']
+
+
+def collect_builds(keep=3, dry_run=False):
+    """Removes old builds from the current host.
+
+    :param keep: the number of good builds to keep (in addition to active builds).
+    :param dry_run: True to only report what would be removed.
+    :return: a dict containing "removed" (a list of paths), "bytes" (reclaimed, or reclaimable
+             for a dry run), and "free" (bytes free on the builds volume afterward).
+    """
+    if keep < 1:
+        raise HaltError('At least one good build must be kept.')
+
+    info = BuildInfo().load()
+    good, kept, newest = _select_builds(info, keep)
+
+    start_msg('----- Collecting old builds (keeping {0}{1}):'.format(
+        ', '.join(sorted(kept)) or 'none', '; dry run' if dry_run else ''))
+    args = ' '.join([ctx().builds_root(), cfg().supervisord_include_conf, cfg().nginx_include_conf, ctx().name,
+                     "'{0}'".format(json.dumps(sorted([info.build_number(name) for name in kept]))), str(newest),
+                     '1' if dry_run else '0'])
+    result = run_json(_COLLECT_SCRIPT, args, use_sudo=True)
+    if result is None:
+        raise HaltError('Failed to collect old builds.')
+
+    # forget the removed builds, and the build inputs that refer to them.
+    gone = [name for name in good if name not in kept]
+    if gone and not dry_run:
+        ops = [['delete', ['builds', name], None] for name in gone]
+        ops.extend([['delete', ['memo', key], None] for key, name in info.memo.iteritems() if name in gone])
+        info.transact(ops)
+
+    for name in result['removed']:
+        message('{0} "{1}"'.format('Would remove' if dry_run else 'Removed', name))
+    succeed_msg('{0} {1} in {2} file(s) and directories; {3} free.'.format(
+        'Reclaimable:' if dry_run else 'Reclaimed', _megabytes(result['bytes']), len(result['removed']),
+        _megabytes(result['free'])))
+    return result
+
+def collect_role(role_name, keep=3, dry_run=False, pool_size=None):
+    """Removes old builds from every instance in a role, concurrently.
+
+    :param role_name: the role name.
+    :param keep: the number of good builds to keep on each instance.
+    :param dry_run: True to only report what would be removed.
+    :param pool_size: optional; the maximum number of hosts to work on at once.
+    :return: a dict mapping each host string to its result (see collect_builds()).
+    """
+    insts, role = ctx().all_hosts_in_role(role_name)
+    hosts = ['{0}@{1}'.format(role.user, inst.public_dns_name) for inst in insts]
+    results = run_parallel(collect_builds, hosts, keep, dry_run, pool_size=pool_size)
+
+    start_msg('----- Build garbage collection for role "{0}":'.format(role_name))
+    for host in sorted(results):
+        message('{0}: {1} {2}'.format(host, _megabytes(results[host]['bytes']),
+                                      'reclaimable' if dry_run else 'reclaimed'))
+    succeed_msg('Total: {0}'.format(_megabytes(sum([r['bytes'] for r in results.itervalues()]))))
+    return results
+
+
+# -------------------- private implementation --------------------
+
+def _select_builds(info, keep):
+    # returns the good builds (oldest first), the set of builds to keep, and the number of the
+    # newest good build (0 if none).
+    good = sorted(set(info.builds.keys() + ([info.last] if info.last else [])), key=info.build_number)
+    kept = set(good[-keep:] + info.active_builds())
+    newest = info.build_number(good[-1]) if good else 0
+    return good, kept, newest
+
+def _megabytes(n):
+    return '{0:.1f} MB'.format(n / (1024.0 * 1024))
+
+# arguments: builds root, supervisor conf dir, nginx conf dir, context name, JSON list of kept
+# build numbers, newest good build number, dry run (1 or 0). removes the context's builds,
+# tarballs and conf files for other build numbers up to the newest, and prints what it removed.
+_COLLECT_SCRIPT = """
+import json, os, re, shutil, stat, sys
+builds_root, supervisor_dir, nginx_dir, context = sys.argv[1:5]
+kept, newest, dry_run = set(json.loads(sys.argv[5])), int(sys.argv[6]), sys.argv[7] == '1'
+pattern = re.compile('^' + re.escape(context) + r'_(\\d+)_')
+# files are hard-linked between builds copied with delta=True; a file's blocks are only
+# reclaimed when all of its links are removed.
+links = {}
+def count(p):
+    st = os.lstat(p)
+    nlink = 1 if stat.S_ISDIR(st.st_mode) else st.st_nlink
+    n, nlink, blocks = links.get((st.st_dev, st.st_ino), (0, nlink, st.st_blocks * 512))
+    links[(st.st_dev, st.st_ino)] = (n + 1, nlink, blocks)
+removed = []
+for d in (builds_root, supervisor_dir, nginx_dir):
+    if not os.path.isdir(d):
+        continue
+    for name in sorted(os.listdir(d)):
+        match = pattern.match(name)
+        if not match or int(match.group(1)) in kept or int(match.group(1)) > newest:
+            continue
+        p = os.path.join(d, name)
+        if d != builds_root and not name.endswith('.conf'):
+            continue
+        count(p)
+        if os.path.isdir(p) and not os.path.islink(p):
+            for root, dirs, files in os.walk(p):
+                for entry in dirs + files:
+                    count(os.path.join(root, entry))
+        removed.append(p)
+reclaimed = sum([blocks for n, nlink, blocks in links.values() if n >= nlink])
+if not dry_run:
+    for p in removed:
+        if os.path.isdir(p) and not os.path.islink(p):
+            shutil.rmtree(p)
+        else:
+            os.remove(p)
+st = os.statvfs(builds_root)
+print(json.dumps(dict(removed=removed, bytes=reclaimed, free=st.f_bavail * st.f_frsize)))
+"""
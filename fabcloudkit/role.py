@@ -10,7 +10,6 @@ from __future__ import absolute_import
 import time
 
 # pypi
-from boto.ec2 import EC2Connection
 from contextlib import contextmanager
 from fabric.context_managers import settings
 from fabric.network import disconnect_all
@@ -71,7 +70,8 @@ class Role(dotdict):
         if instance_type is None:
             instance_type = self.aws.instance_type
 
-        # create the instance.
+        # create the instance. (boto is slow to import; defer it until needed.)
+        from boto.ec2 import EC2Connection
         conn = EC2Connection(ctx().aws_key, ctx().aws_secret)
         result = conn.run_instances(image_id, key_name=key_name,
             security_groups=security_groups, instance_type=instance_type, **kwargs)
@@ -83,6 +83,47 @@ class Role(dotdict):
             inst.update()
         return self._init_instance(inst)
 
+    def collect_builds(self, keep=3, dry_run=False, pool_size=None):
+        """Removes old builds from every instance in this role, concurrently.
+
+        Keeps the last "keep" good builds, and any active build, on each instance; removes other
+        builds along with their tarballs and conf files, and reports the space reclaimed.
+
+        :param keep: the number of good builds to keep on each instance.
+        :param dry_run: True to only report what would be removed.
+        :param pool_size: optional; the maximum number of instances to work on at once.
+        :return: a dict mapping each host string to its result (see retention.collect_builds()).
+        """
+        # imported on first use; it imports the build module.
+        from .retention import collect_role
+
+        return collect_role(self.name, keep=keep, dry_run=dry_run, pool_size=pool_size)
+
+    def distribute_build(self, source_role_name, fanout=2, rate_limit_mb=None, codec='gzip', level=None,
+                         pool_size=None):
+        """Copies the last good build of an instance in another role to every instance in this role.
+
+        Instances that already have the build pass it on to others, so the copy takes a number of
+        rounds that grows with log(number of instances) rather than with the number of instances.
+        This role must allow access to itself, as well as to the source role (see "allow_access").
+
+        :param source_role_name: the role of the instance with the build (e.g., "builder").
+        :param fanout: the number of instances each instance with the build copies to per round.
+        :param rate_limit_mb: optional; the maximum upload rate of each source instance, in MB/s.
+        :param codec: the compression codec for the transfer (see PythonBuildTool.build()).
+        :param level: optional; the compression level.
+        :param pool_size: optional; the maximum number of concurrent copies.
+        :return: the name of the build.
+        """
+        # imported on first use; it imports the build tools.
+        from .distribute import distribute_build
+
+        build_name, insts = distribute_build(source_role_name, self.name, fanout=fanout, rate_limit_mb=rate_limit_mb,
+                                             codec=codec, level=level, pool_size=pool_size)
+        for inst in insts:
+            inst.add_tag(cfg().fck_last_good_build, build_name)
+        return build_name
+
     def load(self, path):
         with open(path, 'r') as f:
             self._set_dct(yaml.safe_load(f.read()))
@@ -0,0 +1,234 @@
+"""
+    fabcloudkit
+
+    Functions for running a build's tests (see PythonBuildTool.build(unittest=...)). Test files
+    are found in the built repos, and each file is run as a separate process in the build's
+    virtualenv, several at a time (one per CPU, by default), longest first.
+
+    The files can also be split into shards that run on other instances in a role, at the same
+    time. Each of those instances streams the build from this one (see PythonBuildTool.copy_from())
+    and copies the repos' files, runs its shard, and removes both afterward. Files are assigned
+    to shards by how long they took in the last good build (largest first, each to the shard
+    with the least total so far), so the shards finish at about the same time. The copies go in
+    a temporary directory, never in the instance's own builds and repos, which may hold a build
+    of the same name.
+
+    plan_shards() only computes the assignment; it doesn't touch any hosts.
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# standard
+import json
+import pipes
+import posixpath as path
+
+# pypi
+from fabric.context_managers import settings
+from fabric.operations import run
+from fabric.state import env
+
+# package
+from fabcloudkit import ctx
+from .build import BuildInfo
+from .build_tools.python_build import PythonBuildTool
+from .internal import *
+from .remote_util import run_json
+from .util import run_parallel, ssh_options
+
+
+__all__ = ['plan_shards', 'run_tests']
+
+
+def plan_shards(files, durations, count):
+    """Assigns test files to shards, balancing their expected total durations.
+
+    :param files: list of test file names.
+    :param durations: dict mapping test file names to their last duration, in seconds. files
+                      without one are expected to take the median duration (or 1 second).
+    :param count: the number of shards.
+    :return: a list of "count" lists of file names, each ordered longest first.
+    """
+    if count < 1:
+        raise ValueError('There must be at least one shard.')
+
+    known = sorted([durations[f] for f in files if f in durations])
+    default = known[len(known) // 2] if known else 1.0
+    expected = dict([(f, durations.get(f, default)) for f in files])
+
+    shards, totals = [[] for _ in xrange(count)], [0.0] * count
+    for f in sorted(files, key=lambda f: (-expected[f], f)):
+        n = totals.index(min(totals))
+        shards[n].append(f)
+        totals[n] += expected[f]
+    return shards
+
+def run_tests(build_name, repo_list, options=None):
+    """Runs the tests of the repos in a build's virtualenv, on the current host (and, optionally,
+    on other instances in a role).
+
+    :param build_name: the name of the build.
+    :param repo_list: the repos whose tests to run.
+    :param options: optional; a dict that may contain:
+        "dirs": directories (relative to each repo) to look for test files in. default: ["tests"]
+        "pattern": the file name pattern of test files. default: "test*.py"
+        "runner": "pytest" (the default), "nose", or "unittest".
+        "processes": the number of test files to run at once on each host. default: CPU count.
+        "shard_role": optional; a role whose other instances also run shards of the tests.
+        "shards": the number of shards. default: one per instance in "shard_role".
+        "ignore_fail": True to report failures without failing the build.
+    :return: a dict containing "passed" and "failed" (lists of test files), "durations" (a dict
+             mapping each test file to its duration in seconds), and "shards" (the number of shards).
+    """
+    options = options if isinstance(options, dict) else {}
+    runner = _RUNNERS.get(options.get('runner', 'pytest'), None)
+    if runner is None:
+        raise HaltError('Unknown test runner: "{0}"'.format(options['runner']))
+
+    # find the test files, as "<repo-dir>/<path>" relative to the repos root.
+    spec = dict(repos=[repo.dir for repo in repo_list], dirs=options.get('dirs', ['tests']),
+                pattern=options.get('pattern', 'test*.py'))
+    files = run_json(_DISCOVER_SCRIPT, '{0} {1}'.format(ctx().repos_root(), pipes.quote(json.dumps(spec))))
+    if files is None:
+        raise HaltError('Unable to find test files.')
+    if not files:
+        yellow_msg('No test files found in repo(s): {0}'.format(', '.join(spec['repos'])))
+        return dict(passed=[], failed=[], durations={}, shards=0)
+
+    # balance the shards with the durations recorded by the last good build.
+    info = BuildInfo().load()
+    last_run = (info.build(info.last) or {}).get('unittest', None) or {}
+    hosts = ['{0}@{1}'.format(env.user, env.host_string.split('@')[-1])]
+    if options.get('shard_role', None):
+        insts, role = ctx().all_hosts_in_role(options['shard_role'])
+        hosts.extend([h for h in ['{0}@{1}'.format(role.user, inst.public_dns_name) for inst in insts]
+                      if h != hosts[0]])
+    hosts = hosts[:options.get('shards', len(hosts))]
+    shards = plan_shards(files, last_run.get('durations', {}), len(hosts))
+
+    start_msg('----- Running {0} test file(s) in {1} shard(s):'.format(len(files), len(hosts)))
+    source, source_role = _current_instance() if len(hosts) > 1 else (None, None)
+    assignments = dict(zip(hosts, shards))
+    args = (assignments, source, source_role, build_name, spec['repos'], runner, options.get('processes', None))
+    if len(hosts) == 1:
+        with settings(host_string=hosts[0]):
+            results = {hosts[0]: _run_shard(*args)}
+    else:
+        results = run_parallel(_run_shard, hosts, *args)
+
+    # aggregate, and report.
+    outcome = dict(passed=[], failed=[], durations={}, shards=len(hosts))
+    for host, result in sorted(results.iteritems()):
+        for f, r in sorted(result.iteritems()):
+            outcome['durations'][f] = r['secs']
+            if r['code']:
+                outcome['failed'].append(f)
+                failed_msg('FAILED {0} ({1}, {2:.1f}s):\n{3}'.format(f, host, r['secs'], r['output']))
+            else:
+                outcome['passed'].append(f)
+        message('{0}: {1} file(s), {2:.1f}s'.format(host, len(result), sum([r['secs'] for r in result.values()])))
+
+    if outcome['failed'] and not options.get('ignore_fail', False):
+        raise HaltError('{0} of {1} test file(s) failed: {2}'.format(
+            len(outcome['failed']), len(files), ', '.join(outcome['failed'])))
+    succeed_msg('Tests: {0} passed, {1} failed.'.format(len(outcome['passed']), len(outcome['failed'])))
+    return outcome
+
+
+# -------------------- private implementation --------------------
+
+def _current_instance():
+    # returns the instance and role for the current host; other shards copy the build from it.
+    insts, role = ctx().all_hosts_in_role(env.role_name)
+    for inst in insts:
+        if inst.public_dns_name == env.host_string.split('@')[-1]:
+            return inst, role
+    raise HaltError('Unable to find the current instance in role "{0}".'.format(env.role_name))
+
+def _run_shard(assignments, source, source_role, build_name, repos, runner, processes):
+    # runs on each shard's host: get the build and repos (unless this is the source), then run
+    # the assigned test files. returns a dict mapping each file to its result.
+    files = assignments[env.host_string]
+    if not files:
+        return {}
+
+    local = source is None or env.host_string.split('@')[-1] == source.public_dns_name
+    root, build_dir = ctx().repos_root(), ctx().build_path(build_name)
+    if not local:
+        result = run('mktemp -d /tmp/fck_tests_{0}_XXXXXXXX'.format(build_name), quiet=True)
+        if result.failed:
+            raise HaltError('Unable to create a temporary directory for the tests.')
+        root = result.strip()
+        build_dir = path.join(root, _BUILDS_DIR, build_name)
+
+    try:
+        if not local:
+            # the build and repos go under the temporary directory only.
+            PythonBuildTool()._stream_from(source, source_role, build_name, dest_root=path.dirname(build_dir))
+            result = run("set -o pipefail && ssh {opts} {user}@{host} 'tar -C {src} -c {repos}' | tar -x -C {root}"
+                         .format(opts=ssh_options(), user=source_role.user, host=source.private_dns_name,
+                                 src=ctx().repos_root(), repos=' '.join(repos), root=root))
+            if result.failed:
+                raise HaltError('Unable to copy repos from "{0}".'.format(source.private_dns_name))
+
+        # run with the virtualenv's python rather than its "activate" script, which names the
+        # virtualenv's original location.
+        spec = dict(root=root, files=files, runner=runner, processes=processes)
+        results = run_json(_TEST_SCRIPT, pipes.quote(json.dumps(spec)), python=path.join(build_dir, 'bin', 'python'))
+        if results is None:
+            raise HaltError('Unable to run tests.')
+        return results
+    finally:
+        if not local:
+            run('rm -rf {0}'.format(root), quiet=True)
+
+# the directory, in a shard's temporary directory, that the build is copied to.
+_BUILDS_DIR = '_builds'
+
+# test runner commands; run in the repo directory, with "{file}" relative to it, and "{module}"
+# its dotted module name.
+_RUNNERS = {
+    'pytest':   '{python} -m pytest -q -p no:cacheprovider {file}',
+    'nose':     '{python} -m nose {file}',
+    'unittest': '{python} -m unittest {module}'
+}
+
+# arguments: repos root, JSON spec of "repos", "dirs" and "pattern". prints the sorted list of
+# test files, as "<repo>/<path>".
+_DISCOVER_SCRIPT = """
+import fnmatch, json, os, sys
+root, spec = sys.argv[1], json.loads(sys.argv[2])
+files = []
+for repo in spec['repos']:
+    for d in spec['dirs']:
+        top = os.path.join(root, repo, d)
+        for dir_path, dirs, names in os.walk(top):
+            for name in fnmatch.filter(names, spec['pattern']):
+                files.append(os.path.relpath(os.path.join(dir_path, name), root))
+print(json.dumps(sorted(files)))
+"""
+
+# arguments: JSON spec of "root", "files" (ordered longest first), "runner" and "processes".
+# runs each file in its repo directory, several at a time; prints each file's exit code,
+# duration, and (if it failed) the end of its output.
+_TEST_SCRIPT = """
+import json, multiprocessing, os, subprocess, sys, time
+from multiprocessing.pool import ThreadPool
+spec = json.loads(sys.argv[1])
+# the virtualenv's scripts come first on the PATH, as they would with it activated.
+env = dict(os.environ, PATH=os.path.dirname(os.path.abspath(sys.executable)) + os.pathsep + os.environ['PATH'])
+def run(f):
+    repo, rel = f.split('/', 1)
+    module = os.path.splitext(rel)[0].replace('/', '.')
+    cmd = spec['runner'].format(python=sys.executable, file=rel, module=module)
+    start = time.time()
+    p = subprocess.Popen(cmd, shell=True, cwd=os.path.join(spec['root'], repo), env=env,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.communicate()[0].decode('utf-8', 'replace')
+    secs = round(time.time() - start, 2)
+    return f, dict(code=p.returncode, secs=secs, output=output[-4000:] if p.returncode else '')
+pool = ThreadPool(spec['processes'] or multiprocessing.cpu_count())
+print(json.dumps(dict(pool.imap_unordered(run, spec['files']))))
+"""
@@ -6,13 +6,46 @@
 """
 from __future__ import absolute_import
 
-from .git import *
-from .gunicorn import *
-from .keys import *
-from .nginx import *
-from .pip import *
-from .pip_command import *
-from .python import *
-from .redis import *
-from .supervisord import *
-from .virtualenv import *
+# standard
+import sys
+from importlib import import_module
+from types import ModuleType
+
+
+# note: tool modules aren't imported here, so that using one tool doesn't import all of
+# them. their names are still available from this package (e.g., "from fabcloudkit.tool
+# import GitTool"); the first use of a name imports the tool modules listed in
+# Tool.__modules__ until one of them has it.
+class _ToolPackage(ModuleType):
+    def __getattr__(self, name):
+        if name == '__all__':
+            return sorted(set(n for module in _tool_modules() for n in _public_names(module)))
+        if not name.startswith('_'):
+            for module in _tool_modules():
+                if name in _public_names(module):
+                    value = getattr(module, name)
+                    setattr(self, name, value)
+                    return value
+        raise AttributeError("'module' object has no attribute '{0}'".format(name))
+
+
+# -------------------- private implementation --------------------
+
+def _tool_modules():
+    # the tool modules in this package, as they'd be found by "from .<module> import *".
+    from ..toolbase import Tool
+    prefix = __name__ + '.'
+    for module_name in sorted(set(m for m in Tool.__modules__.values() if m.startswith(prefix))):
+        yield import_module(module_name)
+
+def _public_names(module):
+    names = getattr(module, '__all__', None)
+    return names if names is not None else [n for n in vars(module) if not n.startswith('_')]
+
+
+# python 2 has no module-level __getattr__; swap in a module that has one. the original
+# module is kept referenced, since its globals are what the functions above use.
+_package = _ToolPackage(__name__, __doc__)
+_package.__dict__.update(sys.modules[__name__].__dict__)
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
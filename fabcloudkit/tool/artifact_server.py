@@ -0,0 +1,206 @@
+"""
+    fabcloudkit
+
+    Functions for running a simple HTTP artifact store (see fabcloudkit.artifact_store). The
+    server stores files in a single directory, and supports GET (including "Range" requests,
+    for concurrent downloads), HEAD, and PUT; a GET of "/" returns a JSON list of file names.
+    It's meant for private networks. Reads aren't authenticated, but a PUT must carry the token
+    the server was installed with ("Authorization: Bearer <token>"); otherwise anyone who can
+    reach the port could replace a build and its recorded hash. Without a token, the server
+    refuses all writes.
+
+    <artifact_server_dir>:
+        The directory that holds the stored files. Files are written to a temporary name and
+        renamed when complete, so readers never see a partial file.
+
+    <artifact_server_script>:
+        The server program; run by supervisor as "nobody".
+
+    <artifact_server_script>.token:
+        The write token; readable only by "nobody".
+
+    The server is a single, dependency-free Python script, so for local testing it can also be
+    run directly: "python <artifact_server_script> <dir> <port> [<token-file>]".
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# standard
+import posixpath as path
+
+# pypi
+from fabric.operations import sudo
+
+# package
+from fabcloudkit import cfg, ctx
+from ..internal import *
+from .supervisord import SupervisorTool
+from ..toolbase import Tool
+from ..util import put_string
+
+
+class ArtifactServerTool(Tool):
+    def __init__(self):
+        super(ArtifactServerTool,self).__init__()
+        self._supervisor = SupervisorTool()
+
+    def check(self, **kwargs):
+        start_msg('----- Checking for artifact server:')
+        if not self._supervisor.wait_until_running(_SUPERVISOR_NAME, tries=0):
+            failed_msg('Artifact server is not running.')
+            return False
+
+        succeed_msg('Artifact server is running.')
+        return True
+
+    def install(self, port=None, token=None, **kwargs):
+        """Installs the artifact server on the current host and starts it.
+
+        :param port: the HTTP port to serve on. default: cfg().artifact_server_port
+        :param token: the token that PUT requests must carry. default: the "token" of the context's
+                      "artifact_store" section. without one, the server is read-only.
+        :return: self
+        """
+        start_msg('----- Installing artifact server:')
+        if port is None:
+            port = cfg().artifact_server_port
+        if token is None:
+            token = (ctx().get('artifact_store', None) or {}).get('token', None)
+        store_dir = cfg().artifact_server_dir
+        script = cfg().artifact_server_script
+        token_file = '{0}.token'.format(script)
+
+        result = sudo('mkdir -p {0} {1} && chown nobody {0}'.format(store_dir, path.dirname(script)))
+        if result.failed:
+            raise HaltError('Unable to create artifact directory: "{0}"'.format(store_dir))
+        put_string(_SERVER_SCRIPT, script, use_sudo=True)
+        sudo('rm -f {0}'.format(token_file))
+        if token:
+            put_string(token, token_file, use_sudo=True, mode=00400)
+            sudo('chown nobody {0}'.format(token_file))
+        else:
+            yellow_msg('No artifact store token; the artifact server will refuse uploads.')
+
+        cmd = 'python {script} {store_dir} {port} {token_file}'.format(**locals())
+        self._supervisor.write_config(_SUPERVISOR_NAME, cmd, dir=store_dir, log_root='/tmp')
+        self._supervisor.reload()
+        if not self._supervisor.wait_until_running(_SUPERVISOR_NAME):
+            raise HaltError('Artifact server did not start.')
+
+        succeed_msg('Artifact server is serving "{0}" on port {1}.'.format(store_dir, port))
+        return self
+
+    def stop(self, **kwargs):
+        self._supervisor.stop_and_remove(_SUPERVISOR_NAME)
+        return self
+
+
+# register.
+Tool.__tools__['artifact_server'] = ArtifactServerTool
+
+
+# private constants.
+_SUPERVISOR_NAME = 'fck_artifact_server'
+
+_SERVER_SCRIPT = """
+import hmac, json, os, shutil, sys, tempfile
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+root, port = sys.argv[1], int(sys.argv[2])
+token_file = sys.argv[3] if len(sys.argv) > 3 else ''
+token = open(token_file).read().strip() if token_file and os.path.exists(token_file) else ''
+compare = getattr(hmac, 'compare_digest', lambda a, b: a == b)
+
+class Handler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        if self.path.split('?')[0] == '/':
+            data = json.dumps(sorted(f for f in os.listdir(root) if not f.startswith('.'))).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            if body:
+                self.wfile.write(data)
+            return
+
+        name = self._file_path()
+        if not name or not os.path.isfile(name):
+            self.send_error(404)
+            return
+        size = os.path.getsize(name)
+        start, end, code = 0, size - 1, 200
+        ranges = self.headers.get('Range', '')
+        if ranges.startswith('bytes=') and ',' not in ranges:
+            first, _, last = ranges[len('bytes='):].partition('-')
+            if first:
+                start, end = int(first), min(int(last) if last else size - 1, size - 1)
+            else:
+                start = max(0, size - int(last))
+            code = 206
+        self.send_response(code)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(max(0, end - start + 1)))
+        if code == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        self.end_headers()
+        if body:
+            f = open(name, 'rb')
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = f.read(min(remaining, 1 << 20))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+            f.close()
+
+    def do_PUT(self):
+        given = self.headers.get('Authorization', '')
+        if not token or not compare(given.encode('utf-8'), ('Bearer ' + token).encode('utf-8')):
+            self.send_error(403)
+            return
+        name = self._file_path()
+        if not name:
+            self.send_error(400)
+            return
+        fd, tmp = tempfile.mkstemp(dir=root, prefix='.')
+        f = os.fdopen(fd, 'wb')
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            block = self.rfile.read(min(remaining, 1 << 20))
+            if not block:
+                break
+            f.write(block)
+            remaining -= len(block)
+        f.close()
+        if remaining:
+            os.remove(tmp)
+            self.send_error(400)
+            return
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, name)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _file_path(self):
+        # a flat namespace; anything that looks like a path is reduced to its last component.
+        name = os.path.basename(self.path.split('?')[0])
+        return os.path.join(root, name) if name and not name.startswith('.') else None
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+Server(('', port), Handler).serve_forever()
+""".lstrip()
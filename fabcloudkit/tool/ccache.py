@@ -0,0 +1,125 @@
+"""
+    fabcloudkit
+
+    Functions for compiling C extensions through ccache, so that builds on the same host
+    reuse the object files of earlier builds instead of recompiling them.
+
+    <ccache_dir>:
+        The compiler cache; shared by all builds on the host, and owned by the user that
+        runs builds. Its size is capped at <ccache_max_size>, after which ccache removes
+        the least recently used entries.
+
+    A build enables the cache by running its compiles with the environment returned by
+    build_env(): CC and CXX invoke the compiler through ccache, and MAKEFLAGS (plus
+    NPY_NUM_BUILD_JOBS for numpy-based packages) allow one compile job per CPU. Note that
+    distutils compiles the sources of a single extension one at a time under Python 2;
+    there the parallelism comes from building several packages at once (see Wheelhouse).
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# standard
+import re
+
+# pypi
+from fabric.operations import run, sudo
+from fabric.state import env
+
+# package
+from fabcloudkit import cfg
+from ..internal import *
+from ..remote_util import host_facts
+from ..toolbase import Tool, SimpleTool
+
+
+class CcacheTool(Tool):
+    def __init__(self):
+        super(CcacheTool,self).__init__()
+        self._simple = SimpleTool.create('ccache')
+
+    def check(self, **kwargs):
+        return self._simple.check()
+
+    def install(self, dir=None, max_size=None, **kwargs):
+        """Installs ccache, and creates and sizes the compiler cache.
+
+        :param dir: the cache directory. default: cfg().ccache_dir
+        :param max_size: the maximum cache size (e.g., "2G"). default: cfg().ccache_max_size
+        :return: self
+        """
+        self._simple.install()
+        self.configure(dir, max_size)
+        succeed_msg('Successfully installed "ccache".')
+        return self
+
+    def configure(self, dir=None, max_size=None):
+        dir = dir or cfg().ccache_dir
+        max_size = max_size or cfg().ccache_max_size
+
+        start_msg('----- Configuring compiler cache "{0}" ({1}):'.format(dir, max_size))
+        result = sudo('mkdir -p {dir} && chown {user} {dir}'.format(user=env.user, **locals()))
+        if result.failed:
+            raise HaltError('Unable to create compiler cache directory: "{0}"'.format(dir))
+
+        result = run('CCACHE_DIR={dir} ccache -M {max_size}'.format(**locals()), quiet=True)
+        if result.failed:
+            raise HaltError('Unable to set compiler cache size ({0}).'.format(result))
+        return self
+
+    def prepare(self, dir=None, max_size=None, jobs=None, **kwargs):
+        """Makes sure the compiler cache is ready for a build, and resets its statistics.
+
+        :param dir: the cache directory. default: cfg().ccache_dir
+        :param max_size: the maximum cache size. default: cfg().ccache_max_size
+        :param jobs: the number of parallel compile jobs. default: the host's CPU count.
+        :return: the environment variables for the build (see build_env()).
+        """
+        self.verify()
+        self.configure(dir, max_size)
+        run('CCACHE_DIR={0} ccache -z'.format(dir or cfg().ccache_dir), quiet=True)
+        return self.build_env(dir, jobs)
+
+    def build_env(self, dir=None, jobs=None):
+        """Returns the environment variables that route compiles through the cache.
+
+        :return: a dict suitable for Fabric's shell_env().
+        """
+        jobs = jobs or host_facts()['cpu_count']
+        return dict(CC='ccache gcc', CXX='ccache g++', CCACHE_DIR=dir or cfg().ccache_dir,
+                    MAKEFLAGS='-j{0}'.format(jobs), NPY_NUM_BUILD_JOBS=str(jobs))
+
+    def stats(self, dir=None):
+        """Reports the cache hits and misses since the last prepare().
+
+        :return: a dict containing "hits", "misses", and "hit_rate" (percent), or None.
+        """
+        result = run('CCACHE_DIR={0} ccache -s'.format(dir or cfg().ccache_dir), quiet=True)
+        if result.failed:
+            failed_msg('Unable to retrieve compiler cache statistics.')
+            return None
+
+        hits, misses = _parse_stats(result)
+        total = hits + misses
+        rate = round(100.0 * hits / total, 1) if total else 0.0
+        message('Compiler cache: {0} hit(s), {1} miss(es); {2}% hit rate.'.format(hits, misses, rate))
+        return dict(hits=hits, misses=misses, hit_rate=rate)
+
+
+# register.
+Tool.__tools__['ccache'] = CcacheTool
+
+
+# private.
+def _parse_stats(text):
+    # ccache 3.x reports "cache hit (direct)", "cache hit (preprocessed)" and "cache miss";
+    # ccache 4.x reports "Hits:" and "Misses:" lines (first for all calls, then per storage).
+    hits = sum([int(n) for n in re.findall(r'^cache hit \(\w+\)\s+(\d+)', text, re.M)])
+    misses = sum([int(n) for n in re.findall(r'^cache miss\s+(\d+)', text, re.M)])
+    if not (hits or misses):
+        match = re.search(r'^\s*Hits:\s+(\d+)', text, re.M)
+        hits = int(match.group(1)) if match else 0
+        match = re.search(r'^\s*Misses:\s+(\d+)', text, re.M)
+        misses = int(match.group(1)) if match else 0
+    return hits, misses
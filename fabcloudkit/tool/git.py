@@ -1,12 +1,34 @@
 """
     fabcloudkit
 
+    Functions for cloning and updating git repos. Clones can be shallow ("depth"), partial
+    ("filter", e.g. "blob:none"; blobs are fetched when checked out) and limited to one branch
+    ("single_branch"); these options can be given to clone(), or set on a repo in the context's
+    "repos" section (along with "branch"), which clone_all() uses:
+
+        repos:
+          myrepo:
+            url: git@github.com:me/myrepo.git
+            branch: master
+            depth: 1
+            filter: blob:none
+            single_branch: True
+
+    Updates fetch only the target ref (by default, the checked-out branch) and reset the working
+    tree to it, so local changes are discarded and there are never merges. clone_all() and
+    update_all() work on all repos at once, in a single remote command, and return each repo's
+    new head commit; the heads are remembered, so head_commit() and head_commits() don't have to
+    ask the host again.
+
     :copyright: (c) 2013 by Rick Bohrer.
     :license: BSD, see LICENSE for more details.
 """
 from __future__ import absolute_import
 
 # standard
+import json
+import pipes
+import posixpath as path
 import uuid
 
 # pypi
@@ -14,7 +36,9 @@ from fabric.context_managers import cd
 from fabric.operations import put, run, sudo
 
 # package
-from fabcloudkit import ctx, start_msg, succeed_msg, message, HaltError
+from fabcloudkit import ctx, start_msg, succeed_msg, failed_msg, message, HaltError
+from ..host_vars import get_value, set_value
+from ..remote_util import run_json
 from ..toolbase import Tool, SimpleTool
 
 
@@ -29,39 +53,67 @@ class GitTool(Tool):
     def install(self, **kwargs):
         return self._simple.install()
 
-    def clone(self, url, name=None, parent_dir=None, repo_name=''):
+    def clone(self, url, name=None, parent_dir=None, repo_name='', branch=None, depth=None, filter=None,
+              single_branch=False):
+        """Clones a git repo.
+
+        :param url: the repo URL.
+        :param name: the directory name of the clone, if "repo_name" isn't given.
+        :param parent_dir: the directory to clone into. default: the repos root.
+        :param repo_name: the directory name of the clone. default: "name", or taken from the URL.
+        :param branch: optional; the branch (or tag) to check out.
+        :param depth: optional; the number of commits of history to fetch (a shallow clone).
+        :param filter: optional; a partial-clone filter, e.g. "blob:none".
+        :param single_branch: True to fetch only "branch" (or the remote's default branch).
+        :return: self
+        """
         start_msg('----- Cloning git repo: "{url}"'.format(**locals()))
-        if not name:
-            name = ctx().name
-            message('Using context name: "{0}"'.format(name))
         if not parent_dir:
             parent_dir = ctx().repos_root()
             message('Using parent directory: "{0}"'.format(parent_dir))
+        repo_name = repo_name or name
+        if not repo_name:
+            repo_name = url.rstrip('/').rsplit('/', 1)[-1].rsplit(':', 1)[-1]
+            repo_name = repo_name[:-len('.git')] if repo_name.endswith('.git') else repo_name
 
         # make sure the parent directory exists.
         result = sudo('mkdir -p -m 0777 {0}'.format(parent_dir))
         if result.failed:
             raise HaltError('Unable to create repo parent directory: {0}'.format(parent_dir))
 
-        with cd(parent_dir):
-            result = run('git clone {url} {repo_name}'.format(**locals()))
-            if result.return_code != 0:
-                raise HaltError('Failed to clone repo: "{url}"'.format(**locals()))
-        succeed_msg('Clone successful.')
+        spec = dict(dir=repo_name, url=url, branch=branch, depth=depth, filter=filter, single_branch=single_branch)
+        result = self._run_all(parent_dir, [spec], 'clone')[repo_name]
+        if 'error' in result:
+            raise HaltError('Failed to clone repo: "{0}" ({1})'.format(url, result['error']))
+        succeed_msg('Clone successful ({0}).'.format(result['commit']))
         return self
 
-    def pull(self, repo_name=None, repo_dir=None):
+    def update(self, repo_name=None, repo_dir=None, ref=None):
+        """Updates a repo to the latest commit of a ref: fetches only that ref, and resets the
+        working tree to it (discarding local changes).
+
+        :param repo_name: the repo directory name (relative to the repos root).
+        :param repo_dir: alternatively, the repo directory.
+        :param ref: optional; the branch, tag or commit to update to. default: the checked-out
+                    branch (or the repo's "branch").
+        :return: the new head commit ID.
+        """
         if not repo_dir:
             if not repo_name:
                 raise HaltError('Either "repo_name" or "repo_dir" must be specified.')
             repo_dir = ctx().repo_path(repo_name)
 
-        start_msg('Executing git pull in repo: "{0}"'.format(repo_dir))
-        with cd(repo_dir):
-            result = run('git pull')
-            if result.failed:
-                raise HaltError('Error during "git pull" ({0})'.format(result))
-        succeed_msg('Pull successful ({0}).'.format(result))
+        start_msg('Updating git repo: "{0}"'.format(repo_dir))
+        parent_dir, name = path.split(repo_dir.rstrip('/'))
+        result = self._run_all(parent_dir, [self._repo_spec(name, ref)], 'update')[name]
+        if 'error' in result:
+            raise HaltError('Error during git update ({0})'.format(result['error']))
+        succeed_msg('Update successful ({0}).'.format(result['commit']))
+        return result['commit']
+
+    def pull(self, repo_name=None, repo_dir=None):
+        # updates are fetch + reset (see update()); kept for existing role files.
+        self.update(repo_name, repo_dir)
         return self
 
     def head_commit(self, repo_name=None, repo_dir=None):
@@ -70,6 +122,10 @@ class GitTool(Tool):
                 raise HaltError('Either "repo_name" or "repo_dir" must be specified.')
             repo_dir = ctx().repo_path(repo_name)
 
+        commit = get_value(_HEAD_KEY + repo_dir)
+        if commit:
+            return commit
+
         start_msg('Getting commit ID in git repo: "{0}":'.format(repo_dir))
         with cd(repo_dir):
             # pipe the result through cat, otherwise the result that comes back from run()
@@ -80,6 +136,35 @@ class GitTool(Tool):
         succeed_msg('Got head commit ID ({0}).'.format(result))
         return result
 
+    def head_commits(self, repo_names):
+        """
+        Returns the head commit ID of each of several repos, using a single remote command (or
+        none, if all of the repos were cloned or updated since the host was connected to).
+
+        :param repo_names: list of repo directory names (relative to the repos root).
+        :return: dict mapping repo name to commit ID.
+        """
+        commits = dict([(name, get_value(_HEAD_KEY + ctx().repo_path(name))) for name in repo_names])
+        commits = dict([(name, commit) for name, commit in commits.iteritems() if commit])
+        unknown = [name for name in repo_names if name not in commits]
+        if not unknown:
+            return commits
+
+        start_msg('Getting commit IDs in git repos: {0}'.format(', '.join(unknown)))
+        cmd = ' && '.join([
+            'echo "{0} $(cd {1} && git log -1 --pretty=format:%h | cat)"'.format(name, ctx().repo_path(name))
+            for name in unknown])
+        result = run(cmd)
+        if result.failed:
+            raise HaltError('Error during "git log" ({0})'.format(result))
+
+        commits.update(dict([line.split() for line in result.splitlines() if len(line.split()) == 2]))
+        missing = [name for name in repo_names if name not in commits]
+        if missing:
+            raise HaltError('Unable to get commit ID for repo(s): {0}'.format(', '.join(missing)))
+        succeed_msg('Got head commit IDs ({0}).'.format(commits))
+        return commits
+
     def install_key_file(self, local_key_file, target_name=None):
         """
         Copies the specified private key file to the host and updates the ssh config for github.com.
@@ -143,24 +228,127 @@ class GitTool(Tool):
 
     def clone_all(self):
         """
-        Clones all repos defined in the current context.
+        Clones all repos defined in the current context, concurrently, using the clone options
+        of each repo (see clone()).
 
         :return: None
         """
-        for repo in ctx().repos():
-            self.clone(repo['url'], repo_name=repo['dir'])
+        start_msg('----- Cloning git repos: {0}'.format(', '.join([repo.dir for repo in ctx().repos()])))
+        result = sudo('mkdir -p -m 0777 {0}'.format(ctx().repos_root()))
+        if result.failed:
+            raise HaltError('Unable to create repo parent directory: {0}'.format(ctx().repos_root()))
+
+        specs = [self._repo_spec(repo.dir) for repo in ctx().repos()]
+        self._report(self._run_all(ctx().repos_root(), specs, 'clone'), 'clone')
         return self
 
+    def update_all(self, ref=None, processes=None):
+        """
+        Updates all repos defined in the current context, concurrently (see update()).
+
+        :param ref: optional; the ref to update every repo to. default: each repo's branch.
+        :param processes: optional; the number of repos to update at once. default: all of them.
+        :return: dict mapping repo name to its new head commit ID.
+        """
+        start_msg('----- Updating git repos: {0}'.format(', '.join([repo.dir for repo in ctx().repos()])))
+        specs = [self._repo_spec(repo.dir, ref) for repo in ctx().repos()]
+        return self._report(self._run_all(ctx().repos_root(), specs, 'update', processes), 'update')
+
     def pull_all(self):
         """
-        Performs a "pull" for all repos defined in the current context.
+        Updates all repos defined in the current context (see update_all()).
 
         :return: None
         """
-        for repo in ctx().repos():
-            self.pull(repo['dir'])
+        self.update_all()
         return self
 
+    def _repo_spec(self, repo_dir, ref=None):
+        # clone/update options for a repo directory, from the context's repo definition (if any).
+        spec = dict(dir=repo_dir, ref=ref)
+        for repo in ctx().repos():
+            if repo.dir == repo_dir:
+                spec.update(url=repo.url, branch=repo.get('branch', None), depth=repo.get('depth', None),
+                            filter=repo.get('filter', None), single_branch=repo.get('single_branch', False))
+        return spec
+
+    def _run_all(self, parent_dir, specs, mode, processes=None):
+        # clones or updates the repos in one remote command; remembers and returns their heads.
+        arg = dict(root=parent_dir, repos=specs, mode=mode, processes=processes)
+        results = run_json(_GIT_SCRIPT, pipes.quote(json.dumps(arg)))
+        if results is None:
+            raise HaltError('Unable to {0} git repos in "{1}".'.format(mode, parent_dir))
+        for name, result in results.iteritems():
+            if 'commit' in result:
+                set_value(_HEAD_KEY + path.join(parent_dir, name), result['commit'])
+        return results
+
+    def _report(self, results, mode):
+        for name, result in sorted(results.iteritems()):
+            if 'error' in result:
+                failed_msg('{0}: {1}'.format(name, result['error']))
+            else:
+                message('{0}: {1} ({2:.1f}s)'.format(name, result['commit'], result['secs']))
+
+        failed = sorted([name for name, result in results.iteritems() if 'error' in result])
+        if failed:
+            raise HaltError('Failed to {0} repo(s): {1}'.format(mode, ', '.join(failed)))
+        succeed_msg('{0} repo(s) done in {1:.1f}s.'.format(
+            len(results), max([result['secs'] for result in results.itervalues()] or [0])))
+        return dict([(name, result['commit']) for name, result in results.iteritems()])
+
 
 # register.
 Tool.__tools__['git'] = GitTool
+
+
+# private constants.
+_HEAD_KEY = 'git_head:'
+
+# argument: JSON spec of "root" (the parent directory), "repos" (each a dict of "dir", and
+# "url", "branch", "depth", "filter", "single_branch" and "ref"), "mode" ("clone" or "update")
+# and "processes". works on the repos concurrently, and prints each repo's head commit and
+# duration (or error).
+_GIT_SCRIPT = """
+import json, os, subprocess, sys, time
+from multiprocessing.pool import ThreadPool
+spec = json.loads(sys.argv[1])
+def git(args, cwd):
+    p = subprocess.Popen(['git'] + args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.communicate()[0].decode('utf-8', 'replace').strip()
+    if p.returncode:
+        raise RuntimeError('git %s: %s' % (args[0], output[-2000:]))
+    return output
+def clone(repo):
+    args = ['clone', '--quiet']
+    if repo.get('branch'):
+        args.extend(['--branch', repo['branch']])
+    if repo.get('depth'):
+        args.extend(['--depth', str(repo['depth'])])
+    if repo.get('filter'):
+        args.append('--filter=' + repo['filter'])
+    if repo.get('single_branch'):
+        args.append('--single-branch')
+    git(args + [repo['url'], repo['dir']], spec['root'])
+def update(repo):
+    # fetch just the target ref (keeping a shallow clone shallow), and reset to it.
+    cwd = os.path.join(spec['root'], repo['dir'])
+    ref = repo.get('ref') or git(['rev-parse', '--abbrev-ref', 'HEAD'], cwd)
+    if ref == 'HEAD':
+        ref = repo.get('branch') or 'HEAD'
+    args = ['fetch', '--quiet', 'origin', ref]
+    if os.path.exists(os.path.join(cwd, '.git', 'shallow')):
+        args[2:2] = ['--depth', str(repo.get('depth') or 1)]
+    git(args, cwd)
+    git(['reset', '--quiet', '--hard', 'FETCH_HEAD'], cwd)
+def work(repo):
+    start = time.time()
+    try:
+        (clone if spec['mode'] == 'clone' else update)(repo)
+        commit = git(['rev-parse', '--short', 'HEAD'], os.path.join(spec['root'], repo['dir']))
+        return repo['dir'], dict(commit=commit, secs=round(time.time() - start, 2))
+    except Exception as e:
+        return repo['dir'], dict(error=str(e), secs=round(time.time() - start, 2))
+pool = ThreadPool(spec['processes'] or max(1, len(spec['repos'])))
+print(json.dumps(dict(pool.map(work, spec['repos']))))
+"""
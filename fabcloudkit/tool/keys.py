@@ -1,10 +1,10 @@
 from __future__ import absolute_import
 
 # standard
+import pipes
 from StringIO import StringIO
 
 # pypi
-from fabric.context_managers import cd
 from fabric.state import env
 from fabric.operations import get, run
 
@@ -28,12 +28,21 @@ class KeyPairTool(Tool):
         result = run('test -f {0}'.format(cfg().machine_key_file()))
         return result.succeeded
 
-    def install(self, **kwargs):
+    def install(self, key_type='ed25519', **kwargs):
         """Generates a private/public key-pair for the host, stored in the ~/.ssh/ directory.
 
+        Ed25519 keys are small and fast to sign and verify, which speeds up the SSH handshake
+        for scp/git traffic between instances. If the host's OpenSSH is too old to support
+        them (before 6.5), a 4096-bit RSA key is generated instead.
+
+        :param key_type: the type of key to generate: "ed25519" (default) or "rsa".
         :return: self
         """
-        result = run('ssh-keygen -b 1024 -t rsa -N "" -f {0}'.format(cfg().machine_key_file()))
+        key_file = cfg().machine_key_file()
+        result = run('ssh-keygen -t {0} -N "" -f {1}'.format(_KEY_TYPE_ARGS[key_type], key_file))
+        if result.failed and key_type != 'rsa':
+            message('Unable to generate a "{0}" key; generating a 4096-bit RSA key instead.'.format(key_type))
+            result = run('ssh-keygen -t {0} -N "" -f {1}'.format(_KEY_TYPE_ARGS['rsa'], key_file))
         if result.failed:
             raise HaltError('Unable to generate and install key pair.')
         succeed_msg('Key pair generated.')
@@ -59,14 +68,17 @@ class RequestAccessTool(Tool):
         super(RequestAccessTool,self).__init__()
         self._key_pair = KeyPairTool()
 
-    def install(self, roles):
+    def install(self, roles, pool_size=None):
         if isinstance(roles, basestring):
             roles = [roles]
 
         if not roles:
             raise HaltError('No roles specified for request_access.')
 
-        public_key = self._key_pair.get_public_key()
+        public_key = self._key_pair.get_public_key().strip()
+        if not public_key:
+            raise HaltError('No key pair on this host; use "key_pair" first.')
+
         for role_name in roles:
             # check if access is allowed.
             target_role = ctx().get_role(role_name)
@@ -74,10 +86,12 @@ class RequestAccessTool(Tool):
                 raise RuntimeError('Role "{0}" does not allow access to role "{1}"'
                                    .format(target_role.name, env.role_name))
 
-            # it is; put this host's public key in the target host's authorized_keys file.
-            inst, role = ctx().get_host_in_role(role_name)
-            with role.and_instance(inst):
-                self._authorize_key(public_key)
+            # it is; put this host's public key in the authorized_keys file of every host in the role.
+            hosts, role = ctx().all_hosts_in_role(role_name)
+            if not hosts:
+                raise HaltError('No instance in role "{0}" is available.'.format(role_name))
+            host_strings = ['{0}@{1}'.format(role.user, inst.public_dns_name) for inst in hosts]
+            run_parallel(self._authorize_key, host_strings, public_key, pool_size=pool_size)
         succeed_msg('Access granted to instances in role(s): {0}'.format(roles))
         return self
 
@@ -86,20 +100,38 @@ class RequestAccessTool(Tool):
 
         Grants access to the current host, to whoever holds the private key associated with the
         specified public key value. This is done by adding the public key to the host's SSH
-        authorized_keys file.
+        authorized_keys file, unless it's already there. Duplicate lines are also removed, so
+        the file stays small no matter how often access is requested.
 
         :param public_key_value: the public key of the entity to be given access.
         :return: None
         """
-        remote_key_file = tmp_file_name('~/.ssh', 'fck_key_', '.pub')
-        with cd('~/.ssh'):
-            put_string(public_key_value, remote_key_file)
-            result = run('cat {0} >> authorized_keys'.format(remote_key_file))
-            if result.failed:
-                raise HaltError('Failed to write to "authorized_keys" file.')
+        key = public_key_value.strip()
+        if not key or '\n' in key:
+            raise HaltError('Invalid public key value.')
+        key = pipes.quote(key)
+
+        result = run(_AUTHORIZE_KEY_CMD.format(**locals()))
+        if result.failed:
+            raise HaltError('Failed to write to "authorized_keys" file.')
         return self
 
 
 # register.
 Tool.__tools__['key_pair'] = KeyPairTool
 Tool.__tools__['request_access'] = RequestAccessTool
+
+
+# private.
+_KEY_TYPE_ARGS = {
+    'ed25519': 'ed25519',
+    'rsa':     'rsa -b 4096'
+}
+
+# appends the key (already shell-quoted) if it isn't present, then drops any duplicate lines
+# in place (keeping the file's permissions and ownership).
+_AUTHORIZE_KEY_CMD = (
+    "mkdir -p -m 0700 ~/.ssh && cd ~/.ssh && touch authorized_keys && chmod 0600 authorized_keys && "
+    "(grep -qxF -e {key} authorized_keys || printf '%s\\n' {key} >> authorized_keys) && "
+    "awk '!seen[$0]++' authorized_keys > authorized_keys.fck_tmp && "
+    "cat authorized_keys.fck_tmp > authorized_keys && rm -f authorized_keys.fck_tmp")
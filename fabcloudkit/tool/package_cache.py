@@ -0,0 +1,299 @@
+"""
+    fabcloudkit
+
+    Functions for running a fleet-local OS package cache. One host (typically in the
+    "builder" role) runs a caching HTTP proxy, and other hosts' package managers (yum or
+    apt) are configured to download through it. The first request for a package file
+    (.rpm or .deb) is fetched from the upstream mirror and kept; later requests for it, from
+    any host, are served from the cache. Everything else (repository metadata, keys) is
+    passed through uncached, so hosts always see current metadata.
+
+    Package managers still check packages as usual: signatures (yum "gpgcheck") and the
+    hashes in the signed repository metadata (apt), against the upstream repositories. The
+    cache only changes where the bytes come from.
+
+    <package_cache_dir>:
+        The cached package files, by mirror host and path (e.g., "<mirror>/<path>.rpm"), so
+        files with the same name from different mirrors or repositories are kept apart. Files
+        can also be put here by hand, at the path they'd be fetched from.
+
+    <package_cache_script>:
+        The proxy program; run by supervisor as "nobody".
+
+    /etc/yum.conf ("proxy" setting), /etc/apt/apt.conf.d/90fabcloudkit-proxy:
+        Written on hosts that use the cache (see use()).
+
+    Requests go only to the hosts in <package_cache_mirrors> (shell-style patterns, e.g.
+    "*.archive.ubuntu.com"); anything else is refused, so the cache isn't an open relay. Only
+    "http" mirrors are cached; "https" requests are tunneled straight through (to port 443
+    only). The cache port must be reachable from other instances (check your security group).
+    For local testing, run the program directly with "python <package_cache_script> <dir> <port>
+    <mirror,...>", and fetch through it with "curl -x http://localhost:<port> http://<mirror>/<path>.rpm".
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# standard
+import pipes
+import posixpath as path
+
+# pypi
+from fabric.operations import sudo
+
+# package
+from fabcloudkit import cfg, ctx
+from fabcloudkit.host_vars import has_yum
+from ..internal import *
+from .supervisord import SupervisorTool
+from ..toolbase import Tool
+from ..util import put_string
+
+
+class PackageCacheTool(Tool):
+    def __init__(self):
+        super(PackageCacheTool,self).__init__()
+        self._supervisor = SupervisorTool()
+
+    def check(self, **kwargs):
+        start_msg('----- Checking for package cache:')
+        if not self._supervisor.wait_until_running(_SUPERVISOR_NAME, tries=0):
+            failed_msg('Package cache is not running.')
+            return False
+
+        succeed_msg('Package cache is running.')
+        return True
+
+    def install(self, port=None, mirrors=None, **kwargs):
+        """Turns the current host into a package cache and starts serving it.
+
+        :param port: the HTTP port to serve on. default: cfg().package_cache_port
+        :param mirrors: host name patterns of the mirrors that may be fetched from.
+            default: cfg().package_cache_mirrors
+        :return: self
+        """
+        start_msg('----- Installing package cache:')
+        if port is None:
+            port = cfg().package_cache_port
+        if mirrors is None:
+            mirrors = cfg().package_cache_mirrors
+        if not mirrors:
+            raise HaltError('No package mirrors configured ("package_cache_mirrors").')
+        cache_dir = cfg().package_cache_dir
+        script = cfg().package_cache_script
+        mirrors = pipes.quote(','.join(mirrors))
+
+        result = sudo('mkdir -p {0} {1} && chown -R nobody {0}'.format(cache_dir, path.dirname(script)))
+        if result.failed:
+            raise HaltError('Unable to create package cache directory: "{0}"'.format(cache_dir))
+        put_string(_SERVER_SCRIPT, script, use_sudo=True)
+
+        cmd = 'python {script} {cache_dir} {port} {mirrors}'.format(**locals())
+        self._supervisor.write_config(_SUPERVISOR_NAME, cmd, dir=cache_dir, log_root='/tmp')
+        self._supervisor.reload()
+        if not self._supervisor.wait_until_running(_SUPERVISOR_NAME):
+            raise HaltError('Package cache server did not start.')
+
+        succeed_msg('Package cache is serving "{0}" on port {1}.'.format(cache_dir, port))
+        return self
+
+    def use(self, role_name=None, host=None, port=None, **kwargs):
+        """Configures the current host's package manager to download through the package cache.
+
+        :param role_name: the role of the instance serving the cache.
+        :param host: alternatively, the host name (or address) of the cache.
+        :param port: the cache port. default: cfg().package_cache_port
+        :return: self
+        """
+        if not host:
+            if not role_name:
+                raise HaltError('Either "role_name" or "host" must be specified.')
+            inst, role = ctx().get_host_in_role(role_name)
+            host = inst.private_dns_name
+        if port is None:
+            port = cfg().package_cache_port
+
+        start_msg('----- Configuring package manager to use cache at "{host}:{port}":'.format(**locals()))
+        if has_yum():
+            result = sudo(_YUM_PROXY_CMD.format(**locals()))
+            if result.succeeded:
+                result = sudo('yum -q clean metadata')
+        else:
+            put_string(_APT_PROXY.format(**locals()), _APT_PROXY_FILE, use_sudo=True)
+            result = sudo('apt-get -y -q update')
+        if result.failed:
+            raise HaltError('Unable to refresh package metadata through the cache.')
+
+        succeed_msg('Package manager now downloads through the cache at "{host}:{port}".'.format(**locals()))
+        return self
+
+    def stop(self, **kwargs):
+        self._supervisor.stop_and_remove(_SUPERVISOR_NAME)
+        return self
+
+
+# register.
+Tool.__tools__['package_cache'] = PackageCacheTool
+
+
+# private constants.
+_SUPERVISOR_NAME = 'fck_package_cache'
+
+# replaces any "proxy" setting in yum's [main] section.
+_YUM_PROXY_CMD = (
+    "sed -i '/^proxy=/d' /etc/yum.conf && "
+    "sed -i 's|^\\[main\\]$|[main]\\nproxy=http://{host}:{port}|' /etc/yum.conf")
+
+_APT_PROXY_FILE = '/etc/apt/apt.conf.d/90fabcloudkit-proxy'
+_APT_PROXY = 'Acquire::http::Proxy "http://{host}:{port}/";\n'
+
+_SERVER_SCRIPT = """
+import errno, fnmatch, os, re, select, shutil, socket, sys, tempfile
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import HTTPError, Request, urlopen
+    from urlparse import urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+    from urllib.parse import urlparse
+
+root, port, mirrors = sys.argv[1], int(sys.argv[2]), sys.argv[3].lower().split(',')
+PACKAGE = re.compile(r'^[\\w.+~-]+\\.(rpm|deb|udeb)$')
+SEGMENT = re.compile(r'^[\\w+~-][\\w.+~-]*$')
+HOP_HEADERS = ('connection', 'keep-alive', 'proxy-connection', 'proxy-authorization', 'te', 'trailer',
+               'transfer-encoding', 'upgrade', 'host')
+
+def is_mirror(host):
+    return any(fnmatch.fnmatch((host or '').lower(), m) for m in mirrors if m)
+
+def cache_path(host, path):
+    # <root>/<host>/<path>, or None if the path can't be kept safely under root.
+    parts = [host.lower()] + path.split('/')[1:]
+    if not PACKAGE.match(parts[-1]) or not all(SEGMENT.match(p) for p in parts):
+        return None
+    return os.path.join(root, *parts)
+
+class Handler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        url = urlparse(self.path)
+        if not url.scheme:
+            # a direct request: a cached package, by its path in the cache ("/<host>/<path>").
+            host, _, rest = url.path.lstrip('/').partition('/')
+            p = cache_path(host, '/' + rest) if host else None
+            return self.send_file(p, body) if p and os.path.isfile(p) else self.send_error(404)
+        if url.scheme != 'http':
+            return self.send_error(400)
+        if not is_mirror(url.hostname) or url.port not in (None, 80):
+            return self.send_error(403)
+        p = cache_path(url.hostname, url.path)
+        if not p:
+            return self.relay(body)
+
+        # a package: serve it from the cache, fetching it first on a miss.
+        if not os.path.isfile(p):
+            try:
+                self.fetch(p)
+            except HTTPError as e:
+                return self.send_error(e.code)
+            except Exception as e:
+                return self.send_error(502, str(e))
+        self.send_file(p, body)
+
+    def do_CONNECT(self):
+        # "https" isn't cached; tunnel it.
+        host, _, port = self.path.rpartition(':')
+        if port != '443' or not is_mirror(host):
+            return self.send_error(403)
+        try:
+            upstream = socket.create_connection((host, 443), timeout=30)
+        except Exception as e:
+            return self.send_error(502, str(e))
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        conns = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, broken = select.select(conns, [], conns, 300)
+                if broken or not readable:
+                    break
+                for s in readable:
+                    data = s.recv(1 << 16)
+                    if not data:
+                        return
+                    (upstream if s is self.connection else self.connection).sendall(data)
+        finally:
+            upstream.close()
+            self.close_connection = True
+
+    def request_for_upstream(self):
+        headers = dict((k, v) for k, v in self.headers.items() if k.lower() not in HOP_HEADERS)
+        r = Request(self.path, headers=headers)
+        r.get_method = lambda: self.command
+        return r
+
+    def fetch(self, p):
+        # written to a temporary name, and renamed only when all the bytes have arrived.
+        src = urlopen(Request(self.path), timeout=60)
+        length = src.info().get('Content-Length')
+        try:
+            os.makedirs(os.path.dirname(p))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(p), prefix='.')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                shutil.copyfileobj(src, f, 1 << 20)
+                size = f.tell()
+            finally:
+                f.close()
+            if length is not None and size != int(length):
+                raise IOError('incomplete download: {0} of {1} bytes'.format(size, length))
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, p)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    def relay(self, body):
+        try:
+            src = urlopen(self.request_for_upstream(), timeout=60)
+            code = src.getcode()
+        except HTTPError as e:
+            src, code = e, e.code
+        except Exception as e:
+            return self.send_error(502, str(e))
+        self.send_response(code)
+        for k, v in src.info().items():
+            if k.lower() not in HOP_HEADERS:
+                self.send_header(k, v)
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        if body:
+            shutil.copyfileobj(src, self.wfile, 1 << 16)
+        self.close_connection = True
+
+    def send_file(self, p, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(p)))
+        self.end_headers()
+        if body:
+            f = open(p, 'rb')
+            shutil.copyfileobj(f, self.wfile, 1 << 20)
+            f.close()
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+Server(('', port), Handler).serve_forever()
+""".lstrip()
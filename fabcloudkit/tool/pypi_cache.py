@@ -0,0 +1,316 @@
+"""
+    fabcloudkit
+
+    Functions for running a fleet-local python package index. One host (typically in the
+    "builder" role) serves a PEP 503 "simple" index from its cache, and fetches anything it
+    doesn't have from the upstream index (PyPI) on first request; other hosts point pip and
+    easy_install at it, so each package is downloaded from PyPI once for the whole fleet.
+
+    <pypi_cache_dir>/<project>/:
+        The cached distribution files for a project (the project name is normalized as in
+        PEP 503, e.g. "Flask_SQLAlchemy" becomes "flask-sqlalchemy"). Files can also be put
+        here by hand; the cache lists every file in the directory.
+
+    <pypi_cache_dir>/<project>/.index.json:
+        The project's last upstream listing (file names, upstream URLs, hashes); reused for
+        a few minutes, and whenever the upstream index can't be reached.
+
+    <pypi_cache_script>:
+        The server program; run by supervisor as "nobody".
+
+    ~/.pip/pip.conf, /root/.pip/pip.conf, /etc/pip.conf, ~/.pydistutils.cfg:
+        Written on hosts that use the cache (see use()).
+
+    With no upstream (pypi_cache_upstream is empty, or install(upstream='')), the cache serves
+    only what's in <pypi_cache_dir>, so it can be tested fully offline: copy some sdists or
+    wheels into <pypi_cache_dir>/<project>/, and run the server directly with
+    "python <pypi_cache_script> <dir> <port>", then "pip install --index-url
+    http://localhost:<port>/simple/ <project>".
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# standard
+import posixpath as path
+
+# pypi
+from fabric.operations import run, sudo
+from fabric.state import env
+
+# package
+from fabcloudkit import cfg, ctx
+from ..internal import *
+from .supervisord import SupervisorTool
+from ..toolbase import Tool
+from ..util import put_string
+
+
+class PypiCacheTool(Tool):
+    def __init__(self):
+        super(PypiCacheTool,self).__init__()
+        self._supervisor = SupervisorTool()
+
+    def check(self, **kwargs):
+        start_msg('----- Checking for pypi cache:')
+        if not self._supervisor.wait_until_running(_SUPERVISOR_NAME, tries=0):
+            failed_msg('Pypi cache is not running.')
+            return False
+
+        succeed_msg('Pypi cache is running.')
+        return True
+
+    def install(self, port=None, upstream=None, **kwargs):
+        """Installs the pypi cache on the current host and starts it.
+
+        :param port: the HTTP port to serve on. default: cfg().pypi_cache_port
+        :param upstream: the index to fill misses from; '' for none. default: cfg().pypi_cache_upstream
+        :return: self
+        """
+        start_msg('----- Installing pypi cache:')
+        if port is None:
+            port = cfg().pypi_cache_port
+        if upstream is None:
+            upstream = cfg().pypi_cache_upstream or ''
+        cache_dir = cfg().pypi_cache_dir
+        script = cfg().pypi_cache_script
+
+        result = sudo('mkdir -p {0} {1} && chown -R nobody {0}'.format(cache_dir, path.dirname(script)))
+        if result.failed:
+            raise HaltError('Unable to create pypi cache directory: "{0}"'.format(cache_dir))
+        put_string(_SERVER_SCRIPT, script, use_sudo=True)
+
+        cmd = "python {script} {cache_dir} {port} '{upstream}'".format(**locals())
+        self._supervisor.write_config(_SUPERVISOR_NAME, cmd, dir=cache_dir, log_root='/tmp')
+        self._supervisor.reload()
+        if not self._supervisor.wait_until_running(_SUPERVISOR_NAME):
+            raise HaltError('Pypi cache did not start.')
+
+        succeed_msg('Pypi cache is serving "{0}" on port {1} (upstream: {2}).'.format(
+            cache_dir, port, upstream or 'none'))
+        return self
+
+    def use(self, role_name=None, host=None, port=None, **kwargs):
+        """Configures pip and easy_install on the current host to use the pypi cache.
+
+        Both the connecting user's and root's configuration are written, since pip is run
+        both ways (e.g., by builds, and by the "pip" and "pip_command" tools).
+
+        :param role_name: the role of the instance serving the cache.
+        :param host: alternatively, the host name (or address) of the cache.
+        :param port: the cache port. default: cfg().pypi_cache_port
+        :return: self
+        """
+        if not host:
+            if not role_name:
+                raise HaltError('Either "role_name" or "host" must be specified.')
+            inst, role = ctx().get_host_in_role(role_name)
+            host = inst.private_dns_name
+        if port is None:
+            port = cfg().pypi_cache_port
+
+        start_msg('----- Configuring pip to use pypi cache at "{host}:{port}":'.format(**locals()))
+        pip_conf = _PIP_CONF.format(**locals())
+        distutils_cfg = _DISTUTILS_CFG.format(**locals())
+        home = run('echo $HOME', quiet=True).strip()
+        result = sudo('mkdir -p {0}/.pip /root/.pip'.format(home))
+        if result.failed:
+            raise HaltError('Unable to create pip configuration directories.')
+        for dest in [path.join(home, '.pip/pip.conf'), '/root/.pip/pip.conf', '/etc/pip.conf']:
+            put_string(pip_conf, dest, use_sudo=True)
+        for dest in [path.join(home, '.pydistutils.cfg'), '/root/.pydistutils.cfg']:
+            put_string(distutils_cfg, dest, use_sudo=True)
+        sudo('chown -R {0} {1}/.pip {1}/.pydistutils.cfg'.format(env.user, home))
+
+        result = run("curl -sSf -o /dev/null 'http://{host}:{port}/simple/'".format(**locals()), quiet=True)
+        if result.failed:
+            yellow_msg('Pypi cache at "{host}:{port}" is not reachable (yet).'.format(**locals()))
+        succeed_msg('pip now uses the pypi cache at "{host}:{port}".'.format(**locals()))
+        return self
+
+    def stop(self, **kwargs):
+        self._supervisor.stop_and_remove(_SUPERVISOR_NAME)
+        return self
+
+
+# register.
+Tool.__tools__['pypi_cache'] = PypiCacheTool
+
+
+# private constants.
+_SUPERVISOR_NAME = 'fck_pypi_cache'
+
+_PIP_CONF = """
+[global]
+index-url = http://{host}:{port}/simple/
+trusted-host = {host}
+""".lstrip()
+
+_DISTUTILS_CFG = """
+[easy_install]
+index_url = http://{host}:{port}/simple/
+""".lstrip()
+
+_SERVER_SCRIPT = """
+import hashlib, json, os, re, shutil, sys, tempfile, time
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import urlopen
+    from urlparse import urljoin, urldefrag
+    from cgi import escape
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import urlopen
+    from urllib.parse import urljoin, urldefrag
+    from html import escape
+
+root, port = sys.argv[1], int(sys.argv[2])
+upstream = sys.argv[3].rstrip('/') + '/' if len(sys.argv) > 3 and sys.argv[3] else None
+INDEX_TTL = 300
+ANCHOR = re.compile(r'<a\\s+([^>]*)>([^<]*)</a>', re.I)
+ATTR = re.compile(r'([\\w-]+)\\s*=\\s*"([^"]*)"')
+# link attributes passed on from upstream; others (e.g., PEP 658 metadata) describe files
+# that the cache doesn't serve.
+KEEP_ATTRS = ('data-requires-python', 'data-yanked')
+
+def normalize(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def fetch_index(project):
+    # returns {file name: {"url", "hash", "attrs"}} from the cached or upstream listing.
+    index_file = os.path.join(root, project, '.index.json')
+    try:
+        cached = json.load(open(index_file))
+    except (IOError, ValueError):
+        cached = None
+    if upstream and not (cached and time.time() - cached['time'] < INDEX_TTL):
+        try:
+            url = urljoin(upstream, project + '/')
+            html = urlopen(url, timeout=15).read().decode('utf-8')
+            links = {}
+            for attrs, text in ANCHOR.findall(html):
+                attrs = dict(ATTR.findall(attrs))
+                href, fragment = urldefrag(urljoin(url, attrs.get('href', '')))
+                attrs = dict((k, v) for k, v in attrs.items() if k in KEEP_ATTRS)
+                links[text.strip()] = dict(url=href, hash=fragment, attrs=attrs)
+            cached = dict(time=time.time(), links=links)
+            if not os.path.isdir(os.path.join(root, project)):
+                os.makedirs(os.path.join(root, project))
+            write_file(index_file, json.dumps(cached).encode('utf-8'))
+        except Exception as e:
+            sys.stderr.write('upstream index failed for %s: %s\\n' % (project, e))
+    return cached['links'] if cached else {}
+
+def write_file(dest, data=None, src=None, digest=''):
+    # writes to a temporary file and renames it, so readers never see a partial file. with a
+    # digest ("<algorithm>=<hex>"), the file is only renamed into place if its content matches.
+    algorithm, _, expected = digest.partition('=')
+    h = hashlib.new(algorithm) if digest else None
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.')
+    try:
+        f = os.fdopen(fd, 'wb')
+        blocks = iter(lambda: src.read(1 << 20), b'') if src is not None else [data]
+        for block in blocks:
+            if h:
+                h.update(block)
+            f.write(block)
+        f.close()
+        if h and h.hexdigest() != expected:
+            raise ValueError('hash mismatch')
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def file_hash(p):
+    h = hashlib.sha256()
+    f = open(p, 'rb')
+    for block in iter(lambda: f.read(1 << 20), b''):
+        h.update(block)
+    f.close()
+    return 'sha256=' + h.hexdigest()
+
+def local_hash(p):
+    # hashes of files put in the cache by hand are kept in a ".<name>.sha256" file.
+    hash_file = os.path.join(os.path.dirname(p), '.%s.sha256' % os.path.basename(p))
+    if os.path.exists(hash_file) and os.path.getmtime(hash_file) >= os.path.getmtime(p):
+        return open(hash_file).read().strip()
+    fragment = file_hash(p)
+    write_file(hash_file, fragment.encode('utf-8'))
+    return fragment
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = [p for p in self.path.split('?')[0].split('/') if p]
+        if parts == ['simple']:
+            names = sorted(n for n in os.listdir(root) if os.path.isdir(os.path.join(root, n)))
+            self.send_html('Simple index', ['<a href="%s/">%s</a>' % (n, n) for n in names])
+        elif len(parts) == 2 and parts[0] == 'simple':
+            project = normalize(parts[1])
+            if project != parts[1]:
+                self.send_response(301)
+                self.send_header('Location', '/simple/%s/' % project)
+                self.end_headers()
+                return
+            self.send_project(project)
+        elif len(parts) == 3 and parts[0] == 'files':
+            self.send_dist(normalize(parts[1]), os.path.basename(parts[2]))
+        else:
+            self.send_error(404)
+
+    def send_project(self, project):
+        project_dir = os.path.join(root, project)
+        local = set()
+        if os.path.isdir(project_dir):
+            local = set(n for n in os.listdir(project_dir) if not n.startswith('.'))
+        links = fetch_index(project)
+        if not (local or links):
+            self.send_error(404)
+            return
+        anchors = []
+        for name in sorted(local | set(links)):
+            link = links.get(name, {})
+            fragment = link.get('hash', '') or (local_hash(os.path.join(project_dir, name)) if name in local else '')
+            attrs = ''.join(' %s="%s"' % item for item in sorted(link.get('attrs', {}).items()))
+            href = '/files/%s/%s%s' % (project, name, '#' + fragment if fragment else '')
+            anchors.append('<a href="%s"%s>%s</a>' % (href, attrs, escape(name)))
+        self.send_html('Links for %s' % project, anchors)
+
+    def send_dist(self, project, name):
+        p = os.path.join(root, project, name)
+        if not os.path.isfile(p):
+            link = fetch_index(project).get(name, None)
+            if not link:
+                self.send_error(404)
+                return
+            try:
+                write_file(p, src=urlopen(link['url'], timeout=60), digest=link['hash'])
+            except Exception as e:
+                self.send_error(502, str(e))
+                return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(p)))
+        self.end_headers()
+        f = open(p, 'rb')
+        shutil.copyfileobj(f, self.wfile, 1 << 20)
+        f.close()
+
+    def send_html(self, title, anchors):
+        data = ('<!DOCTYPE html>\\n<html><head><title>%s</title></head><body>\\n%s\\n</body></html>\\n' % (
+            title, '<br/>\\n'.join(anchors))).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+Server(('', port), Handler).serve_forever()
+""".lstrip()
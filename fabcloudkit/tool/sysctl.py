@@ -0,0 +1,218 @@
+"""
+    fabcloudkit
+
+    Functions for tuning kernel parameters and resource limits for the services a host runs.
+    Recommended values are computed from host facts (memory, CPU count) and the services of
+    the host's role, then applied persistently. Applying is idempotent: the files below are
+    rewritten in full each time, and only differing values are reported.
+
+    /etc/sysctl.d/90-fabcloudkit.conf:
+        Kernel parameters; loaded at boot, and applied immediately with "sysctl -p".
+
+    /etc/security/limits.d/90-fabcloudkit.conf:
+        The open-file ("nofile") limit for the user that runs services (default "nobody").
+
+    /etc/supervisord.conf:
+        Programs started by supervisord inherit its limits rather than the PAM limits above,
+        so its "minfds" setting is raised to the same value. This takes effect the next time
+        supervisord starts.
+
+    /etc/rc.local:
+        Disables transparent hugepages at boot (for Redis hosts).
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# standard
+import re
+
+# pypi
+from fabric.operations import run, sudo
+from fabric.state import env
+
+# package
+from ..internal import *
+from ..remote_util import host_facts
+from ..toolbase import Tool
+from ..util import put_string
+
+
+class SysctlTool(Tool):
+    def check(self, services=None, sysctl=None, limits=None, user='nobody', **kwargs):
+        """Determines if the host is already tuned.
+
+        :return: True if all recommended values are in effect, False otherwise.
+        """
+        return not self.diff(services, sysctl, limits, user)
+
+    def install(self, services=None, sysctl=None, limits=None, user='nobody', **kwargs):
+        """Applies the recommended kernel parameters and limits to the host.
+
+        :param services:
+            optional; list of services the host runs: "web" (nginx/gunicorn) and/or "redis".
+            default: taken from the tools used in the current role's specs.
+
+        :param sysctl:
+            optional; dict of kernel parameters that override recommended values.
+
+        :param limits:
+            optional; dict of limits that override recommended values (currently "nofile").
+
+        :param user:
+            optional; the user whose limits are raised. default: "nobody" (supervisor programs).
+
+        :return: the dict of differences that were applied (see diff()).
+        """
+        start_msg('----- Tuning kernel parameters and limits:')
+        params, lims, thp = self.recommend(services, sysctl, limits)
+        changes = self.diff(services, sysctl, limits, user, params=(params, lims, thp))
+        if not changes:
+            succeed_msg('Host is already tuned.')
+            return changes
+
+        # kernel parameters.
+        conf = ''.join(['{0} = {1}\n'.format(k, params[k]) for k in sorted(params)])
+        put_string(conf, _SYSCTL_FILE, use_sudo=True)
+        result = sudo('sysctl -e -p {0}'.format(_SYSCTL_FILE))
+        if result.failed:
+            raise HaltError('Failed to apply kernel parameters ({0}).'.format(result))
+
+        # open-file limits, for both PAM sessions and supervisor programs.
+        nofile = lims['nofile']
+        put_string(_LIMITS_CONF.format(**locals()), _LIMITS_FILE, use_sudo=True)
+        sudo("test -f {0} && sed -i 's/^minfds=[0-9]*/minfds={1}/' {0}".format(_SUPERVISOR_CONF, nofile))
+
+        # transparent hugepages: now, and at boot.
+        if thp:
+            cmd = _THP_CMD.format(value=thp)
+            result = sudo(cmd)
+            if result.failed:
+                failed_msg('Unable to set transparent hugepages; ignoring.')
+            sudo("grep -qF '{0}' /etc/rc.local || echo '{0}' >> /etc/rc.local".format(cmd))
+
+        succeed_msg('Applied {0} change(s).'.format(len(changes)))
+        return changes
+
+    def diff(self, services=None, sysctl=None, limits=None, user='nobody', params=None):
+        """Reports the differences between current and recommended values.
+
+        :return: dict mapping a setting name to a (current, recommended) tuple.
+        """
+        params, lims, thp = params or self.recommend(services, sysctl, limits)
+
+        changes = dict()
+        current = self._current_sysctl(params.keys())
+        for k,v in params.iteritems():
+            if _normalize(current.get(k, None)) != _normalize(v):
+                changes[k] = (current.get(k, None), v)
+
+        result = sudo('ulimit -n', user=user, quiet=True)
+        nofile = result.strip() if result.succeeded else None
+        if _normalize(nofile) != _normalize(lims['nofile']):
+            changes['{0}.nofile'.format(user)] = (nofile, lims['nofile'])
+
+        if thp:
+            result = run(_THP_READ_CMD, quiet=True)
+            match = re.search(r'\[(\w+)\]', result)
+            current_thp = match.group(1) if match else None
+            if current_thp is not None and current_thp != thp:
+                changes['transparent_hugepage'] = (current_thp, thp)
+
+        for k in sorted(changes):
+            yellow_msg('{0}: {1} -> {2}'.format(k, *changes[k]))
+        return changes
+
+    def recommend(self, services=None, sysctl=None, limits=None):
+        """Computes recommended values from host facts and services.
+
+        :return: a tuple of (kernel parameters dict, limits dict, transparent hugepage setting or None).
+        """
+        facts = host_facts()
+        services = self._services(services)
+        mem_kb = facts['mem_total'] // 1024
+        cpus = facts['cpu_count']
+
+        # the usual rule of thumb: allow ~10% of memory (in KB) as open files.
+        file_max = max(mem_kb // 10, facts['file_max'], 65536)
+        params = {'fs.file-max': file_max}
+        lims = {'nofile': min(file_max, 65535)}
+        thp = None
+
+        if 'web' in services:
+            # nginx and gunicorn accept queues, and many short-lived proxy connections.
+            big = mem_kb >= 2 * 1024 * 1024
+            params['net.core.somaxconn'] = 4096
+            params['net.ipv4.tcp_max_syn_backlog'] = 8192 if big else 4096
+            params['net.core.netdev_max_backlog'] = max(1000, 2500 * cpus)
+            params['net.ipv4.ip_local_port_range'] = '10240 65535'
+            params['net.ipv4.tcp_tw_reuse'] = 1
+            params['net.ipv4.tcp_fin_timeout'] = 15
+
+        if 'redis' in services:
+            # redis needs overcommit for background saves, and THP causes latency spikes on fork.
+            params['vm.overcommit_memory'] = 1
+            params['net.core.somaxconn'] = max(params.get('net.core.somaxconn', 0), 1024)
+            thp = 'never'
+
+        params.update(sysctl or {})
+        lims.update(limits or {})
+        return params, lims, thp
+
+    def _current_sysctl(self, keys):
+        result = run('sysctl -e {0}'.format(' '.join(sorted(keys))), quiet=True)
+        current = dict()
+        for line in result.splitlines():
+            if '=' in line:
+                k, v = line.split('=', 1)
+                current[k.strip()] = v.strip()
+        return current
+
+    def _services(self, services):
+        if services is not None:
+            return [services] if isinstance(services, basestring) else services
+
+        # infer services from the tools used by the current role.
+        role = env.get('role', None)
+        names = set()
+        for section in ('provision', 'build', 'activate'):
+            for tool_def in (role.get(section, None) or []) if role else []:
+                names.update(tool_def.keys() if isinstance(tool_def, dict) else [])
+                for spec in (tool_def.values() if isinstance(tool_def, dict) else []):
+                    if isinstance(spec, dict) and isinstance(spec.get('options', None), list):
+                        names.update(spec['options'])
+
+        services = []
+        if names & set(['nginx', 'gunicorn', 'nginx_gunicorn']):
+            services.append('web')
+        if 'redis' in names:
+            services.append('redis')
+        message('Tuning for services: {0}'.format(services or 'none'))
+        return services
+
+
+# register.
+Tool.__tools__['sysctl'] = SysctlTool
+
+
+# private.
+_SYSCTL_FILE = '/etc/sysctl.d/90-fabcloudkit.conf'
+_LIMITS_FILE = '/etc/security/limits.d/90-fabcloudkit.conf'
+_SUPERVISOR_CONF = '/etc/supervisord.conf'
+
+_LIMITS_CONF = """
+{user} soft nofile {nofile}
+{user} hard nofile {nofile}
+""".lstrip()
+
+# the RedHat 6 kernel uses a different path.
+_THP_CMD = ('for f in /sys/kernel/mm/transparent_hugepage/enabled '
+            '/sys/kernel/mm/redhat_transparent_hugepage/enabled; '
+            'do test -f $f && echo {value} > $f; done; true')
+_THP_READ_CMD = ('cat /sys/kernel/mm/transparent_hugepage/enabled '
+                 '/sys/kernel/mm/redhat_transparent_hugepage/enabled 2>/dev/null')
+
+def _normalize(value):
+    # sysctl separates multi-value parameters with tabs.
+    return None if value is None else ' '.join(str(value).split())
@@ -91,6 +91,39 @@ class VirtualEnvTool(Tool):
                 succeed_msg('Used python interpreter: "{0}"'.format(interpreter))
         return self
 
+    def clone(self, src_dir, dst_dir):
+        """
+        Creates a new virtualenv as a copy of an existing one.
+
+        Files are hard-linked rather than copied, which is fast and shares disk space between
+        the two virtualenvs. Scripts and path files that contain the source path are rewritten
+        for the new location (rewriting replaces the file, so the source isn't affected).
+
+        Note: because files are shared, packages must be uninstalled (not overwritten in place)
+        before they're reinstalled into the clone; pip does this for upgrades.
+
+        :param src_dir: the existing virtualenv directory.
+        :param dst_dir: the new virtualenv directory; must not exist.
+        :return: None
+        """
+        start_msg('----- Cloning virtualenv "{0}" to "{1}":'.format(src_dir, dst_dir))
+        result = run('cp -al {src_dir} {dst_dir}'.format(**locals()))
+        if result.failed:
+            raise HaltError('Failed to clone virtualenv "{0}"'.format(src_dir))
+
+        result = run(_FIXUP_PATHS_CMD.format(**locals()))
+        if result.failed:
+            raise HaltError('Failed to fix up paths in cloned virtualenv "{0}"'.format(dst_dir))
+        succeed_msg('Cloned virtualenv to "{0}"'.format(dst_dir))
+        return self
+
 
 # register.
 Tool.__tools__['virtualenv'] = VirtualEnvTool
+
+# rewrites the absolute virtualenv path in text files that contain it: scripts in "bin" (e.g.,
+# "activate" and "#!" lines), and path configuration files in site-packages.
+_FIXUP_PATHS_CMD = (
+    "grep -rlIF --null '{src_dir}' {dst_dir}/bin "
+    "$(ls -d {dst_dir}/lib/python*/site-packages/*.pth {dst_dir}/lib/python*/site-packages/*.egg-link 2>/dev/null) "
+    "| xargs -0 -r sed -i 's#{src_dir}#{dst_dir}#g'")
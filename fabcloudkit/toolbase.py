@@ -1,5 +1,8 @@
 from __future__ import absolute_import
 
+# standard
+from importlib import import_module
+
 # pypi
 from fabric.operations import reboot, run, sudo
 
@@ -14,6 +17,32 @@ class Tool(object):
     # key is the tool name, value is the tool class.
     __tools__ = dict()
 
+    # tools that are imported on first use. key is the tool name, value is the name of the
+    # module that registers the tool when imported. third-party tools can also be provided
+    # via the "fabcloudkit.tools" entry point group (entry point name is the tool name).
+    __modules__ = {
+        'artifact_server': 'fabcloudkit.tool.artifact_server',
+        'ccache':          'fabcloudkit.tool.ccache',
+        'git':             'fabcloudkit.tool.git',
+        'gunicorn':        'fabcloudkit.tool.gunicorn',
+        'key_pair':        'fabcloudkit.tool.keys',
+        'nginx':           'fabcloudkit.tool.nginx',
+        'nginx_gunicorn':  'fabcloudkit.activation_tools.nginx_gunicorn_activation',
+        'package_cache':   'fabcloudkit.tool.package_cache',
+        'pip':             'fabcloudkit.tool.pip',
+        'pip_command':     'fabcloudkit.tool.pip_command',
+        'pypi_cache':      'fabcloudkit.tool.pypi_cache',
+        'python_build':    'fabcloudkit.build_tools.python_build',
+        'redis':           'fabcloudkit.tool.redis',
+        'request_access':  'fabcloudkit.tool.keys',
+        'supervisord':     'fabcloudkit.tool.supervisord',
+        'sysctl':          'fabcloudkit.tool.sysctl',
+        'virtualenv':      'fabcloudkit.tool.virtualenv'
+    }
+
+    # entry points from the "fabcloudkit.tools" group; loaded on first miss.
+    _entry_points = None
+
     @classmethod
     def create(cls, name):
         """Creates a Tool-derived class based on the tool name.
@@ -22,9 +51,58 @@ class Tool(object):
         :return: the Tool-derived object.
         """
         # look first for a registered tool, fallback to a simple tool.
-        tool_cls = cls.__tools__.get(name, None)
+        tool_cls = cls.lookup(name)
         return tool_cls() if tool_cls else SimpleTool.create(name)
 
+    @classmethod
+    def lookup(cls, name):
+        """Returns the Tool-derived class registered for a tool name, importing it if necessary.
+
+        :param name: the name of the tool.
+        :return: the Tool-derived class, or None if there is no such tool.
+        """
+        tool_cls = cls.__tools__.get(name, None)
+        if tool_cls is not None:
+            return tool_cls
+
+        # importing the module registers the tool in __tools__.
+        module_name = cls.__modules__.get(name, None)
+        if module_name:
+            import_module(module_name)
+            return cls.__tools__.get(name, None)
+
+        entry_point = cls._get_entry_points().get(name, None)
+        if entry_point:
+            tool_cls = entry_point.load()
+            cls.__tools__[name] = tool_cls
+        return tool_cls
+
+    @classmethod
+    def exists(cls, name):
+        """Determines if a (non-simple) tool is known by name, without importing it.
+
+        :param name: the name of the tool.
+        :return: True if the tool is registered or can be imported, False otherwise.
+        """
+        return name in cls.__tools__ or name in cls.__modules__ or name in cls._get_entry_points()
+
+    @classmethod
+    def register(cls, name, module_name):
+        """Registers a tool whose module should be imported on first use.
+
+        :param name: the name of the tool.
+        :param module_name: the name of the module that registers the tool when imported.
+        """
+        cls.__modules__[name] = module_name
+
+    @classmethod
+    def _get_entry_points(cls):
+        if cls._entry_points is None:
+            # pkg_resources is slow to import; only pay for it if a tool isn't otherwise known.
+            from pkg_resources import iter_entry_points
+            cls._entry_points = dict((ep.name, ep) for ep in iter_entry_points('fabcloudkit.tools'))
+        return cls._entry_points
+
     @classmethod
     def execute(cls, tool_name, dct):
         """Executes a standard/compliant tool definition.
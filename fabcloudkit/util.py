@@ -13,7 +13,10 @@ import posixpath as path
 import random
 
 # pypi
+from fabric.decorators import parallel
 from fabric.operations import run, put
+from fabric.state import env
+from fabric.tasks import execute
 
 # package
 from fabcloudkit import cfg
@@ -45,9 +48,52 @@ def put_string(str, remote_path, *args, **kwargs):
         raise HaltError("Appeared to write file \"{0}\", but it's not there...?".format(remote_path))
     return result
 
+def ssh_options():
+    """
+    Returns the ssh/scp options used for connections between instances.
+
+    Connections use the machine key, and are multiplexed over a persistent master connection
+    so repeated scp/ssh/git commands to the same host skip the key exchange and authentication.
+    """
+    return ('-o StrictHostKeyChecking=no -o BatchMode=yes '
+            '-o ControlMaster=auto -o ControlPath=~/.ssh/fck_%r@%h:%p -o ControlPersist=5m '
+            '-i {key}'.format(key=cfg().machine_key_file()))
+
 def copy_file_from(from_user, from_host, from_path, to_path):
     result = run(
-        'scp -o StrictHostKeyChecking=no -i {key} {from_user}@{from_host}:{from_path} {to_path}'
-        .format(key=cfg().machine_key_file(), **locals()))
+        'scp {opts} {from_user}@{from_host}:{from_path} {to_path}'
+        .format(opts=ssh_options(), **locals()))
     if result.failed:
         raise HaltError('Unable to copy from {0}:{1}'.format(from_host, from_path))
+
+def run_parallel(func, host_strings, *args, **kwargs):
+    """
+    Executes a function on each of the specified hosts concurrently.
+
+    Uses Fabric's parallel (multi-process) execution, so the function runs with env.host_string
+    set to each host in turn, as it would under settings(host_string=...). Return values must
+    be picklable.
+
+    :param func: the function to execute.
+    :param host_strings: list of host strings (e.g., "ec2-user@host").
+    :param pool_size: optional keyword argument; the maximum number of concurrent hosts.
+    :return: a dict mapping each host string to the function's return value.
+    """
+    if not host_strings:
+        return {}
+
+    def task(*args, **kwargs):
+        # report failures as values; Fabric only reports that a child process failed.
+        try:
+            return True, func(*args, **kwargs)
+        except Exception as e:
+            failed_msg('Failed on host "{0}": {1}'.format(env.host_string, e))
+            return False, str(e)
+
+    pool_size = kwargs.pop('pool_size', None)
+    results = execute(parallel(pool_size=pool_size)(task), *args, hosts=host_strings, **kwargs)
+
+    failed = sorted([host for host, result in results.iteritems() if not (result and result[0])])
+    if failed:
+        raise HaltError('Failed on host(s): {0}'.format(', '.join(failed)))
+    return dict([(host, result[1]) for host, result in results.iteritems()])
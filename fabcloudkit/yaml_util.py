@@ -16,3 +16,44 @@ def env_constructor(loader, node):
 
 # this tag only works if using yaml.load(), not yaml.safe_load().
 yaml.add_constructor(u'!env', env_constructor)
+
+
+class EnvRef(object):
+    """A reference to an environment variable; see BundleLoader."""
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return '!env {0}'.format(self.name)
+
+    def resolve(self):
+        value = os.environ.get(self.name, None)
+        if value is None:
+            raise RuntimeError('Environment variable "{0}" is not set.'.format(self.name))
+        return value
+
+
+# use the libyaml-based loader when it's available; it's much faster than the pure-python one.
+class BundleLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+    """Safe loader that leaves "!env" values as EnvRef objects instead of resolving them.
+
+    This allows the parsed result to be cached without capturing environment values (which
+    are often secrets); see resolve_env().
+    """
+    pass
+
+def _env_ref_constructor(loader, node):
+    return EnvRef(loader.construct_scalar(node))
+
+BundleLoader.add_constructor(u'!env', _env_ref_constructor)
+
+
+def resolve_env(obj):
+    """Returns a copy of obj with every EnvRef replaced by the environment variable's value."""
+    if isinstance(obj, EnvRef):
+        return obj.resolve()
+    if isinstance(obj, dict):
+        return dict((k, resolve_env(v)) for k,v in obj.iteritems())
+    if isinstance(obj, list):
+        return [resolve_env(v) for v in obj]
+    return obj
@@ -0,0 +1,68 @@
+"""
+    fabcloudkit
+
+    Checks of the dependency layer key (see fabcloudkit.build.DependencyCache.key()). The
+    remote requirements check (resolve_requirements()) is replaced by a function returning
+    fixed requirements, so nothing runs on a host.
+
+    Run from the repository root: "PYTHONPATH=. python tests/test_build.py".
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# standard
+import re
+import unittest
+
+# package
+from fabcloudkit import build
+from fabcloudkit.build import DependencyCache
+
+
+class DependencyCacheKeyTest(unittest.TestCase):
+    def setUp(self):
+        self._resolve_requirements = build.resolve_requirements
+        self.info = dict(python='2.7.18', requirements=['Django==1.5.1', 'South>=0.8'])
+        self.calls = []
+
+        def resolve_requirements(repo_list, interpreter=None):
+            self.calls.append((repo_list, interpreter))
+            return self.info
+        build.resolve_requirements = resolve_requirements
+
+    def tearDown(self):
+        build.resolve_requirements = self._resolve_requirements
+
+    def key(self):
+        return DependencyCache().key(['repo'], 'python2.7')
+
+    def test_key(self):
+        key, requirements = self.key()
+        self.assertTrue(re.match(r'^[0-9a-f]{16}$', key), key)
+        self.assertEqual(requirements, ['Django==1.5.1', 'South>=0.8'])
+        self.assertEqual(self.calls, [(['repo'], 'python2.7')])
+
+    def test_same_inputs(self):
+        self.assertEqual(self.key(), self.key())
+
+    def test_requirements_change_key(self):
+        key = self.key()[0]
+        self.info = dict(python='2.7.18', requirements=['Django==1.5.2', 'South>=0.8'])
+        self.assertNotEqual(self.key()[0], key)
+        self.info = dict(python='2.7.18', requirements=['Django==1.5.1'])
+        self.assertNotEqual(self.key()[0], key)
+
+    def test_python_changes_key(self):
+        key = self.key()[0]
+        self.info = dict(python='2.7.3', requirements=['Django==1.5.1', 'South>=0.8'])
+        self.assertNotEqual(self.key()[0], key)
+
+    def test_unknown_requirements(self):
+        self.info = None
+        self.assertEqual(self.key(), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
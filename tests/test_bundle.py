@@ -0,0 +1,91 @@
+"""
+    fabcloudkit
+
+    Checks of the repo defaults and validation done when a configuration bundle is compiled
+    (see fabcloudkit.bundle). Warnings are collected instead of printed.
+
+    Run from the repository root: "PYTHONPATH=. python tests/test_bundle.py".
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# standard
+import unittest
+
+# package
+from fabcloudkit import bundle
+from fabcloudkit.bundle import _resolve_repos, _validate
+
+
+class ResolveReposTest(unittest.TestCase):
+    def test_defaults(self):
+        context = dict(repos=dict(app=dict(url='git@github.com:example/my-app.git')))
+        _resolve_repos(context)
+        self.assertEqual(context['repos']['app'], dict(url='git@github.com:example/my-app.git',
+                                                       dir='my-app', package_name='my-app'))
+
+    def test_explicit_values_kept(self):
+        repo = dict(url='https://github.com/example/app.git', dir='site', package_name='example_site')
+        context = dict(repos=dict(app=dict(repo)))
+        _resolve_repos(context)
+        self.assertEqual(context['repos']['app'], repo)
+
+    def test_package_name_from_dir(self):
+        context = dict(repos=dict(app=dict(url='https://github.com/example/app.git', dir='site')))
+        _resolve_repos(context)
+        self.assertEqual(context['repos']['app']['package_name'], 'site')
+
+    def test_no_repos(self):
+        for context in (dict(), dict(repos=None)):
+            _resolve_repos(context)
+
+    def test_missing_url(self):
+        self.assertRaises(RuntimeError, _resolve_repos, dict(repos=dict(app=dict(dir='app'))))
+
+
+class ValidateTest(unittest.TestCase):
+    def setUp(self):
+        self._message = bundle.message
+        self.messages = []
+        bundle.message = self.messages.append
+        self.config = dict(tools=dict(gcc=dict(), nginx=dict()))
+
+    def tearDown(self):
+        bundle.message = self._message
+
+    def validate(self, roles, name='demo'):
+        _validate('demo.yaml', dict(name=name), roles, self.config)
+
+    def test_valid(self):
+        self.validate([
+            dict(name='builder', allow_access=dict(roles=['web']),
+                 provision=[{'tools': ['gcc', 'nginx']}, {'key_pair': None}],
+                 build=[{'python_build': dict(command='build')}]),
+            dict(name='web', allow_access=dict(roles='builder'), activate=[{'git': None}])])
+        self.assertEqual(self.messages, [])
+
+    def test_context_name(self):
+        for name in (None, '', 'my demo'):
+            self.assertRaises(RuntimeError, self.validate, [], name=name)
+
+    def test_role_names(self):
+        self.assertRaises(RuntimeError, self.validate, [dict(provision=[])])
+        self.assertRaises(RuntimeError, self.validate, [dict(name='web'), dict(name='web')])
+
+    def test_unknown_tool_warns(self):
+        self.validate([dict(name='web', provision=[{'tools': dict(options=['gcc', 'no_such_tool'])}],
+                            activate=[{'no_such_activation': None}])])
+        self.assertEqual(len(self.messages), 2)
+        self.assertIn('"no_such_tool" in "provision"', self.messages[0])
+        self.assertIn('"no_such_activation" in "activate"', self.messages[1])
+
+    def test_unknown_role_warns(self):
+        self.validate([dict(name='web', allow_access=dict(roles=['web', 'builder']))])
+        self.assertEqual(len(self.messages), 1)
+        self.assertIn('unknown role "builder"', self.messages[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""
+    fabcloudkit
+
+    Checks of the build distribution schedule (see fabcloudkit.distribute.plan_rounds()). The
+    last test runs a schedule with local directories standing in for hosts, and a "tar | tar"
+    process for each copy; the copies in a round run at the same time.
+
+    Run from the repository root: "PYTHONPATH=. python tests/test_distribute.py".
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# standard
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+# package
+from fabcloudkit.distribute import plan_rounds
+
+
+class PlanRoundsTest(unittest.TestCase):
+    def test_every_target_once(self):
+        targets = ['h{0}'.format(n) for n in xrange(50)]
+        rounds = plan_rounds(['src'], targets, fanout=3)
+        received = [target for pairs in rounds for source, target in pairs]
+        self.assertEqual(sorted(received), sorted(targets))
+        self.assertNotIn('src', received)
+
+    def test_sources_have_the_build(self):
+        holders = set(['src'])
+        for pairs in plan_rounds(['src'], ['h{0}'.format(n) for n in xrange(40)], fanout=2):
+            for source, target in pairs:
+                self.assertIn(source, holders)
+            holders.update([target for source, target in pairs])
+
+    def test_fanout(self):
+        for pairs in plan_rounds(['src'], ['h{0}'.format(n) for n in xrange(40)], fanout=2):
+            sources = [source for source, target in pairs]
+            self.assertTrue(all([sources.count(source) <= 2 for source in sources]))
+
+    def test_round_count(self):
+        for fanout in (1, 2, 4):
+            for count in (1, 2, 7, 8, 9, 100, 1000):
+                rounds = plan_rounds(['src'], ['h{0}'.format(n) for n in xrange(count)], fanout=fanout)
+                expected = int(math.ceil(math.log(count + 1) / math.log(fanout + 1) - 1e-9))
+                self.assertEqual(len(rounds), expected, (fanout, count))
+
+    def test_no_targets(self):
+        self.assertEqual(plan_rounds(['src'], [], fanout=2), [])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, plan_rounds, ['src'], ['h0'], fanout=0)
+        self.assertRaises(ValueError, plan_rounds, [], ['h0'], fanout=2)
+
+    def test_local_hosts(self):
+        root = tempfile.mkdtemp()
+        try:
+            hosts = ['h{0}'.format(n) for n in xrange(12)]
+            for host in ['src'] + hosts:
+                os.mkdir(os.path.join(root, host))
+            build = os.path.join(root, 'src', 'ctx_1_abc')
+            os.makedirs(os.path.join(build, 'bin'))
+            with open(os.path.join(build, 'bin', 'python'), 'w') as f:
+                f.write('x' * 100000)
+
+            for pairs in plan_rounds(['src'], hosts, fanout=2):
+                copies = [subprocess.Popen('tar -C {0} -c ctx_1_abc | tar -C {1} -x'.format(
+                    os.path.join(root, source), os.path.join(root, target)), shell=True)
+                    for source, target in pairs]
+                self.assertEqual([p.wait() for p in copies], [0] * len(copies))
+
+            for host in hosts:
+                with open(os.path.join(root, host, 'ctx_1_abc', 'bin', 'python')) as f:
+                    self.assertEqual(len(f.read()), 100000)
+        finally:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    unittest.main()
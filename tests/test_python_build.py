@@ -0,0 +1,67 @@
+"""
+    fabcloudkit
+
+    Checks of the build input key that memoized builds are found by (see
+    PythonBuildTool._input_key()). The remote requirements check is replaced by a function
+    returning fixed requirements.
+
+    Run from the repository root: "PYTHONPATH=. python tests/test_python_build.py".
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# standard
+import unittest
+
+# package
+from fabcloudkit.build_tools import python_build
+from fabcloudkit.build_tools.python_build import PythonBuildTool
+
+
+class InputKeyTest(unittest.TestCase):
+    def setUp(self):
+        self._resolve_requirements = python_build.resolve_requirements
+        self.info = dict(python='2.7.18', requirements=['Django==1.5.1'])
+        python_build.resolve_requirements = lambda repo_list, interpreter=None: self.info
+        self.commits = dict(app='3f2a9c1', lib='77b01de')
+        self.plan = dict(repos=['app', 'lib'], post_build=None, tarball=True, unittest=None, precompile=True)
+
+    def tearDown(self):
+        python_build.resolve_requirements = self._resolve_requirements
+
+    def key(self, commits=None, interpreter='python2.7', plan=None):
+        return PythonBuildTool()._input_key(['repo'], commits or self.commits, interpreter, plan or self.plan)
+
+    def test_same_inputs(self):
+        key = self.key()
+        self.assertEqual(len(key), 40)
+        self.assertEqual(self.key(commits=dict(reversed(self.commits.items()))), key)
+        self.assertEqual(self.key(plan=dict(self.plan)), key)
+
+    def test_commit_changes_key(self):
+        self.assertNotEqual(self.key(commits=dict(self.commits, lib='0c9d4e2')), self.key())
+
+    def test_plan_changes_key(self):
+        self.assertNotEqual(self.key(plan=dict(self.plan, tarball=False)), self.key())
+        self.assertNotEqual(self.key(plan=dict(self.plan, repos=['app'])), self.key())
+
+    def test_interpreter_changes_key(self):
+        key = self.key()
+        self.assertNotEqual(self.key(interpreter='python3.3'), key)
+        self.info = dict(python='2.7.3', requirements=['Django==1.5.1'])
+        self.assertNotEqual(self.key(), key)
+
+    def test_requirements_change_key(self):
+        key = self.key()
+        self.info = dict(python='2.7.18', requirements=['Django==1.5.1', 'South>=0.8'])
+        self.assertNotEqual(self.key(), key)
+
+    def test_unknown_requirements(self):
+        self.info = None
+        self.assertEqual(self.key(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
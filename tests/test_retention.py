@@ -0,0 +1,61 @@
+"""
+    fabcloudkit
+
+    Checks of which builds garbage collection keeps (see fabcloudkit.retention), using a
+    BuildInfo filled in locally rather than loaded from a host.
+
+    Run from the repository root: "PYTHONPATH=. python tests/test_retention.py".
+
+    :copyright: (c) 2013 by Rick Bohrer.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import absolute_import
+
+# standard
+import unittest
+
+# package
+from fabcloudkit.build import BuildInfo
+from fabcloudkit.retention import _select_builds
+
+
+def build_info(good, last=None, active=None):
+    info = BuildInfo('demo')
+    info._dct = dict(number=0, last=last, builds=dict((name, {}) for name in good),
+                     active=dict((key, dict(build=name)) for key, name in (active or {}).items()))
+    return info
+
+def name(number):
+    return 'demo_{0:0>5}_abc{0}'.format(number)
+
+
+class SelectBuildsTest(unittest.TestCase):
+    def test_keeps_newest(self):
+        # numeric order, not name order: build 10 is newer than build 9.
+        good, kept, newest = _select_builds(build_info([name(n) for n in (10, 2, 9, 1)]), 2)
+        self.assertEqual(good, [name(1), name(2), name(9), name(10)])
+        self.assertEqual(kept, set([name(9), name(10)]))
+        self.assertEqual(newest, 10)
+
+    def test_keeps_active(self):
+        info = build_info([name(n) for n in range(1, 6)], active=dict(web=name(1), api=name(2)))
+        good, kept, newest = _select_builds(info, 1)
+        self.assertEqual(kept, set([name(1), name(2), name(5)]))
+
+    def test_last_good_counts_as_good(self):
+        # files written by earlier versions only record the last good build.
+        good, kept, newest = _select_builds(build_info([name(1), name(2)], last=name(3)), 2)
+        self.assertEqual(good, [name(1), name(2), name(3)])
+        self.assertEqual(kept, set([name(2), name(3)]))
+        self.assertEqual(newest, 3)
+
+    def test_keep_more_than_built(self):
+        good, kept, newest = _select_builds(build_info([name(1), name(2)], last=name(2)), 5)
+        self.assertEqual(kept, set([name(1), name(2)]))
+
+    def test_no_builds(self):
+        self.assertEqual(_select_builds(build_info([]), 3), ([], set(), 0))
+
+
+if __name__ == '__main__':
+    unittest.main()